@@ -3,8 +3,11 @@ from django.core.cache import cache
 from rest_framework import status
 from rest_framework.test import APITestCase
 from pprint import pprint
+from pycoin.key.BIP32Node import BIP32Node
 
 from .models import Address
+from blockchain.models import Transaction
+from wallet.models import Wallet
 from spauser import utils
 import address.utils
 import wallet.utils
@@ -108,3 +111,48 @@ class AddressTest(APITestCase):
         known_address = Address(label='manual', p2pkh='n24pZghJBAjjGT5V8i8bufRuhb2LEACuzU', wallet_id=litecoin_testnet4_wallet_id)
         known_address.save()
         self.assertEqual(Address.objects.count(), 5)
+
+    def test_get_new_address_skips_used(self):
+        """
+        Verify addresses with transactions are skipped, across more than one gap of derived addresses.
+        """
+        public_key = BIP32Node.from_master_secret(b'address gap test seed', netcode='BTC').hwif(as_private=False)
+        btc_wallet = Wallet.objects.create(label='default', currencycode='BTC', public_key=public_key)
+
+        # Nothing is used yet, so the first address is the first one derived.
+        new_address, index = address.utils.get_new_address(user_wallet=btc_wallet)
+        self.assertEqual(index, 0)
+        expected_key = BIP32Node.from_hwif(public_key).subkey(i=0).subkey(i=0)
+        self.assertEqual(new_address['p2pkh'], expected_key.bitcoin_address())
+
+        # Use the first 26 addresses, more than one gap.
+        for used_address in address.utils.derive_addresses(btc_wallet, is_change=False, index=0, count=26):
+            used = Address.objects.create(wallet=btc_wallet, label='used', p2pkh=used_address['p2pkh'],
+                                          p2sh_p2wpkh=used_address['p2sh_p2wpkh'], bech32=used_address['bech32'],
+                                          index=used_address['index'])
+            Transaction.objects.create(address=used, txid='%064x' % used_address['index'], value_in=1000)
+
+        new_address, index = address.utils.get_new_address(user_wallet=btc_wallet)
+        self.assertEqual(index, 26)
+        self.assertEqual(new_address['index'], 26)
+        expected_key = BIP32Node.from_hwif(public_key).subkey(i=0).subkey(i=26)
+        self.assertEqual(new_address['p2pkh'], expected_key.bitcoin_address())
+
+        # All the used addresses are returned when asked for.
+        all_addresses, index = address.utils.get_new_address(user_wallet=btc_wallet, get_all_addresses=True)
+        self.assertEqual(len(all_addresses), 26)
+        self.assertEqual(index, 26)
+
+        # The change chain has no used addresses.
+        change_address, index = address.utils.get_new_address(user_wallet=btc_wallet, is_change=True)
+        self.assertEqual(index, 0)
+        expected_key = BIP32Node.from_hwif(public_key).subkey(i=1).subkey(i=0)
+        self.assertEqual(change_address['p2pkh'], expected_key.bitcoin_address())
+
+        # Another wallet's addresses aren't served from this wallet's cached keys.
+        other_public_key = BIP32Node.from_master_secret(b'another gap test seed', netcode='BTC').hwif(as_private=False)
+        other_wallet = Wallet.objects.create(label='default', currencycode='BTC', public_key=other_public_key)
+        other_address, index = address.utils.get_new_address(user_wallet=other_wallet)
+        self.assertEqual(index, 0)
+        self.assertNotEqual(other_address['p2pkh'], change_address['p2pkh'])
+        self.assertNotEqual(other_address['p2pkh'], new_address['p2pkh'])
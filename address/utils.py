@@ -1,3 +1,4 @@
+import functools
 import json
 from pprint import pprint
 
@@ -15,23 +16,24 @@ import spauser.utils
 from blockchain.models import Transaction
 
 
-def address_is_used(address_to_check, user_wallet):
-    try:
-        transactions = Transaction.objects.filter(address__wallet=user_wallet)
-        # Return True if any of the passed in addresses are being used
-        for address_type in address_to_check:
-            if address_type == 'p2pkh':
-                is_used = transactions.filter(address__p2pkh=address_to_check[address_type])[:1]
-            elif address_type == 'p2sh_pwwpkh':
-                is_used = transactions.filter(address__p2wpkh=address_to_check[address_type])[:1]
-            elif address_type == 'p2sh_pwwpkh':
-                is_used = transactions.filter(address__bech32=address_to_check[address_type])[:1]
-            if is_used.id:
-                return True
-        return False
-    except Exception as e:
-        #print ("error: %s" % str(e))
-        return False
+# The number of addresses derived at a time when searching for an unused address, the BIP44 gap limit.
+ADDRESS_GAP = 20
+
+# Returns the set of all addresses in the wallet that have transactions, in a single query.
+def get_used_addresses(user_wallet):
+    used_addresses = set()
+    for p2pkh, p2sh_p2wpkh, bech32 in Transaction.objects.filter(address__wallet=user_wallet) \
+            .values_list('address__p2pkh', 'address__p2sh_p2wpkh', 'address__bech32').distinct():
+        used_addresses.update([p2pkh, p2sh_p2wpkh, bech32])
+    used_addresses.discard(None)
+    return used_addresses
+
+def address_is_used(address_to_check, used_addresses):
+    # Return True if any of the passed in addresses are being used
+    for address_type in ['p2pkh', 'p2sh_p2wpkh', 'bech32']:
+        if address_to_check.get(address_type) in used_addresses:
+            return True
+    return False
 
 def is_address_in_wallet(address_to_check, user_wallet):
     # Check if this address exists in any form in the user's wallet
@@ -69,76 +71,79 @@ def get_new_exchange_address(self, currencycode):
         print("ERROR: invalid currencycode({}) in get_new_exchange_address".format(currencycode))
         return None
 
+# Addresses are derived from the wallet's public key, along the external (0) or change (1) chain. Parsing the key and
+# deriving the chain are cached, as is each address derived, so finding a new address only derives keys it hasn't
+# derived before.
+@functools.lru_cache(maxsize=1024)
+def get_chain_key(public_key, is_change):
+    wallet_public_key = BIP32Node.from_hwif(public_key)
+    if not is_change:
+        return wallet_public_key.subkey(i=0, is_hardened=False, as_private=False)
+    return wallet_public_key.subkey(i=1, is_hardened=False, as_private=False)
+
+@functools.lru_cache(maxsize=10000)
+def derive_address(public_key, currencycode, is_change, index):
+    # Create addresses following BIP44
+    # https://github.com/bitcoin/bips/blob/master/bip-0044.mediawiki
+    address_key = get_chain_key(public_key, is_change).subkey(i=index, is_hardened=False, as_private=False)
+    new_address = {
+        'index': index,
+        'p2pkh': address_key.bitcoin_address()
+    }
+    # Generate bech32 for Bitcoin and Bitcoin Testnet
+    # @TODO get working with LTC https://github.com/richardkiss/pycoin/issues/323
+    if currencycode in ['BTC', 'XTN']:
+        try:
+            script = ScriptPayToAddressWit(b'\0', address_key.hash160(use_uncompressed=False)).script()
+            new_address['p2sh_p2wpkh'] = address_for_pay_to_script(script, netcode=currencycode)
+            new_address['bech32'] = address_for_pay_to_script_wit(script, netcode=currencycode)
+        except Exception as e:
+            #print(e)
+            new_address['p2sh_p2wpkh'] = None
+            new_address['bech32'] = None
+    else:
+        new_address['p2sh_p2wpkh'] = None
+        new_address['bech32'] = None
+    return new_address
+
+# Derive count addresses from the wallet's external or change chain, starting at index.
+def derive_addresses(user_wallet, is_change, index, count):
+    return [dict(derive_address(user_wallet.public_key, user_wallet.currencycode, bool(is_change), child_index))
+            for child_index in range(index, index + count)]
+
 def get_new_address(user_wallet, is_change=False, get_all_addresses=False):
     # Be sure this is a valid currency supported by the exchange
-    if user_wallet.currencycode in settings.COINS.keys():
-        all_addresses = []
-        last_active_address = 0
-
-        # Use the wallet's public_key to generate addresses.
-        wallet_public_key = BIP32Node.from_hwif(user_wallet.public_key)
-
-        # External address
-        if not is_change:
-            wallet_base = wallet_public_key.subkey(i=0, is_hardened=False, as_private=False)
-            index = user_wallet.last_external_index
-        # Change address
-        else:
-            wallet_base = wallet_public_key.subkey(i=1, is_hardened=False, as_private=False)
-            index = user_wallet.last_change_index
-
-        if get_all_addresses:
-            index = 0
-
-        # If index is non-zero, then increment by one to generate a new unused
-        # index.
-        if index > 0:
-            index += 1
+    if user_wallet.currencycode not in settings.COINS.keys():
+        return False, False
 
-        # Look for an unused address.
-        # @TODO: https://github.com/ .. /issues/6 search through a gap of 20
-        searching = True
-        while searching:
-            # Create addresses following BIP44
-            # https://github.com/bitcoin/bips/blob/master/bip-0044.mediawiki
-            address_key = wallet_base.subkey(i=index, is_hardened=False, as_private=False)
-            new_address = {
-                'index': index,
-                'p2pkh': address_key.bitcoin_address()
-            }
-            # Generate bech32 for Bitcoin and Bitcoin Testnet
-            # @TODO get working with LTC https://github.com/richardkiss/pycoin/issues/323
-            if user_wallet.currencycode in ['BTC', 'XTN']:
-                try:
-                    script = ScriptPayToAddressWit(b'\0', address_key.hash160(use_uncompressed=False)).script()
-                    new_address['p2sh_p2wpkh'] = address_for_pay_to_script(script, netcode=user_wallet.currencycode)
-                    new_address['bech32'] = address_for_pay_to_script_wit(script, netcode=user_wallet.currencycode)
-                except Exception as e:
-                    #print(e)
-                    new_address['p2sh_p2wpkh'] = None
-                    new_address['bech32'] = None
-            else:
-                new_address['p2sh_p2wpkh'] = None
-                new_address['bech32'] = None
-            #print("coin: %s, p2pkh: %s, p2sh_p2wpkh: %s, bech32: %s" % (user_wallet.currencycode, p2pkh, p2sh_p2wpkh, bech32))
-
-            if address_is_used(new_address, user_wallet):
-                index += 1
-                if get_all_addresses:
-                    all_addresses.append(new_address)
-            else:
-                last_active_address += 1
-                if get_all_addresses and last_active_address > 20:
-                    searching = False
-                else:
-                    searching = False
-                #print("%s address: %s" % (user_wallet.currencycode, p2pkh))
-        if get_all_addresses:
-            return all_addresses, index
-        else:
-            return new_address, index
+    all_addresses = []
+    # External address
+    if not is_change:
+        index = user_wallet.last_external_index
+    # Change address
     else:
-        return False, False
+        index = user_wallet.last_change_index
+
+    if get_all_addresses:
+        index = 0
+
+    # If index is non-zero, then increment by one to generate a new unused
+    # index.
+    if index > 0:
+        index += 1
+
+    # Look for an unused address, deriving a gap of addresses at a time.
+    used_addresses = get_used_addresses(user_wallet)
+    while True:
+        for new_address in derive_addresses(user_wallet, is_change=is_change, index=index, count=ADDRESS_GAP):
+            if not address_is_used(new_address, used_addresses):
+                #print("%s address: %s" % (user_wallet.currencycode, new_address['p2pkh']))
+                if get_all_addresses:
+                    return all_addresses, index
+                return new_address, index
+            index += 1
+            if get_all_addresses:
+                all_addresses.append(new_address)
 
 def create_address(self, token=None, data={}):
     url = reverse('address:address-create')
@@ -107,6 +107,38 @@ DATABASES = {
 }
 
 
+# Audit
+# Audit records are written to the log by a background thread in each process.
+
+AUDIT = {
+    # Maximum number of records waiting to be written before audit() blocks.
+    'buffer': 10000,
+    # Maximum number of records written per batch.
+    'batch': 500,
+    # Seconds to wait for queued records to be written on exit.
+    'flush_timeout': 10,
+}
+
+
+# Notifications
+# Notifications for the middleware are published to RabbitMQ by a background thread in each process.
+
+NOTIFICATIONS = {
+    'host': 'rabbit',
+    'queue': 'pushNotifications',
+    # Topic exchange for notifications published per topic, such as each cryptopair's orderbook deltas.
+    'exchange': 'notifications',
+    # Topic of a cryptopair's orderbook deltas.
+    'orderbook_topic': 'orderbook.%s',
+    # Maximum number of notifications waiting to be published, further notifications are dropped (and audited).
+    'outbox': 10000,
+    # Maximum number of notifications published per batch.
+    'batch': 100,
+    # Seconds to wait for the outbox to be published on exit.
+    'flush_timeout': 10,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
 
@@ -212,6 +244,33 @@ ADDRESSAPI = {
     'protocol': 'http',
     'domain': 'addressapi',
     'port': 8001,
+    # Seconds to wait to connect, and to wait for a response.
+    'timeout': (3.05, 10),
+    # Maximum number of concurrent requests (and pooled connections) per process.
+    'concurrency': 10,
+    # Set to True if the address API supports querying the unspent outputs of many addresses in one request.
+    'bulk': False,
+    'bulk_size': 100,
+}
+
+# Orders are matched by one matcher process per cryptopair (see `python manage.py matcher`), consuming an intake
+# queue on RabbitMQ. If not enabled, orders are matched inline by the web worker that accepted them.
+MATCHER = {
+    'enabled': False,
+    'host': 'rabbit',
+    'queue': 'matcher.%s',
+    # Seconds a web worker waits for the matcher to reply.
+    'timeout': 10,
+    'prefetch': 100,
+    # Seconds between removing expired orders from the orderbooks.
+    'prune_interval': 60,
+    # Minimum seconds between saving snapshots of an orderbook, changes in between are saved together.
+    'snapshot_interval': 0.5,
+}
+
+BLOCKCHAIN_CACHE = {
+    # Seconds unspent outputs are cached for, in case a block event is lost.
+    'ttl': 900,
 }
 
 COINS = {
@@ -295,3 +354,46 @@ CRYPTOPAIRS = {
         'listed': False,
     },
 }
+
+# Settlement (see `python manage.py settle`) is split into as many transactions as needed to keep each within these
+# limits. Signed transactions are only sent to the blockchain if broadcast is True.
+SETTLE = {
+    # Virtual bytes, below the 100,000 standardness limit.
+    'max_vsize': 90000,
+    'max_inputs': 500,
+    'max_outputs': 1000,
+    'broadcast': False,
+}
+
+# How wallet.coinselection chooses the unspent outputs spent by sends and settlement. 'minimize_fee' searches for
+# outputs that need no change (spending up to change_tolerance satoshi more than needed), falling back to
+# 'knapsack' or 'largest_first'. 'consolidate' spends the smallest outputs first.
+COIN_SELECTION = {
+    'strategy': 'minimize_fee',
+    'change_tolerance': 1000,
+    'max_tries': 100000,
+    'fallback': 'knapsack',
+}
+
+# Fee rates are served from memory by wallet.fees, refreshed by a background thread in each process.
+FEE_ORACLE = {
+    'background': True,
+    # Seconds between refreshes.
+    'interval': 60,
+    # Seconds before a fee rate is stale, and is fetched live instead.
+    'max_age': 300,
+    # The number_of_blocks and estimate_mode combinations refreshed in the background.
+    'targets': [2, 4, 6, 18, 144],
+    'estimate_modes': ['CONSERVATIVE', 'ECONOMICAL'],
+}
+
+# Requests to the coin daemons (see wallet.rpc) share a pooled keep-alive session per daemon.
+RPC = {
+    # Seconds to wait to connect, and to wait for a response.
+    'timeout': (3.05, 30),
+    # Times to retry a request if the daemon can't be reached, or its work queue is full.
+    'retries': 3,
+    # Seconds to wait before the first retry, doubling for each retry after.
+    'backoff': 0.5,
+    'pool_size': 10,
+}
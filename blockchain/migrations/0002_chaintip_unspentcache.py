@@ -0,0 +1,42 @@
+# Generated by Django 2.2 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blockchain', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChainTip',
+            fields=[
+                ('coin', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('height', models.BigIntegerField(default=0)),
+                ('hash', models.CharField(blank=True, max_length=128)),
+                ('modified', models.DateTimeField(auto_now=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UnspentCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('coin', models.CharField(max_length=64)),
+                ('address', models.CharField(max_length=128)),
+                ('height', models.BigIntegerField(default=0)),
+                ('changed', models.BigIntegerField(default=0)),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('response', models.TextField(blank=True, null=True)),
+                ('cached', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('coin', 'address')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='unspentcache',
+            index=models.Index(fields=['coin', 'height'], name='blockchain__coin_4b4cc8_idx'),
+        ),
+    ]
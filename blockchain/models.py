@@ -26,3 +26,36 @@ class Transaction(models.Model):
     # Metadata
     created = models.DateTimeField(auto_now_add=True, null=True, blank=True, editable=False)
     modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+class ChainTip(models.Model):
+    '''
+    The latest block of each blockchain, as reported to the block webhook.
+    '''
+    coin = models.CharField(max_length=64, primary_key=True)
+    height = models.BigIntegerField(default=0)
+    hash = models.CharField(max_length=128, blank=True)
+    modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+class UnspentCache(models.Model):
+    '''
+    Cache the unspent outputs of an address, as returned by the address API.
+
+    An entry is cleared when a block event lists its address, or when a block at or below the height it was cached at
+    is orphaned. If a block event is lost, entries still expire after BLOCKCHAIN_CACHE['ttl'] seconds.
+    '''
+    coin = models.CharField(max_length=64)
+    address = models.CharField(max_length=128)
+    # Chain tip when the unspent outputs were requested.
+    height = models.BigIntegerField(default=0)
+    # Height of the last block event that listed this address.
+    changed = models.BigIntegerField(default=0)
+    # The address API response, null if this entry was cleared.
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.TextField(null=True, blank=True)
+    cached = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('coin', 'address'),)
+        indexes = [
+            models.Index(fields=['coin', 'height']),
+        ]
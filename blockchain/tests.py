@@ -1,3 +1,60 @@
 from django.test import TestCase
 
-# Create your tests here.
+import blockchain.utils
+from blockchain.models import ChainTip, UnspentCache
+
+
+class UnspentCacheTest(TestCase):
+    def cached_addresses(self, coin):
+        return set(UnspentCache.objects.filter(coin=coin, response__isnull=False).values_list('address', flat=True))
+
+    def test_block_events(self):
+        """
+        Verify block events clear the unspent outputs cached for the addresses they list, and orphan blocks clear
+        everything cached at or above their height.
+        """
+        coin = 'bitcoin_testnet3'
+        unspent = {'data': {'balance': 0, 'unspent': {}}}
+        blockchain.utils.block_event(coin=coin, event='new block', height=100, block_hash='a', addresses=[''])
+        self.assertEqual(blockchain.utils.get_chain_tip(coin=coin), 100)
+        blockchain.utils.cache_unspent(coin=coin, height=100, fetched={
+            'address1': (200, unspent),
+            'address2': (200, unspent),
+            'address3': (None, "request failed"),
+        })
+        self.assertEqual(self.cached_addresses(coin), {'address1', 'address2'})
+
+        # A new block lists address1.
+        blockchain.utils.block_event(coin=coin, event='new block', height=101, block_hash='b',
+                                     addresses=['address1', 'address4'])
+        self.assertEqual(self.cached_addresses(coin), {'address2'})
+
+        # A response requested before block 101 isn't cached for the addresses it listed.
+        blockchain.utils.cache_unspent(coin=coin, height=100, fetched={
+            'address1': (200, unspent),
+            'address4': (404, {}),
+        })
+        self.assertEqual(self.cached_addresses(coin), {'address2'})
+        blockchain.utils.cache_unspent(coin=coin, height=101, fetched={
+            'address1': (200, unspent),
+        })
+        self.assertEqual(self.cached_addresses(coin), {'address1', 'address2'})
+
+        # Orphaning block 101 clears what was cached at height 101.
+        blockchain.utils.block_event(coin=coin, event='orphan block', height=101, block_hash='b', addresses=[])
+        self.assertEqual(self.cached_addresses(coin), {'address2'})
+        self.assertEqual(ChainTip.objects.get(coin=coin).height, 100)
+
+        # Sending a transaction clears the addresses it spent from, and responses requested before it aren't cached
+        # until the next block.
+        blockchain.utils.clear_unspent(coin=coin, addresses=['address2'])
+        self.assertEqual(self.cached_addresses(coin), set())
+        blockchain.utils.cache_unspent(coin=coin, height=100, fetched={
+            'address2': (200, unspent),
+        })
+        self.assertEqual(self.cached_addresses(coin), set())
+        blockchain.utils.block_event(coin=coin, event='new block', height=101, block_hash='c', addresses=[])
+        blockchain.utils.cache_unspent(coin=coin, height=101, fetched={
+            'address2': (200, unspent),
+        })
+        self.assertEqual(self.cached_addresses(coin), {'address2'})
@@ -1,21 +1,170 @@
+import concurrent.futures
+import datetime
+import functools
 import json
 from pprint import pprint
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.forms.models import model_to_dict
 from rest_framework import status
 import requests
+import requests.adapters
 
 from address.models import Address
 import address.utils
-from blockchain.models import Transaction
+from blockchain.models import ChainTip, Transaction, UnspentCache
 import reporting.utils
 import wallet.rpc
 
 
-# This currently queries addressapi every time. We could consider a caching layer as new blocks only
-# happen every ~10 minutes, and we get notified when there are changes (though a notification can get
-# lost)
+# All requests to the address API share a pooled keep-alive session.
+addressapi_session = requests.Session()
+addressapi_session.mount('%s://' % settings.ADDRESSAPI['protocol'], requests.adapters.HTTPAdapter(
+    pool_connections=settings.ADDRESSAPI['concurrency'],
+    pool_maxsize=settings.ADDRESSAPI['concurrency'],
+))
+
+def get_addressapi_url(path):
+    return '%s://%s:%d/api/%s' % (settings.ADDRESSAPI['protocol'],
+                                  settings.ADDRESSAPI['domain'],
+                                  settings.ADDRESSAPI['port'],
+                                  path)
+
+# Query the unspent outputs of a single address, returns (status_code, addressapi) or (None, error).
+def fetch_unspent(coin, address_to_check):
+    url = get_addressapi_url('address/%s/%s/unspent' % (coin, address_to_check))
+    try:
+        response = addressapi_session.get(url, timeout=settings.ADDRESSAPI['timeout'])
+        return response.status_code, json.loads(response.content)
+    except Exception as e:
+        return None, "request to %s failed: %s" % (url, e)
+
+# Query the unspent outputs of many addresses with a single request per ADDRESSAPI['bulk_size'] addresses:
+#   POST /api/address/<coin>/unspent {"addresses": [...]}
+# returns {"data": {"<address>": <same as GET /api/address/<coin>/<address>/unspent>, ...}}, addresses not on the
+# blockchain are left out.
+def fetch_unspent_bulk(coin, addresses):
+    url = get_addressapi_url('address/%s/unspent' % coin)
+    results = {}
+    for start in range(0, len(addresses), settings.ADDRESSAPI['bulk_size']):
+        chunk = addresses[start:start + settings.ADDRESSAPI['bulk_size']]
+        try:
+            response = addressapi_session.post(url, json={'addresses': chunk}, timeout=settings.ADDRESSAPI['timeout'])
+            response.raise_for_status()
+            found = json.loads(response.content)['data']
+            for address_to_check in chunk:
+                if address_to_check in found:
+                    results[address_to_check] = (status.HTTP_200_OK, found[address_to_check])
+                else:
+                    results[address_to_check] = (status.HTTP_404_NOT_FOUND, {})
+        except Exception as e:
+            for address_to_check in chunk:
+                results[address_to_check] = (None, "request to %s failed: %s" % (url, e))
+    return results
+
+# Query the unspent outputs of many addresses from the address API, returns {address: (status_code, addressapi)}, or
+# (None, error) for addresses that couldn't be queried. Unless the address API supports bulk requests, addresses are
+# queried concurrently, at most ADDRESSAPI['concurrency'] at a time.
+def fetch_unspent_many(coin, addresses):
+    if not addresses:
+        return {}
+    if settings.ADDRESSAPI['bulk']:
+        return fetch_unspent_bulk(coin=coin, addresses=addresses)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(settings.ADDRESSAPI['concurrency'],
+                                                               len(addresses))) as executor:
+        results = executor.map(functools.partial(fetch_unspent, coin), addresses)
+        return dict(zip(addresses, results))
+
+def get_chain_tip(coin):
+    try:
+        return ChainTip.objects.get(coin=coin).height
+    except ChainTip.DoesNotExist:
+        return 0
+
+# Get the unspent outputs of many addresses, see fetch_unspent_many(). Reads through the unspent cache, which is
+# cleared by block events (see block_event()).
+def get_unspent(coin, addresses):
+    addresses = list(addresses)
+    if not addresses:
+        return {}
+
+    results = {}
+    expires = timezone.now() - datetime.timedelta(seconds=settings.BLOCKCHAIN_CACHE['ttl'])
+    for address_to_check, status_code, response in UnspentCache.objects.filter(
+            coin=coin, address__in=addresses, response__isnull=False, cached__gt=expires) \
+            .values_list('address', 'status_code', 'response'):
+        results[address_to_check] = (status_code, json.loads(response))
+
+    missing = [address_to_check for address_to_check in addresses if address_to_check not in results]
+    if missing:
+        # Get the chain tip before querying, a block event after this will clear what we cache.
+        height = get_chain_tip(coin=coin)
+        fetched = fetch_unspent_many(coin=coin, addresses=missing)
+        results.update(fetched)
+        cache_unspent(coin=coin, height=height, fetched=fetched)
+    return results
+
+def cache_unspent(coin, height, fetched):
+    now = timezone.now()
+    entries = [UnspentCache(coin=coin, address=address_to_check, height=height, changed=height,
+                            status_code=status_code, response=json.dumps(response), cached=now)
+               for address_to_check, (status_code, response) in fetched.items() if status_code is not None]
+    if not entries:
+        return
+    with transaction.atomic():
+        # Replace old entries, unless a block event listed the address after we queried it: we don't know if our
+        # response includes that block, so the address is left uncached.
+        UnspentCache.objects.filter(coin=coin, address__in=[entry.address for entry in entries],
+                                    changed__lte=height).delete()
+        UnspentCache.objects.bulk_create(entries, ignore_conflicts=True)
+
+# Clear the unspent cache for a block event: 'new block' clears the addresses it lists, 'orphan block' also clears
+# everything cached at or above the orphaned height.
+def block_event(coin, event, height, block_hash, addresses):
+    height = int(height)
+    addresses = [address_to_check for address_to_check in addresses if address_to_check]
+    with transaction.atomic():
+        if event == 'orphan block':
+            tip_height = height - 1
+        else:
+            tip_height = height
+        ChainTip.objects.update_or_create(coin=coin, defaults={'height': tip_height, 'hash': block_hash})
+
+        if addresses:
+            # Record the change even for addresses that aren't cached, in case they're being queried right now.
+            UnspentCache.objects.bulk_create([UnspentCache(coin=coin, address=address_to_check, height=height,
+                                                           changed=height)
+                                              for address_to_check in addresses], ignore_conflicts=True)
+            UnspentCache.objects.filter(coin=coin, address__in=addresses) \
+                .update(status_code=None, response=None, cached=None, changed=Greatest(F('changed'), height))
+        if event == 'orphan block':
+            UnspentCache.objects.filter(coin=coin, height__gte=height).update(status_code=None, response=None,
+                                                                             cached=None)
+
+# Clear the unspent cache of addresses whose outputs we just spent in a transaction we sent. Queries already under way
+# may have read the outputs before they were spent: they can't cache them until the next block is seen.
+def clear_unspent(coin, addresses):
+    addresses = [address_to_check for address_to_check in addresses if address_to_check]
+    if not addresses:
+        return
+    changed = get_chain_tip(coin=coin) + 1
+    UnspentCache.objects.filter(coin=coin, address__in=addresses) \
+        .update(status_code=None, response=None, cached=None, changed=Greatest(F('changed'), changed))
+
+# Returns all the addresses of a wallet: p2pkh, p2sh-p2wpkh and bech32 for each address.
+def get_wallet_addresses(user_wallet, order_by='created'):
+    addresses = []
+    for address_in_wallet in Address.objects.filter(wallet=user_wallet.id).order_by(order_by):
+        for an_address in [address_in_wallet.p2pkh, address_in_wallet.p2sh_p2wpkh, address_in_wallet.bech32]:
+            if an_address:
+                addresses.append(an_address)
+    return addresses
+
 # Parameters:
 #  - identifiers: used in the audit trail
 #  - user_wallet: the wallet to return the balance for
@@ -27,63 +176,56 @@ def get_balance(identifiers, user_wallet, confirmations=6):
 
     blockchain_height = None
 
-    for address_in_wallet in Address.objects.filter(wallet=user_wallet.id):
-        for address in [address_in_wallet.p2pkh, address_in_wallet.p2sh_p2wpkh, address_in_wallet.bech32]:
-            if address:
-                url = '%s://%s:%d/api/address/%s/%s/unspent' % (settings.ADDRESSAPI['protocol'],
-                                                                settings.ADDRESSAPI['domain'],
-                                                                settings.ADDRESSAPI['port'],
-                                                                settings.COINS[user_wallet.currencycode]['name'],
-                                                                address)
-                reporting.utils.audit(message="blockchain: querying", details={
+    addresses = get_wallet_addresses(user_wallet=user_wallet)
+    reporting.utils.audit(message="blockchain: querying", details={
+        'identifiers': identifiers,
+        'addresses': addresses,
+    })
+    unspent = get_unspent(coin=settings.COINS[user_wallet.currencycode]['name'], addresses=addresses)
+    for address_to_check in addresses:
+        status_code, addressapi = unspent[address_to_check]
+        try:
+            if status_code is None:
+                raise Exception(addressapi)
+            reporting.utils.audit(message="blockchain: queried", details={
+                'identifiers': identifiers,
+                'addressapi': addressapi,
+            })
+            if status_code != status.HTTP_404_NOT_FOUND:
+                if not blockchain_height:
+                    blockchain_height = get_height(currencycode=user_wallet.currencycode)
+                assert(blockchain_height > 0)
+                # Loop through unspent, and split out those that are pending from those that have sufficient
+                # confirmations to consider permanent.
+                for txid in addressapi['data']['unspent']:
+                    tx_height = int(addressapi['data']['unspent'][txid]['height'])
+                    for key in addressapi['data']['unspent'][txid]:
+                        if key != 'height':
+                            #print("txid(%s) needed height: %d, height: %d" % (txid, (blockchain_height - confirmations), tx_height))
+                            if (blockchain_height - confirmations) > tx_height:
+                                balance += addressapi['data']['unspent'][txid][key]
+                            else:
+                                pending_balance += addressapi['data']['unspent'][txid][key]
+                                pending_details[txid] = addressapi['data']['unspent'][txid]
+                reporting.utils.audit(message="blockchain: add unspent balance", details={
                     'identifiers': identifiers,
-                    'url': url,
+                    'unspent_balance': addressapi['data']['balance'],
+                    'balance': balance,
                 })
-                try:
-                    response = requests.get(url)
-                    addressapi = json.loads(response.content)
-                    reporting.utils.audit(message="blockchain: queried", details={
-                        'identifiers': identifiers,
-                        'addressapi': addressapi,
-                    })
-                    if response.status_code != status.HTTP_404_NOT_FOUND:
-                        if not blockchain_height:
-                            blockchain_height = get_height(currencycode=user_wallet.currencycode)
-                        assert(blockchain_height > 0)
-                        # Loop through unspent, and split out those that are pending from those that have sufficient
-                        # confirmations to consider permanent.
-                        for txid in addressapi['data']['unspent']:
-                            tx_height = int(addressapi['data']['unspent'][txid]['height'])
-                            for key in addressapi['data']['unspent'][txid]:
-                                if key != 'height':
-                                    #print("txid(%s) needed height: %d, height: %d" % (txid, (blockchain_height - confirmations), tx_height))
-                                    if (blockchain_height - confirmations) > tx_height:
-                                        balance += addressapi['data']['unspent'][txid][key]
-                                    else:
-                                        pending_balance += addressapi['data']['unspent'][txid][key]
-                                        pending_details[txid] = addressapi['data']['unspent'][txid]
-                        reporting.utils.audit(message="blockchain: add unspent balance", details={
-                            'identifiers': identifiers,
-                            'unspent_balance': addressapi['data']['balance'],
-                            'balance': balance,
-                        })
-                except Exception as e:
-                    reporting.utils.audit(message="blockchain: error", details={
-                        'identifiers': identifiers,
-                        'error': str(e),
-                    })
-                    print("error while getting blockchain balance, request to %s failed" % url)
+        except Exception as e:
+            reporting.utils.audit(message="blockchain: error", details={
+                'identifiers': identifiers,
+                'address': address_to_check,
+                'error': str(e),
+            })
+            print("error while getting blockchain balance of %s: %s" % (address_to_check, e))
 
     return balance, pending_balance, pending_details
 
 def is_address_on_blockchain(currencycode, address_to_check, confirmations=6):
-    url = '%s://%s:%d/api/address/%s/%s' % (settings.ADDRESSAPI['protocol'],
-                                            settings.ADDRESSAPI['domain'],
-                                            settings.ADDRESSAPI['port'],
-                                            settings.COINS[currencycode]['name'],
-                                            address_to_check)
+    url = get_addressapi_url('address/%s/%s' % (settings.COINS[currencycode]['name'], address_to_check))
     try:
-        response = requests.get(url)
+        response = addressapi_session.get(url, timeout=settings.ADDRESSAPI['timeout'])
         addressapi = json.loads(response.content)
         if response.status_code == status.HTTP_404_NOT_FOUND:
             return False
@@ -107,13 +249,10 @@ def update_cache(wallet_address, user_wallet, cache_height):
         # @TODO: optimize the backend API to accept cache_height, and only return new data
         # Possibly include cache_height + a hash of all txids, to validate the cache
         if address_hash:
-            url = '%s://%s:%d/api/address/%s/%s' % (settings.ADDRESSAPI['protocol'],
-                                                         settings.ADDRESSAPI['domain'],
-                                                         settings.ADDRESSAPI['port'],
-                                                         settings.COINS[user_wallet.currencycode]['name'],
-                                                         address_hash)
+            url = get_addressapi_url('address/%s/%s' % (settings.COINS[user_wallet.currencycode]['name'],
+                                                        address_hash))
             try:
-                response = requests.get(url)
+                response = addressapi_session.get(url, timeout=settings.ADDRESSAPI['timeout'])
                 if response.status_code != status.HTTP_404_NOT_FOUND:
                     addressapi = json.loads(response.content)
                     unspent = addressapi['data']['balance']
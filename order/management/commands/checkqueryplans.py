@@ -0,0 +1,148 @@
+import datetime
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+import trade.ticker
+from order.models import Order
+from trade.models import Candle, OrderbookSnapshot
+from wallet.models import Wallet
+
+
+class RollbackSeed(Exception):
+    pass
+
+# The queries run on the hot paths: the matchers loading their orderbook and expiring orders, the ticker and OHLCV
+# reading candles, and the public orderbook reading its snapshot. Sum(), Min() and Max() of the ticker are planned as a
+# scan of the same candles, as they are here.
+def get_hot_queries(cryptopair, now):
+    ticker_candles = trade.ticker.get_ticker_candles(cryptopair, now)
+    return [
+        ('orderbook snapshot', OrderbookSnapshot.objects.filter(cryptopair=cryptopair)),
+        ('ticker candles', ticker_candles),
+        ('ticker open', ticker_candles.order_by('start').values_list('open', flat=True)[:1]),
+        ('ohlcv since', Candle.objects.filter(cryptopair=cryptopair, interval='1h',
+                                              start__gte=now - datetime.timedelta(days=7)).order_by('start')[:500]),
+        ('ohlcv latest', Candle.objects.filter(cryptopair=cryptopair, interval='1h').order_by('-start')[:500]),
+        ('resident orderbook', Order.objects.filter(cryptopair=cryptopair, open=True).order_by('created')),
+        ('expired orders', Order.objects.filter(open=True, timeinforce__lte=now)),
+    ]
+
+# The tables growing with the history of the exchange, which the hot queries must never scan sequentially. There's one
+# orderbook snapshot per cryptopair, so scanning them is expected.
+GROWING_TABLES = ['order_order', 'trade_candle']
+
+# Returns the tables scanned sequentially anywhere in an EXPLAIN (FORMAT JSON) plan.
+def get_seq_scans(plan):
+    seq_scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        seq_scans.append(plan.get('Relation Name'))
+    for subplan in plan.get('Plans', []):
+        seq_scans.extend(get_seq_scans(subplan))
+    return seq_scans
+
+
+class Command(BaseCommand):
+    help = 'Verify the orderbook, ticker and OHLCV queries are planned with indexes, failing if any scans the order ' \
+           'or candle table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--closed', type=int, default=200000,
+                            help='number of closed orders to seed (default: 200000)')
+        parser.add_argument('--open', type=int, default=2000,
+                            help='number of open orders to seed (default: 2000)')
+        parser.add_argument('--candles', type=int, default=20000,
+                            help='number of candles of each interval to seed per cryptopair (default: 20000)')
+        parser.add_argument('--no-seed', action='store_true',
+                            help='explain the queries against the existing orders and candles, without seeding')
+
+    def seed(self, closed_count, open_count, candle_count, now):
+        seed_wallet = Wallet.objects.create(label='checkqueryplans', currencycode='XTN')
+        cryptopairs = list(settings.CRYPTOPAIRS.keys())
+        batch = []
+        for index in range(closed_count + open_count):
+            is_open = index >= closed_count
+            cryptopair = random.choice(cryptopairs)
+            batch.append(Order(
+                wallet=seed_wallet,
+                label='checkqueryplans',
+                cryptopair=cryptopair,
+                base_currency=settings.CRYPTOPAIRS[cryptopair]['base'],
+                quote_currency=settings.CRYPTOPAIRS[cryptopair]['quote'],
+                side=random.choice([True, False]),
+                limit_price=random.randint(1, 100) * 100000000,
+                volume=100000,
+                original_volume=100000,
+                open=is_open,
+                timeinforce=now + datetime.timedelta(hours=random.randint(-24, 24)) if random.random() < 0.1 else None,
+            ))
+            if len(batch) == 10000:
+                Order.objects.bulk_create(batch)
+                batch = []
+        Order.objects.bulk_create(batch)
+
+        # Consecutive candles of every interval, ending now.
+        batch = []
+        for cryptopair in cryptopairs:
+            for interval, seconds in trade.ticker.CANDLE_INTERVALS.items():
+                latest = trade.ticker.get_candle_start(now, seconds)
+                for index in range(candle_count):
+                    price = random.randint(1, 100) * 100000000
+                    batch.append(Candle(
+                        cryptopair=cryptopair,
+                        interval=interval,
+                        start=latest - datetime.timedelta(seconds=seconds * index),
+                        open=price,
+                        high=price,
+                        low=price,
+                        close=price,
+                        volume=100000,
+                        base_volume=100000,
+                        trades=1,
+                    ))
+                    if len(batch) == 10000:
+                        Candle.objects.bulk_create(batch, ignore_conflicts=True)
+                        batch = []
+        Candle.objects.bulk_create(batch, ignore_conflicts=True)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE order_order')
+            cursor.execute('ANALYZE trade_candle')
+
+    def explain(self, now):
+        regressions = []
+        for cryptopair in settings.CRYPTOPAIRS:
+            for name, queryset in get_hot_queries(cryptopair, now):
+                # QuerySet.explain() returns the plan as text, run EXPLAIN to get the plan decoded by psycopg2.
+                sql, params = queryset.query.sql_with_params()
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                    plan = cursor.fetchone()[0][0]['Plan']
+                seq_scans = get_seq_scans(plan)
+                self.stdout.write("%s %s: %s" % (cryptopair, name, plan['Node Type']))
+                for table in GROWING_TABLES:
+                    if table in seq_scans:
+                        regressions.append("%s %s (%s)" % (cryptopair, name, table))
+        return regressions
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['no_seed']:
+            regressions = self.explain(now)
+        else:
+            # Seed and explain in a transaction that's always rolled back.
+            try:
+                with transaction.atomic():
+                    self.seed(options['closed'], options['open'], options['candles'], now)
+                    regressions = self.explain(now)
+                    raise RollbackSeed()
+            except RollbackSeed:
+                pass
+
+        if regressions:
+            raise CommandError('Sequential scan of a growing table in: %s' % ', '.join(regressions))
+        self.stdout.write(self.style.SUCCESS('Successfully verified %d query plans' %
+                                             (len(settings.CRYPTOPAIRS) * len(get_hot_queries(None, now)))))
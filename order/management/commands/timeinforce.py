@@ -4,17 +4,31 @@ from django.core.management.base import BaseCommand, CommandError
 from order.models import Order
 from django.utils import timezone
 
+import reporting.utils
+import trade.matcher
+
 
 class Command(BaseCommand):
     help = 'Expire orders whose timeinforce has passed'
 
     def handle(self, *args, **options):
         expire_count = 0
+        failed_count = 0
         # Find open orders with expired timeinforce
         for order in Order.objects.filter(open=True, timeinforce__lte=timezone.now()):
-            order.open = False
-            order.canceled = True
-            order.save()
-            expire_count += 1
+            identifiers = {
+                'trace_id': reporting.utils.generate_trace_id(),
+                'wallet': order.wallet_id,
+                'command': 'timeinforce',
+            }
+            # Expire the order through the matcher, as it's the only writer to the orderbook.
+            expired_order, valid = trade.matcher.cancel_order(identifiers=identifiers, user_order=order)
+            if valid is True and expired_order.canceled is True:
+                expire_count += 1
+            elif valid is not True:
+                # The cancel is still queued, or the matcher couldn't be reached (the next run tries again).
+                failed_count += 1
 
         self.stdout.write(self.style.SUCCESS('Successfully expired %d orders' % expire_count))
+        if failed_count:
+            self.stdout.write(self.style.WARNING('Could not confirm %d orders expired' % failed_count))
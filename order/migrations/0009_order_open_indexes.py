@@ -0,0 +1,25 @@
+# Generated by Django 2.2 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0008_auto_20190204_2206'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(open=True), fields=['cryptopair', 'side', 'limit_price', 'created'], name='order_open_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(open=True), fields=['cryptopair', 'created'], name='order_open_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(open=True, timeinforce__isnull=False), fields=['timeinforce'], name='order_open_timeinforce_idx'),
+        ),
+    ]
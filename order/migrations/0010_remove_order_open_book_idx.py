@@ -0,0 +1,17 @@
+# Generated by Django 2.2 on 2026-10-18 14:25
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0009_order_open_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='order',
+            name='order_open_book_idx',
+        ),
+    ]
@@ -38,3 +38,16 @@ class Order(models.Model):
     # Metadata
     created = models.DateTimeField(auto_now_add=True, null=True, blank=True, editable=False)
     modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        # The orderbook only ever reads open orders, which are a small fraction of all orders. Partial indexes keep
+        # these queries independent of the closed order history. The best prices are read from the orderbook snapshot
+        # (see trade.orderbook), not from the orders.
+        indexes = [
+            # Loading the resident orderbook (see trade.orderbook).
+            models.Index(fields=['cryptopair', 'created'], condition=models.Q(open=True),
+                         name='order_open_created_idx'),
+            # Expiring orders (see the timeinforce command).
+            models.Index(fields=['timeinforce'], condition=models.Q(open=True, timeinforce__isnull=False),
+                         name='order_open_timeinforce_idx'),
+        ]
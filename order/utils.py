@@ -174,6 +174,10 @@ def get_fee(order, volume):
     # @TODO: calculate fee based on user history etc
     return int(volume * .005)
 
+# The fee get_fee() charges, calculated in SQL from the named volume column.
+def get_fee_sql(volume_column):
+    return "TRUNC(%s * 0.005)" % volume_column
+
 def get_side(request):
     # Determine which side of the trade this is, or generate error.
     try:
@@ -3,6 +3,7 @@ import uuid
 import datetime
 
 from django.conf import settings
+from django.db import transaction
 from django.forms.models import model_to_dict
 from rest_framework import views, permissions, status, generics
 from rest_framework.response import Response
@@ -11,9 +12,11 @@ import order.utils
 from .serializers import OrderSerializer
 from .models import Order
 import blockchain.utils
+import wallet.ledger
 import wallet.utils
 from wallet.models import Wallet
 import trade.utils
+import trade.matcher
 from trade.models import Trade
 from otp import permissions as totp_permissions
 import reporting.utils
@@ -154,14 +157,15 @@ class OrderCreateView(views.APIView):
             'funds': funds,
         })
 
+        # The wallet's ledger tracks its open orders and unsettled trades.
+        ledger = wallet.ledger.get_ledger(user_wallet)
+
         # 2b) Subtract any unsettled open orders or trades out of this wallet
-        out_trades_balance = wallet.utils.get_unsettled_open_orders_or_filled_trades_out(identifiers=identifiers,
-                                                                                        wallet=user_wallet)
+        out_trades_balance = ledger.reserved + ledger.pending_out
         funds['balance_of_trades_out'] = out_trades_balance
 
         # 2c) Credit any unsettled trades into this wallet
-        in_trades_balance = wallet.utils.get_unsettled_trades_in(identifiers=identifiers, wallet=user_wallet,
-                                                                user_id=self.request.user.id)
+        in_trades_balance = ledger.pending_in
         funds['balance_of_trades_in'] = in_trades_balance
 
         available_balance = blockchain_balance - out_trades_balance + in_trades_balance
@@ -279,7 +283,9 @@ class OrderCreateView(views.APIView):
             filled=False,
         )
         # .save() has no return value, so we run it after creating a new order
-        new_order.save()
+        with transaction.atomic():
+            new_order.save()
+            wallet.ledger.order_opened(new_order)
         new_order_dict = model_to_dict(new_order)
         new_order_dict['id'] = new_order.id
         # We store side as a boolean, but display as a string
@@ -295,7 +301,10 @@ class OrderCreateView(views.APIView):
         })
 
         # Step 6: find matching orders, if anyway, and process fulfillment immediately
-        trades = trade.utils.match_order(identifiers=identifiers, order_to_match=new_order)
+        trades, valid = trade.matcher.submit_order(identifiers=identifiers, new_order=new_order)
+        if valid is not True:
+            # If valid is not True, trades is a JSON-formatted error: abort!
+            return Response(trades, status=valid)
         if len(trades):
             # The order was at least partially filled: reload from the database
             new_order = Order.objects.get(id=new_order.id)
@@ -386,13 +395,23 @@ class OrderCancelView(views.APIView):
             }
             return Response(data, status=status_code)
 
-        # Cancel the order.
-        user_order.open = False
-        user_order.canceled = True
-        user_order.save()
+        identifiers = {
+            'trace_id': reporting.utils.generate_trace_id(),
+            'user': request.user.id,
+            'wallet': user_wallet.id,
+            'wallet_symbol': user_wallet.currencycode,
+        }
+
+        # Cancel the order, this is done by the matcher as it's the only writer to the orderbook.
+        user_order, valid = trade.matcher.cancel_order(identifiers=identifiers, user_order=user_order)
+        if valid is not True:
+            # If valid is not True, user_order is a JSON-formatted error: abort!
+            return Response(user_order, status=valid)
 
-        # Determine if order was already partially filled.
-        if user_order.filled > 0:
+        # Determine if order was filled before it could be canceled, or already partially filled.
+        if user_order.canceled is not True:
+            status_text = "order fully filled, unable to cancel"
+        elif user_order.filled > 0:
             status_text = "order partially filled, unfilled portion canceled"
         else:
             status_text = "order canceled"
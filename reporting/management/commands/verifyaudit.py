@@ -0,0 +1,72 @@
+import gzip
+
+from django.core.management.base import BaseCommand, CommandError
+
+import reporting.utils
+
+
+class Command(BaseCommand):
+    help = 'Verify the hash chains of an audit log'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Audit log to verify, optionally gzip compressed')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if path.endswith('.gz'):
+            log = gzip.open(path, 'rt', errors='replace')
+        else:
+            log = open(path, errors='replace')
+
+        # The last record seen in each chain.
+        chains = {}
+        continued = 0
+        errors = 0
+        records = 0
+        first_sequence = None
+        last_sequence = None
+        with log:
+            for line_number, line in enumerate(log, 1):
+                record = reporting.utils.parse_audit_record(line)
+                if record is None:
+                    continue
+                records += 1
+                sequence = record['sequence']
+                if first_sequence is None or sequence < first_sequence:
+                    first_sequence = sequence
+                if last_sequence is None or sequence > last_sequence:
+                    last_sequence = sequence
+
+                previous = chains.get(record['chain'])
+                if previous is None:
+                    if record['previous_hash'] != reporting.utils.GENESIS_HASH:
+                        # This chain started in an earlier log, its first link can't be verified here.
+                        continued += 1
+                else:
+                    if record['previous_hash'] != previous['hash']:
+                        errors += 1
+                        self.stderr.write("line %d: chain %s broken at sequence %d" %
+                                          (line_number, record['chain'], sequence))
+                    if sequence <= previous['sequence']:
+                        errors += 1
+                        self.stderr.write("line %d: chain %s sequence %d follows %d" %
+                                          (line_number, record['chain'], sequence, previous['sequence']))
+
+                chains[record['chain']] = {
+                    'hash': reporting.utils.hash_audit_record(record['record']),
+                    'sequence': sequence,
+                }
+
+        if records:
+            # Postgres sequences aren't gapless: numbers are skipped when a transaction rolls back or a process exits
+            # with numbers allocated but not yet used. Gaps are only informational, a lost record breaks its chain.
+            gaps = last_sequence - first_sequence + 1 - records
+        else:
+            gaps = 0
+        self.stdout.write("verified %d records in %d chains (%d continued from an earlier log), sequence %s to %s, "
+                          "%d unused sequence numbers" % (records, len(chains), continued, first_sequence,
+                                                         last_sequence, gaps))
+
+        if errors:
+            raise CommandError("%d errors found in audit log" % errors)
+        self.stdout.write(self.style.SUCCESS('Audit log verified'))
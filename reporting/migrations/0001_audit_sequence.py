@@ -0,0 +1,18 @@
+# Generated by Django 2.2 on 2026-10-18 09:12
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE SEQUENCE reporting_audit_sequence',
+            reverse_sql='DROP SEQUENCE reporting_audit_sequence',
+        ),
+    ]
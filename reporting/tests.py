@@ -1,9 +1,15 @@
 import json
+import time
+import tempfile
+from io import StringIO
 from pprint import pprint
 from django.core.cache import cache
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
+from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
 
 from reporting.views import ReportingOrderbookView, ReportingTradesView, ReportingTickerView
 import reporting.utils
@@ -258,6 +264,32 @@ class TradeTest(APITestCase):
         self.assertEqual(content['data']['base']['volume'], buy4_base_volume)
         base_volume = buy4_base_volume + int(buy_volume / buy_limit_price * 100000000)
         self.assertEqual(content['data']['base']['24h_volume'], base_volume)
+        # The 24 hour open is the price of the first trade, and the change is relative to it.
+        self.assertEqual(content['data']['quote']['24h_open'], buy_limit_price)
+        self.assertEqual(content['data']['quote']['24h_change'], buy4_limit_price - buy_limit_price)
+        self.assertEqual(content['data']['quote']['24h_percentage'],
+                         (buy4_limit_price - buy_limit_price) / buy_limit_price * 100)
+        self.assertEqual(content['data']['quote']['24h_vwap'],
+                         int((buy_volume + buy4_volume) * 100000000 / base_volume))
+
+        # /api/public/<cryptopair>/ohlcv/
+        # The trades are added up in a candle for each interval with trades, they may span two days.
+        response = reporting.utils.view_ohlcv(self, cryptopair=cryptopair, data={'interval': '1d'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        content = json.loads(response.content)
+        self.assertEqual(sum(candle['trades'] for candle in content['data']), 2)
+        self.assertEqual(sum(candle['volume'] for candle in content['data']), buy_volume + buy4_volume)
+        self.assertEqual(sum(candle['base_volume'] for candle in content['data']), base_volume)
+        self.assertEqual(content['data'][0]['open'], buy_limit_price)
+        self.assertEqual(content['data'][-1]['close'], buy4_limit_price)
+        # No candles start after the last trade.
+        response = reporting.utils.view_ohlcv(self, cryptopair=cryptopair, data={'since': int(time.time()) + 86400})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['data'], [])
+        response = reporting.utils.view_ohlcv(self, cryptopair=cryptopair, data={'interval': '2m'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = reporting.utils.view_ohlcv(self, cryptopair=cryptopair, data={'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
         # Create another sell order for XTN, buying XLT.
         cryptopair = 'XTN-XLT'
@@ -754,6 +786,24 @@ class TradeTest(APITestCase):
                              [sell2_limit_price, sell2_volume],
                          ])
 
+        # Level 1 only shows the best price on each side.
+        response = reporting.utils.view_orderbook(self, cryptopair="XTN-XLT", data={'level': 1})
+        content = json.loads(response.content)
+        self.assertEqual(content['data']['bids'], [[buy2_limit_price, buy2_volume]])
+        self.assertEqual(content['data']['asks'], [[sell3_limit_price, sell3_volume]])
+        self.assertEqual(content['data']['market'], {'bids': 0, 'asks': 0})
+
+        # Depth limits the number of rows on each side.
+        response = reporting.utils.view_orderbook(self, cryptopair="XTN-XLT", data={'level': 2, 'depth': 2})
+        content = json.loads(response.content)
+        self.assertEqual(content['data']['bids'], [[buy2_limit_price, buy2_volume], [buy_limit_price, buy_volume]])
+        self.assertEqual(content['data']['asks'], [[sell3_limit_price, sell3_volume], [sell_limit_price, sell_volume]])
+
+        response = reporting.utils.view_orderbook(self, cryptopair="XTN-XLT", data={'level': 4})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = reporting.utils.view_orderbook(self, cryptopair="XTN-XLT", data={'depth': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
         # @TODO, is there anyway to cause this error?
         # - Invalid `cryptopair`: `500 Internal Server Error`: status: "`regex failed on cryptopair`"
 
@@ -1103,3 +1153,62 @@ class TradeTest(APITestCase):
         # There are no results, so no pager
         self.assertEqual(content['pager']['next'], None)
         self.assertEqual(content['pager']['previous'], None)
+
+
+class AuditTest(TestCase):
+    def test_audit_chain(self):
+        """
+        Verify audit records written by the background writer are sequenced and chained, in the order they were
+        audited, and that the verifyaudit command validates the chain.
+        """
+        with self.assertLogs(level='INFO') as logs:
+            for counter in range(5):
+                reporting.utils.audit(message="test audit chain", details={'counter': counter})
+            self.assertTrue(reporting.utils.flush_audit())
+
+        records = [reporting.utils.parse_audit_record(line) for line in logs.output if '|test audit chain|' in line]
+        self.assertEqual(len(records), 5)
+        previous = None
+        for counter, record in enumerate(records):
+            self.assertEqual(record['message'], "test audit chain")
+            self.assertEqual(json.loads(record['details']), {'counter': counter})
+            if previous is not None:
+                self.assertEqual(record['chain'], previous['chain'])
+                self.assertGreater(record['sequence'], previous['sequence'])
+                self.assertEqual(record['previous_hash'], reporting.utils.hash_audit_record(previous['record']))
+            previous = record
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.log') as log:
+            log.write("0|START|exchange started\n")
+            for record in records:
+                log.write("%s\n" % record['record'])
+            log.flush()
+            out = StringIO()
+            call_command('verifyaudit', log.name, stdout=out)
+            self.assertIn('verified 5 records in 1 chains (1 continued from an earlier log)', out.getvalue())
+
+            # Tampering with a record breaks the chain.
+            log.write("%s\n" % records[2]['record'])
+            log.flush()
+            with self.assertRaises(CommandError):
+                call_command('verifyaudit', log.name, stdout=StringIO(), stderr=StringIO())
+
+        # Gaps in the sequence alone are not errors: the last record links to the one before it.
+        last = records[-1]
+        renumbered = "%d%s" % (last['sequence'] + 10, last['record'][len(str(last['sequence'])):])
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.log') as log:
+            for record in records[:-1]:
+                log.write("%s\n" % record['record'])
+            log.write("%s\n" % renumbered)
+            log.flush()
+            out = StringIO()
+            call_command('verifyaudit', log.name, stdout=out)
+            self.assertIn('Audit log verified', out.getvalue())
+
+        # A lost record breaks the chain, even though its sequence number is only a gap.
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.log') as log:
+            for record in records[:2] + records[3:]:
+                log.write("%s\n" % record['record'])
+            log.flush()
+            with self.assertRaises(CommandError):
+                call_command('verifyaudit', log.name, stdout=StringIO(), stderr=StringIO())
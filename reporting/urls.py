@@ -14,4 +14,5 @@ urlpatterns = [
     path('public/<cryptopair:pair>/orderbook/', views.ReportingOrderbookView.as_view(), name="public-orderbook"),
     path('public/<cryptopair:pair>/trades/', views.ReportingTradesView.as_view(), name="public-trades"),
     path('public/<cryptopair:pair>/ticker/', views.ReportingTickerView.as_view(), name="public-ticker"),
+    path('public/<cryptopair:pair>/ohlcv/', views.ReportingOhlcvView.as_view(), name="public-ohlcv"),
 ]
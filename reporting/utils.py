@@ -1,22 +1,33 @@
+import atexit
 import logging
 import json
 import hashlib
+import os
+import queue
+import re
+import socket
+import threading
+import time
 import uuid
 from order.models import Order
+from django.conf import settings
+from django.db import connection
 from django.forms.models import model_to_dict
+from rest_framework import status
 import datetime
 
 import pika
 
 import spauser.utils
+import trade.ticker
 
 
-# Initialize our audit log structure in a global scope
-log_message_cache = {
-    'counter': 0,
-    'message': '',
-    'details': '',
-}
+# Audit records are written as: sequence|chain|message|details|sha256=<hash of the previous record in the chain>
+#  - sequence is allocated from a Postgres sequence shared by all processes, so it's unique and increasing
+#  - chain identifies the process that wrote the record, each process hash-chains its own records
+# A new chain starts with the hash of GENESIS_HASH, see the verifyaudit management command.
+GENESIS_HASH = '0' * 64
+AUDIT_RECORD = re.compile(r'(\d+)\|([0-9a-f]{32})\|([^|]*)\|(.*)\|sha256=([0-9a-f]{64})$')
 
 class AuditEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -32,34 +43,259 @@ class AuditEncoder(json.JSONEncoder):
 def generate_trace_id():
     return uuid.uuid4()
 
-# We assume all keys in our log_dictionary are strings, as otherwise order can change each time we hash.
-def hash_log_message(log_dictionary):
-    h = hashlib.sha256(json.dumps(log_dictionary, sort_keys=True, ensure_ascii=True).encode())
-    return h.hexdigest()
+def hash_audit_record(record):
+    return hashlib.sha256(record.encode()).hexdigest()
+
+# Find an audit record in a line of the log, returns None if there isn't one.
+def parse_audit_record(line):
+    match = AUDIT_RECORD.search(line.rstrip('\n'))
+    if match is None:
+        return None
+    return {
+        'record': match.group(0),
+        'sequence': int(match.group(1)),
+        'chain': match.group(2),
+        'message': match.group(3),
+        'details': match.group(4),
+        'previous_hash': match.group(5),
+    }
+
+# Allocate sequence numbers for a batch of audit records in a single query.
+def allocate_audit_sequence(count):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval('reporting_audit_sequence') FROM generate_series(1, %s)", [count])
+        return sorted(row[0] for row in cursor.fetchall())
+
+class AuditWriter:
+    '''
+    Sequences, hashes, chains and writes audit records from a background thread, so the request path only has to
+    serialize the record and queue it. The queue is bounded: if the writer falls behind, audit() blocks until there's
+    room rather than dropping records.
+    '''
+    def __init__(self):
+        self.pid = None
+        self.queue = None
+        self.chain = None
+        self.previous_hash = None
+        self.lock = threading.Lock()
+
+    # The writer is started on first use in each process, as threads don't survive gunicorn forking workers. Each
+    # process writes its own chain.
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=settings.AUDIT['buffer'])
+            self.chain = uuid.uuid4().hex
+            self.previous_hash = GENESIS_HASH
+            self.queue.put(("audit chain started", json.dumps({
+                'hostname': socket.gethostname(),
+                'pid': os.getpid(),
+            })))
+            writer = threading.Thread(target=self.run, name='audit-writer')
+            writer.daemon = True
+            writer.start()
+            self.pid = os.getpid()
+
+    def put(self, message, details):
+        if self.pid != os.getpid():
+            self.start()
+        self.queue.put((message, details))
+
+    def allocate(self, count):
+        delay = 0.1
+        while True:
+            try:
+                return allocate_audit_sequence(count)
+            except Exception as e:
+                # Keep the records queued until the database is back, audit records are never written unsequenced.
+                print("Failed to allocate audit sequence, retrying in %0.1fs: %s" % (delay, e))
+                connection.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    def run(self):
+        while True:
+            # Wait for a record, then write everything else that's queued in the same batch.
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < settings.AUDIT['batch']:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            sequences = self.allocate(len(batch))
+            if self.queue.empty():
+                # Don't hold a database connection open while idle.
+                connection.close()
+
+            for sequence, (message, details) in zip(sequences, batch):
+                record = "%d|%s|%s|%s|sha256=%s" % (sequence, self.chain, message, details, self.previous_hash)
+                self.previous_hash = hash_audit_record(record)
+                try:
+                    # @TODO: sign audit logs, send to remote server(s)
+                    logging.info("%s\n" % record)
+                except Exception as e:
+                    print("Failed to write audit record: %s" % e)
+                self.queue.task_done()
+
+    # Wait for all queued records to be written.
+    def flush(self, timeout=None):
+        if self.pid != os.getpid():
+            return True
+        if timeout is None:
+            timeout = settings.AUDIT['flush_timeout']
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+audit_writer = AuditWriter()
 
 def audit(message, details):
-    hash_of_previous_log = hash_log_message(log_dictionary=log_message_cache)
+    # Serialize now: details often include objects (such as orders) that keep changing after this call.
+    audit_writer.put(message, json.dumps(details, cls=AuditEncoder))
 
-    # Update globally scoped audit log structure
-    log_message_cache['counter'] += 1
-    log_message_cache['message'] = message
+def flush_audit(timeout=None):
+    return audit_writer.flush(timeout=timeout)
 
-    # Format key=value
-    log_message_cache['details'] = "%s|sha256=%s" % (json.dumps(details, cls=AuditEncoder), hash_of_previous_log)
+# Don't lose queued audit records when a management command or worker exits.
+atexit.register(flush_audit)
 
-    # @TODO: sign audit logs, send to remote server(s)
-    logging.info("%d|%s|%s\n" % (log_message_cache['counter'], log_message_cache['message'], log_message_cache['details']))
+class NotificationPublisher:
+    '''
+    Publishes middleware notifications from a background thread over a long-lived RabbitMQ connection. Each batch is
+    published in a transaction, so the broker accepts the whole batch in one round trip. The request path only adds
+    notifications to the outbox. If the connection is lost, we reconnect with backoff and republish the batch that
+    wasn't committed.
 
-def notify_middleware(message):
-    try:
-        queue = 'pushNotifications'
-        mqconnection = pika.BlockingConnection(pika.ConnectionParameters('rabbit'))
-        channel = mqconnection.channel()
-        channel.queue_declare(queue=queue)
-        channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(message))
-        mqconnection.close()
-    except Exception as e:
-        print("Failed to send notification to middleware: %s" % e)
+    Transactions are used rather than publisher confirms: pika 0.12's BlockingChannel waits for the broker to confirm
+    each message before basic_publish() returns, so confirming a batch would take a round trip per notification.
+
+    Notifications without a topic go to the NOTIFICATIONS['queue'] queue. Notifications with a topic are published to
+    the NOTIFICATIONS['exchange'] topic exchange, with the topic as routing key, for the middleware to bind to.
+    '''
+    def __init__(self):
+        self.pid = None
+        self.outbox = None
+        self.mqconnection = None
+        self.channel = None
+        # The number of notifications dropped because the outbox was full.
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    # The publisher is started on first use in each process, as threads don't survive gunicorn forking workers.
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.outbox = queue.Queue(maxsize=settings.NOTIFICATIONS['outbox'])
+            publisher = threading.Thread(target=self.run, name='notification-publisher')
+            publisher.daemon = True
+            publisher.start()
+            self.pid = os.getpid()
+
+    def put(self, message, topic=None):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.outbox.put_nowait((topic, message))
+        except queue.Full:
+            # Never block an order on the middleware, notifications are best effort.
+            self.dropped += 1
+            audit(message="dropped notification to middleware: outbox full", details={
+                'topic': topic,
+                'notification': message,
+                'dropped': self.dropped,
+            })
+
+    def connect(self):
+        self.mqconnection = pika.BlockingConnection(pika.ConnectionParameters(settings.NOTIFICATIONS['host']))
+        self.channel = self.mqconnection.channel()
+        self.channel.queue_declare(queue=settings.NOTIFICATIONS['queue'])
+        self.channel.exchange_declare(exchange=settings.NOTIFICATIONS['exchange'], exchange_type='topic')
+        self.channel.tx_select()
+
+    def disconnect(self):
+        try:
+            if self.mqconnection is not None:
+                self.mqconnection.close()
+        except Exception:
+            pass
+        self.mqconnection = None
+        self.channel = None
+
+    def publish(self, batch):
+        delay = 0.1
+        while batch:
+            try:
+                if self.mqconnection is None:
+                    self.connect()
+                for topic, message in batch:
+                    if topic is None:
+                        exchange, routing_key = '', settings.NOTIFICATIONS['queue']
+                    else:
+                        exchange, routing_key = settings.NOTIFICATIONS['exchange'], topic
+                    self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=json.dumps(message))
+                # Once committed, the broker has all of the batch.
+                self.channel.tx_commit()
+                for published in batch:
+                    self.outbox.task_done()
+                batch = []
+            except Exception as e:
+                audit(message="failed to send notifications to middleware, retrying", details={
+                    'notifications': len(batch),
+                    'delay': delay,
+                    'error': str(e),
+                })
+                self.disconnect()
+                time.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.outbox.get(timeout=1)]
+            except queue.Empty:
+                # Keep the idle connection alive.
+                try:
+                    if self.mqconnection is not None:
+                        self.mqconnection.process_data_events()
+                except Exception:
+                    self.disconnect()
+                continue
+
+            try:
+                while len(batch) < settings.NOTIFICATIONS['batch']:
+                    batch.append(self.outbox.get_nowait())
+            except queue.Empty:
+                pass
+            self.publish(batch)
+
+    # Wait for all notifications in the outbox to be published.
+    def flush(self, timeout=None):
+        if self.pid != os.getpid():
+            return True
+        if timeout is None:
+            timeout = settings.NOTIFICATIONS['flush_timeout']
+        deadline = time.time() + timeout
+        while self.outbox.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+notification_publisher = NotificationPublisher()
+
+def notify_middleware(message, topic=None):
+    notification_publisher.put(message, topic=topic)
+
+def flush_notifications(timeout=None):
+    return notification_publisher.flush(timeout=timeout)
+
+atexit.register(flush_notifications)
 
 def get_since_parameter(request):
     # Optional filter for trade history
@@ -83,6 +319,84 @@ def get_since_parameter(request):
 
     return value, True
 
+def get_level_parameter(request):
+    # Optional orderbook level of detail: 1 (best prices), 2 (aggregated by price) or 3 (each order)
+    value = request.GET.get('level', '3')
+    if value not in ['1', '2', '3']:
+        status_code = status.HTTP_400_BAD_REQUEST
+        data = {
+            "status": "level must be one of: 1, 2, 3",
+            "code": status_code,
+            "debug": {
+                "invalid value": value,
+            },
+            "data": {},
+        }
+        return data, status_code
+
+    return int(value), True
+
+def get_depth_parameter(request):
+    # Optional limit on the number of orderbook rows per side
+    try:
+        value = request.GET.get('depth')
+        if value is not None:
+            value = int(value)
+    except Exception as e:
+        value = -1
+
+    if value is not None and value < 1:
+        status_code = status.HTTP_400_BAD_REQUEST
+        data = {
+            "status": "depth must be a positive integer",
+            "code": status_code,
+            "debug": {
+                "invalid value": request.GET.get('depth'),
+            },
+            "data": {},
+        }
+        return data, status_code
+
+    return value, True
+
+def get_interval_parameter(request):
+    # Optional candle interval, defaults to one minute
+    value = request.GET.get('interval', '1m')
+    if value not in trade.ticker.CANDLE_INTERVALS:
+        status_code = status.HTTP_400_BAD_REQUEST
+        data = {
+            "status": "interval must be one of: %s" % ', '.join(trade.ticker.CANDLE_INTERVALS),
+            "code": status_code,
+            "debug": {
+                "invalid value": value,
+            },
+            "data": {},
+        }
+        return data, status_code
+
+    return value, True
+
+def get_limit_parameter(request, default=500, maximum=1000):
+    # Optional limit on the number of rows returned
+    try:
+        value = int(request.GET.get('limit', default))
+    except Exception as e:
+        value = -1
+
+    if value < 1 or value > maximum:
+        status_code = status.HTTP_400_BAD_REQUEST
+        data = {
+            "status": "limit must be an integer from 1 to %d" % maximum,
+            "code": status_code,
+            "debug": {
+                "invalid value": request.GET.get('limit'),
+            },
+            "data": {},
+        }
+        return data, status_code
+
+    return value, True
+
 # Helper to invoke /api/public/<cryptopair>/orderbook/ endpoint from a test.
 def view_orderbook(self, cryptopair, token=None, data={}):
     url = '/api/public/%s/orderbook/' % cryptopair
@@ -112,3 +426,8 @@ def view_trades(self, cryptopair, token=None, data={}, offset=None, since=None):
 def view_ticker(self, cryptopair, token=None, data={}):
     url = '/api/public/%s/ticker/' % cryptopair
     return spauser.utils.client_get_optional_jwt(self, url=url, token=token, data=data)
+
+# Helper to invoke /api/public/<cryptopair>/ohlcv/ endpoint from a test.
+def view_ohlcv(self, cryptopair, token=None, data={}):
+    url = '/api/public/%s/ohlcv/' % cryptopair
+    return spauser.utils.client_get_optional_jwt(self, url=url, token=token, data=data)
@@ -7,12 +7,12 @@ from django.conf import settings
 from rest_framework import views, permissions, status, generics
 from rest_framework.response import Response
 from django.db import connection
-import requests
-from django.db.models import Sum, Max, Min
 
 from address.models import Address
-from order.models import Order
 from trade.models import Trade
+import blockchain.utils
+import trade.orderbook
+import trade.ticker
 import reporting.utils
 from trade.serializers import ReportingTradeSerializer
 import app.pagination
@@ -80,8 +80,15 @@ class ReportingBlockView(views.APIView):
         except Exception as e:
             print("Failed to broadcast new block: %s" % e)
 
-        # Notify users if their wallets had activity
+        # Clear cached unspent outputs of the addresses in this block
         addresses = content['addresses'].split(',')
+        try:
+            blockchain.utils.block_event(coin=content['type'], event=content['event'], height=content['height'],
+                                         block_hash=content['hash'], addresses=addresses)
+        except Exception as e:
+            print("Failed to clear unspent cache for block: %s" % e)
+
+        # Notify users if their wallets had activity
         for address in addresses:
             with connection.cursor() as cursor:
                 cursor.execute(
@@ -100,30 +107,28 @@ class ReportingBlockView(views.APIView):
                         'error_count': 0,
                     }
 
+                    wallet_addresses = []
                     for address_in_wallet in Address.objects.filter(wallet=wallet_id).order_by('created'):
                         for an_address in [address_in_wallet.p2pkh, address_in_wallet.p2sh_p2wpkh,
                                            address_in_wallet.bech32]:
                             if an_address:
-                                wallet_detail['address_count'] += 1
-                                url = '%s://%s:%d/api/address/%s/%s/unspent' % (settings.ADDRESSAPI['protocol'],
-                                                                                settings.ADDRESSAPI['domain'],
-                                                                                settings.ADDRESSAPI['port'],
-                                                                                content['type'],
-                                                                                an_address)
-                                try:
-                                    response = requests.get(url)
-                                    addressapi = json.loads(response.content)
-                                    if response.status_code == status.HTTP_404_NOT_FOUND:
-                                        wallet_detail['404_count'] += 1
-                                    else:
-                                        wallet_detail['balance'] += addressapi['data']['balance']
-                                except Exception as e:
-                                    wallet_detail['error_count'] += 1
-                                    wallet_detail['error'].append({
-                                        'url': url,
-                                        'code': response.status_code,
-                                    })
-                                    print("request to %s failed" % url)
+                                wallet_addresses.append(an_address)
+                    wallet_detail['address_count'] = len(wallet_addresses)
+
+                    unspent = blockchain.utils.get_unspent(coin=content['type'], addresses=wallet_addresses)
+                    for an_address in wallet_addresses:
+                        status_code, addressapi = unspent[an_address]
+                        if status_code is None:
+                            wallet_detail['error_count'] += 1
+                            wallet_detail['error'].append({
+                                'address': an_address,
+                                'error': addressapi,
+                            })
+                            print(addressapi)
+                        elif status_code == status.HTTP_404_NOT_FOUND:
+                            wallet_detail['404_count'] += 1
+                        else:
+                            wallet_detail['balance'] += addressapi['data']['balance']
 
                     data = {
                         'recipient': str(spauser_id),
@@ -200,6 +205,10 @@ class ReportingMarketsView(views.APIView):
 class ReportingOrderbookView(views.APIView):
     """
     This endpoint is for viewing the orderbook for a given currency pair.
+
+    Optional parameters:
+     - level: 1 for only the best prices, 2 for orders aggregated by price, or 3 (the default) for each order
+     - depth: the maximum number of rows shown for each side
     """
     permission_classes = [permissions.AllowAny]
 
@@ -209,21 +218,28 @@ class ReportingOrderbookView(views.APIView):
             # If valid is not True, base_currency is a JSON-formatted error: abort!
             return Response(base_currency, status=valid)
 
-        bids = []
-        # Look for open buy orders:
-        for order in Order.objects.filter(base_currency=base_currency, quote_currency=quote_currency, side=True,
-                                          open=True, limit_price__gt=0).order_by("-limit_price"):
-            bids.append([
-                order.limit_price, order.volume
-            ])
-
-        asks = []
-        # Look for open sell orders:
-        for order in Order.objects.filter(base_currency=base_currency, quote_currency=quote_currency, side=False,
-                                          open=True, limit_price__gt=0).order_by("limit_price"):
-            asks.append([
-                order.limit_price, order.volume
-            ])
+        level, valid = reporting.utils.get_level_parameter(request)
+        if valid is not True:
+            # If valid is not True, level is a JSON-formatted error: abort!
+            return Response(level, status=valid)
+
+        depth, valid = reporting.utils.get_depth_parameter(request)
+        if valid is not True:
+            # If valid is not True, depth is a JSON-formatted error: abort!
+            return Response(depth, status=valid)
+
+        # The orderbook is served from the snapshot saved each time the book changes.
+        snapshot = trade.orderbook.get_snapshot(pair)
+        if level == 1:
+            # Only the best price on each side.
+            depth = 1
+            rows = snapshot['l2']
+        elif level == 2:
+            rows = snapshot['l2']
+        else:
+            rows = snapshot['l3']
+        bids = rows['bids'][:depth]
+        asks = rows['asks'][:depth]
 
         status_code = status.HTTP_200_OK
         data = {
@@ -233,10 +249,15 @@ class ReportingOrderbookView(views.APIView):
                 "cryptopair": pair,
                 "base_currency": base_currency,
                 "quote_currency": quote_currency,
+                "level": level,
+                "depth": depth,
             },
             "data": {
+                'sequence': snapshot['sequence'],
                 'bids': bids,
                 'asks': asks,
+                # Market orders have no price, only their total volume is shown
+                'market': snapshot['market'],
             },
         }
         return Response(data, status=status_code)
@@ -314,35 +335,25 @@ class ReportingTickerView(views.APIView):
         trades = Trade.objects.filter(cryptopair=pair).order_by('-id')[0:2]
         last_trade = None
         previous_trade = None
-        for counter, trade in enumerate(trades):
+        for counter, a_trade in enumerate(trades):
             if counter == 0:
-                last_trade = trade
+                last_trade = a_trade
             else:
                 assert(counter == 1)
-                previous_trade = trade
+                previous_trade = a_trade
 
         if last_trade:
             last_timestamp = last_trade.created.replace(tzinfo=datetime.timezone.utc).timestamp()
             last_quote_price = last_trade.price
             last_base_volume = int(last_trade.volume / last_trade.price * 100000000)
-            aggregate_volume = Trade.objects \
-                .filter(cryptopair=pair, created__lte=datetime.datetime.now() + datetime.timedelta(days=1))\
-                .aggregate(Sum('volume'), Sum('base_volume'))
-            quote_24h_volume = aggregate_volume['volume__sum']
-            base_24h_volume = aggregate_volume['base_volume__sum']
-            aggregate_price = Trade.objects \
-                .filter(cryptopair=pair, created__lte=datetime.datetime.now() + datetime.timedelta(days=1)) \
-                .aggregate(Min('price'), Max('price'))
-            high = aggregate_price['price__max']
-            low = aggregate_price['price__min']
             last_quote_volume = last_trade.volume
-
-            ask_order = Order.objects.filter(side=False, cryptopair=pair, open=True,
-                                             created__lte=datetime.datetime.now() + datetime.timedelta(days=1))\
-                .aggregate(Min('limit_price'))
-            bid_order = Order.objects.filter(side=True, cryptopair=pair, open=True,
-                                             created__lte=datetime.datetime.now() + datetime.timedelta(days=1))\
-                .aggregate(Max('limit_price'))
+            ticker = trade.ticker.get_ticker(cryptopair=pair)
+            quote_24h_volume = ticker['volume']
+            base_24h_volume = ticker['base_volume']
+            high = ticker['high']
+            low = ticker['low']
+            vwap = ticker['vwap']
+            open_price = ticker['open']
         else:
             last_timestamp = None
             last_base_volume = None
@@ -352,24 +363,30 @@ class ReportingTickerView(views.APIView):
             low = None
             last_quote_volume = None
             quote_24h_volume = None
+            vwap = None
+            open_price = None
 
         if previous_trade:
             difference = last_trade.price - previous_trade.price
         else:
             difference = None
 
-        try:
-            ask = ask_order['limit_price__min']
-        except:
-            ask = None
-        if ask == 0:
-            ask = None
+        if open_price:
+            change = last_quote_price - open_price
+            percentage = change / open_price * 100
+        else:
+            change = None
+            percentage = None
 
-        try:
-            bid = bid_order['limit_price__max']
-        except:
-            bid = None
-        if bid == 0:
+        # The best prices are kept up to date in the orderbook snapshot, as orders rest or leave the book.
+        snapshot = trade.orderbook.get_snapshot(pair)
+        if snapshot['l2']['asks']:
+            ask = snapshot['l2']['asks'][0][0]
+        else:
+            ask = None
+        if snapshot['l2']['bids']:
+            bid = snapshot['l2']['bids'][0][0]
+        else:
             bid = None
 
         status_code = status.HTTP_200_OK
@@ -393,8 +410,12 @@ class ReportingTickerView(views.APIView):
                     'symbol': quote_currency,
                     'price': last_quote_price,
                     'difference': difference,
+                    '24h_open': open_price,
                     '24h_high': high,
                     '24h_low': low,
+                    '24h_vwap': vwap,
+                    '24h_change': change,
+                    '24h_percentage': percentage,
                     'ask': ask,
                     'bid': bid,
                     'volume': last_quote_volume,
@@ -403,3 +424,68 @@ class ReportingTickerView(views.APIView):
             },
         }
         return Response(data, status=status_code)
+
+class ReportingOhlcvView(views.APIView):
+    """
+    This endpoint is for viewing the open, high, low and close prices and the volume traded for a given currency pair,
+    one candle per interval with trades.
+
+    Optional parameters:
+     - interval: the length of each candle, one of 1m (the default), 5m, 15m, 1h or 1d
+     - since: a unix timestamp, return the candles starting at or after it instead of the latest candles
+     - limit: the maximum number of candles returned, from 1 to 1000 (default 500)
+    """
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request, pair, format=None):
+        base_currency, quote_currency, valid = split_pair(cryptopair=pair)
+        if valid is not True:
+            # If valid is not True, base_currency is a JSON-formatted error: abort!
+            return Response(base_currency, status=valid)
+
+        interval, valid = reporting.utils.get_interval_parameter(request)
+        if valid is not True:
+            # If valid is not True, interval is a JSON-formatted error: abort!
+            return Response(interval, status=valid)
+
+        since, valid = reporting.utils.get_since_parameter(request)
+        if valid is not True:
+            # If valid is not True, since is a JSON-formatted error: abort!
+            return Response(since, status=valid)
+
+        limit, valid = reporting.utils.get_limit_parameter(request)
+        if valid is not True:
+            # If valid is not True, limit is a JSON-formatted error: abort!
+            return Response(limit, status=valid)
+
+        since_datetime = None
+        if since:
+            try:
+                since_datetime = datetime.datetime.fromtimestamp(since, datetime.timezone.utc)
+            except (OverflowError, OSError, ValueError):
+                status_code = status.HTTP_400_BAD_REQUEST
+                data = {
+                    "status": "since must be a valid unix timestamp",
+                    "code": status_code,
+                    "debug": {
+                        "invalid value": since,
+                    },
+                    "data": {},
+                }
+                return Response(data, status=status_code)
+
+        status_code = status.HTTP_200_OK
+        data = {
+            "status": "%s ohlcv" % pair,
+            "code": status_code,
+            "debug": {
+                "cryptopair": pair,
+                "base_currency": base_currency,
+                "quote_currency": quote_currency,
+                "interval": interval,
+                "since": since,
+                "limit": limit,
+            },
+            "data": trade.ticker.get_ohlcv(cryptopair=pair, interval=interval, since=since_datetime, limit=limit),
+        }
+        return Response(data, status=status_code)
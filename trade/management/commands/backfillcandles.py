@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+import reporting.utils
+import trade.ticker
+from trade.models import Candle, Trade
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the trade candles of all intervals from the existing trades, in a single pass over the trades'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cryptopair', help='only rebuild the candles of this cryptopair')
+        parser.add_argument('--chunk', type=int, default=10000,
+                            help='number of trades added to the candles at a time (default: 10000)')
+
+    def handle(self, *args, **options):
+        candles = Candle.objects.all()
+        trades = Trade.objects.filter(created__isnull=False)
+        if options['cryptopair']:
+            candles = candles.filter(cryptopair=options['cryptopair'])
+            trades = trades.filter(cryptopair=options['cryptopair'])
+
+        count = 0
+        with transaction.atomic():
+            # Trades being saved wait for the candles to be rebuilt. Trades saved before we have the lock are read
+            # below, as they were already committed.
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE trade_candle IN EXCLUSIVE MODE')
+            candles.delete()
+
+            chunk = []
+            for a_trade in trades.order_by('id').only('id', 'cryptopair', 'price', 'volume', 'base_volume', 'created') \
+                    .iterator(chunk_size=options['chunk']):
+                chunk.append(a_trade)
+                if len(chunk) == options['chunk']:
+                    trade.ticker.add_trades(chunk)
+                    count += len(chunk)
+                    chunk = []
+            trade.ticker.add_trades(chunk)
+            count += len(chunk)
+
+        reporting.utils.audit(message="backfilled candles", details={
+            'cryptopair': options['cryptopair'],
+            'trades': count,
+        })
+        self.stdout.write(self.style.SUCCESS('Successfully added %d trades to candles' % count))
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import trade.matcher
+
+
+class Command(BaseCommand):
+    help = 'Match orders from the intake queue, the only writer to the orderbook of each cryptopair'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pair', action='append', dest='pairs',
+                            help='Cryptopair to match, can be repeated (defaults to all cryptopairs)')
+
+    def handle(self, *args, **options):
+        if options['pairs']:
+            cryptopairs = options['pairs']
+        else:
+            cryptopairs = sorted(settings.CRYPTOPAIRS)
+
+        for cryptopair in cryptopairs:
+            if cryptopair not in settings.CRYPTOPAIRS:
+                raise CommandError("unknown cryptopair: %s" % cryptopair)
+
+        matcher = trade.matcher.Matcher(cryptopairs=cryptopairs, stdout=self.stdout)
+        matcher.run()
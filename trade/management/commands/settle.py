@@ -1,18 +1,21 @@
 import datetime
-from pprint import pprint
+import json
+import math
+import multiprocessing
+import uuid
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.core.management import call_command
-from django.db import models, connection
-from django.forms.models import model_to_dict
+from django.db import models, connection, connections, transaction
 from django.utils import timezone
 from pycoin.key.BIP32Node import BIP32Node
 
 import address.utils
+import blockchain.utils
 import order.utils
 import trade.models
 import reporting.utils
+import wallet.ledger
 import wallet.models
 import wallet.utils
 from address.models import Address
@@ -32,766 +35,831 @@ class TempTrades(models.Model):
     class Meta:
         app_label = "settle"
 
-class Command(BaseCommand):
-    help = 'Settle trades'
-
-    # Mark trade valid if not already marked with an error
-    def mark_as_valid(self, identifiers, unsettled_trade, order_side, order_direction):
-        if order_side == True:
-            order_side = 'buy'
-        elif order_side == False:
-            order_side = 'sell'
-
-        if order_side == 'buy':
-            if order_direction == 'in':
-                if unsettled_trade.buy_order_settled_in is trade.models.SETTLED_NONE:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_VALID" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.buy_order.id))
-                    unsettled_trade.buy_order_settled_in = trade.models.SETTLED_VALID
-                    unsettled_trade.save()
-            else:
-                assert(order_direction == 'out')
-                if unsettled_trade.buy_order_settled_out is trade.models.SETTLED_NONE:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_VALID" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.buy_order.id))
-                    unsettled_trade.buy_order_settled_out = trade.models.SETTLED_VALID
-                    unsettled_trade.save()
+# Each side and direction of a trade is settled separately, and staged as its own row in the staging table: side is
+# true for the buy order, and volume is positive for funds into a wallet, negative for funds out of a wallet.
+SETTLED_FIELDS = [
+    ('buy', 'in', 'buy_order_settled_in'),
+    ('buy', 'out', 'buy_order_settled_out'),
+    ('sell', 'in', 'sell_order_settled_in'),
+    ('sell', 'out', 'sell_order_settled_out'),
+]
+
+# The staged rows, with the trade (t) and the order (o) on the staged side of the trade.
+STAGED_TRADES_SQL = '''
+    {table} s
+    JOIN trade_trade t ON t.id = s.trade_id
+    JOIN order_order o ON o.id = CASE WHEN s.side THEN t.buy_order_id ELSE t.sell_order_id END
+'''
+
+# Stage the unsettled trades sending a coin out of a wallet, along with the funds they send into the wallet of the
+# other user in the same coin, minus our fee. wallet_owners and coin_wallets map an order's wallet to the wallet its
+# user holds in the coin. Only trades newer than the watermark are staged, plus any older trades that committed after
+# the watermark was recorded and so were never validated. Trades with any side marked as an error are never staged
+# again, they're left for review.
+STAGE_TRADES_SQL = '''
+    WITH wallet_owners AS (
+        SELECT DISTINCT ON (wallet_id) wallet_id, spauser_id
+        FROM wallet_wallet_user
+        ORDER BY wallet_id, spauser_id
+    ), coin_wallets AS (
+        SELECT DISTINCT ON (wu.spauser_id) wu.spauser_id, wu.wallet_id
+        FROM wallet_wallet_user wu
+        JOIN wallet_wallet w ON w.id = wu.wallet_id
+        WHERE w.currencycode = %%(coin)s
+        ORDER BY wu.spauser_id, w.created, w.id
+    ), trades_out AS (
+        SELECT t.id AS trade_id, FALSE AS side, s.wallet_id AS wallet_out, b.wallet_id AS order_wallet_in,
+            t.base_volume AS volume
+        FROM trade_trade t
+        JOIN order_order s ON s.id = t.sell_order_id
+        JOIN order_order b ON b.id = t.buy_order_id
+        WHERE s.base_currency = %%(coin)s
+            AND ((t.id > %%(watermark)s AND t.sell_order_settled_out IN (%%(none)s, %%(valid)s))
+                OR (t.id <= %%(watermark)s AND t.sell_order_settled_out = %%(none)s))
+            AND %%(error)s NOT IN (t.buy_order_settled_in, t.buy_order_settled_out, t.sell_order_settled_in,
+                t.sell_order_settled_out)
+        UNION ALL
+        SELECT t.id, TRUE, b.wallet_id, s.wallet_id, t.volume
+        FROM trade_trade t
+        JOIN order_order b ON b.id = t.buy_order_id
+        JOIN order_order s ON s.id = t.sell_order_id
+        WHERE b.quote_currency = %%(coin)s
+            AND ((t.id > %%(watermark)s AND t.buy_order_settled_out IN (%%(none)s, %%(valid)s))
+                OR (t.id <= %%(watermark)s AND t.buy_order_settled_out = %%(none)s))
+            AND %%(error)s NOT IN (t.buy_order_settled_in, t.buy_order_settled_out, t.sell_order_settled_in,
+                t.sell_order_settled_out)
+    )
+    INSERT INTO {table} (currency, volume, fee, wallet_id, trade_id, side)
+    SELECT %%(coin)s, -o.volume, 0, o.wallet_out, o.trade_id, o.side
+    FROM trades_out o
+    UNION ALL
+    SELECT %%(coin)s, o.volume - %(fee)s, %(fee)s, cw.wallet_id, o.trade_id, NOT o.side
+    FROM trades_out o
+    LEFT JOIN wallet_owners wo ON wo.wallet_id = o.order_wallet_in
+    LEFT JOIN coin_wallets cw ON cw.spauser_id = wo.spauser_id
+''' % {'fee': order.utils.get_fee_sql('o.volume')}
+
+# Split a settlement into transactions within the size, input and output limits. inputs are the unspent outputs to
+# spend, each with its value and address type. outputs are [address, value, address type] to pay, in order: an output
+# may be split across two transactions. Whatever remains once all outputs are paid goes to the exchange, so the
+# network fee of each transaction is paid from the exchange fee. Returns a list of transactions, each with its inputs,
+# {address: value} outputs, network fee and estimated virtual size, or None if the exchange fee doesn't cover the
+# network fees.
+def plan_transactions(inputs, outputs, exchange_address, exchange_type, fee_rate, max_vsize, max_inputs, max_outputs):
+    def estimate(transaction_inputs, output_types):
+        vsize = wallet.utils.estimate_transaction_vsize([detail['type'] for detail in transaction_inputs],
+                                                        output_types)
+        return vsize, int(math.ceil(vsize * fee_rate / 1000))
+
+    # Always leave room to close a transaction with two more outputs: part of the next output, and the exchange.
+    reserve = ['p2pkh', 'p2pkh']
+    pending = [list(output) for output in outputs]
+    transactions = []
+    next_input = 0
+    while next_input < len(inputs):
+        transaction_inputs = []
+        transaction_outputs = []
+        value_in = 0
+        value_out = 0
+        while True:
+            output_types = [output_type for to_address, value, output_type in transaction_outputs]
+            if pending:
+                vsize, fee = estimate(transaction_inputs, output_types + [pending[0][2]] + reserve)
+                if vsize > max_vsize or len(transaction_outputs) + 1 + len(reserve) > max_outputs:
+                    break
+                if value_in - value_out - fee >= pending[0][1]:
+                    value_out += pending[0][1]
+                    transaction_outputs.append(pending.pop(0))
+                    continue
+            if next_input == len(inputs) or len(transaction_inputs) == max_inputs:
+                break
+            vsize, fee = estimate(transaction_inputs + [inputs[next_input]], output_types + reserve)
+            if vsize > max_vsize and transaction_inputs:
+                break
+            value_in += inputs[next_input]['value']
+            transaction_inputs.append(inputs[next_input])
+            next_input += 1
+
+        # Pay as much of the next output as we can, the next transaction pays the rest.
+        output_types = [output_type for to_address, value, output_type in transaction_outputs]
+        if pending:
+            vsize, fee = estimate(transaction_inputs, output_types + [pending[0][2]])
+            paid = min(value_in - value_out - fee, pending[0][1])
+            if paid <= 0:
+                return None
+            transaction_outputs.append([pending[0][0], paid, pending[0][2]])
+            output_types.append(pending[0][2])
+            value_out += paid
+            pending[0][1] -= paid
+            if not pending[0][1]:
+                pending.pop(0)
+
+        # Anything left over goes to the exchange.
+        vsize, fee = estimate(transaction_inputs, output_types + [exchange_type])
+        if value_in - value_out - fee > 0:
+            transaction_outputs.append([exchange_address, value_in - value_out - fee, exchange_type])
         else:
-            assert(order_side == 'sell')
-            if order_direction == 'in':
-                if unsettled_trade.sell_order_settled_in is trade.models.SETTLED_NONE:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_VALID" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.sell_order.id))
-                    unsettled_trade.sell_order_settled_in = trade.models.SETTLED_VALID
-                    unsettled_trade.save()
-            else:
-                assert(order_direction == 'out')
-                if unsettled_trade.sell_order_settled_out is trade.models.SETTLED_NONE:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_VALID" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.sell_order.id))
-                    unsettled_trade.sell_order_settled_out = trade.models.SETTLED_VALID
-                    unsettled_trade.save()
-
-        reporting.utils.audit(message="settling order marked valid", details={
-            'identifiers': identifiers,
-            'trade': model_to_dict(unsettled_trade),
-            'side': order_side,
+            # Too little to be worth an output, it's paid as network fee.
+            vsize, fee = estimate(transaction_inputs, output_types)
+            if value_in - value_out < fee:
+                return None
+            fee = value_in - value_out
+
+        transaction_outputs_by_address = {}
+        for to_address, value, output_type in transaction_outputs:
+            transaction_outputs_by_address[to_address] = transaction_outputs_by_address.get(to_address, 0) + value
+        transactions.append({
+            'inputs': transaction_inputs,
+            'outputs': transaction_outputs_by_address,
+            'fee': fee,
+            'vsize': vsize,
         })
 
-        return unsettled_trade
-
-    def mark_as_pending(self, identifiers, unsettled_trade, order_side, order_direction):
-        if order_side == True:
-            order_side = 'buy'
-        elif order_side == False:
-            order_side = 'sell'
+    if pending:
+        return None
+    return transactions
+
+# Settle a coin in a worker process, with its own database connection.
+def settle_worker(arguments):
+    coin_type, run_id, identifiers, now = arguments
+    try:
+        run = trade.models.SettlementRun.objects.get(id=run_id)
+        return Command().settle(coin_types=[coin_type], run=run, identifiers=identifiers, now=now)
+    except Exception as e:
+        print("ERROR: failed to settle %s: %s" % (coin_type, e))
+        return {
+            'settled_order_count': 0,
+            'coins': {coin_type: 'failed'},
+            'errors': ["failed to settle %s: %s" % (coin_type, e)],
+        }
+    finally:
+        connections.close_all()
+        # Pool workers exit without running atexit handlers.
+        reporting.utils.flush_audit()
 
-        if order_side == 'buy':
-            if order_direction == 'in':
-                if unsettled_trade.buy_order_settled_in is trade.models.SETTLED_VALID:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.buy_order.id))
-                    unsettled_trade.buy_order_settled_in = trade.models.SETTLED_PENDING
-                    unsettled_trade.save()
-                else:
-                    print(" !! failed to mark %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.buy_order.id))
-                    self.mark_as_error(identifiers, unsettled_trade, order_side)
-            else:
-                assert(order_direction == 'out')
-                if unsettled_trade.buy_order_settled_out is trade.models.SETTLED_VALID:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.buy_order.id))
-                    unsettled_trade.buy_order_settled_out = trade.models.SETTLED_PENDING
-                    unsettled_trade.save()
-                else:
-                    print(" !! failed to mark %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.buy_order.id))
-                    self.mark_as_error(identifiers, unsettled_trade, order_side)
-        else:
-            assert(order_side == 'sell')
-            if order_direction == 'in':
-                if unsettled_trade.sell_order_settled_in is trade.models.SETTLED_VALID:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.sell_order.id))
-                    unsettled_trade.sell_order_settled = trade.models.SETTLED_PENDING
-                    unsettled_trade.save()
-                else:
-                    print(" !! failed to mark %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.sell_order.id))
-                    self.mark_as_error(identifiers, unsettled_trade, order_side)
-            else:
-                if unsettled_trade.sell_order_settled_out is trade.models.SETTLED_VALID:
-                    print(" - marking %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.sell_order.id))
-                    unsettled_trade.sell_order_settled = trade.models.SETTLED_PENDING
-                    unsettled_trade.save()
-                else:
-                    print(" !! failed to mark %s %s order %s (%d:%s) SETTLED_PENDING" % (unsettled_trade.cryptopair, order_side, order_direction, unsettled_trade.id, unsettled_trade.sell_order.id))
-                    self.mark_as_error(identifiers, unsettled_trade, order_side)
+class Command(BaseCommand):
+    help = 'Settle trades'
 
-        reporting.utils.audit(message="settling order marked pending", details={
+    def add_arguments(self, parser):
+        parser.add_argument('--parallel', action='store_true',
+                            help='Settle each coin in its own worker process')
+
+    def get_staged_condition(self, order_side, order_direction):
+        return "s.side IS %s AND s.volume %s 0" % ('TRUE' if order_side == 'buy' else 'FALSE',
+                                                   '>' if order_direction == 'in' else '<=')
+
+    # Move each side and direction of the staged trades matching the condition from one settled state to another,
+    # returns {(order_side, order_direction): [trade_id, ...]}.
+    def update_settled(self, cursor, condition, params, from_states, to_state):
+        updated = {}
+        with transaction.atomic():
+            # Trades are shared by the coins on both sides of their cryptopair: lock them in a consistent order so
+            # coins settling in parallel can't deadlock.
+            cursor.execute('''
+                SELECT id FROM trade_trade WHERE id IN (SELECT trade_id FROM {table}) ORDER BY id FOR UPDATE
+            '''.format(table=self.staging_table))
+            for order_side, order_direction, field in SETTLED_FIELDS:
+                cursor.execute('''
+                    UPDATE trade_trade SET {field} = %(to_state)s, modified = %(modified)s
+                    WHERE {field} IN %(from_states)s AND id IN (
+                        SELECT s.trade_id FROM {staged} WHERE {staged_condition} AND ({condition})
+                    )
+                    RETURNING id
+                '''.format(field=field, staged=STAGED_TRADES_SQL.format(table=self.staging_table),
+                           staged_condition=self.get_staged_condition(order_side, order_direction),
+                           condition=condition),
+                    dict(params, to_state=to_state, from_states=tuple(from_states), modified=timezone.now()))
+                updated[(order_side, order_direction)] = [row[0] for row in cursor.fetchall()]
+        return updated
+
+    # Mark the staged trades matching the condition as errors, unless already marked with an error
+    def mark_as_error(self, cursor, identifiers, condition, params, reason, errors, from_states=None):
+        if from_states is None:
+            from_states = [trade.models.SETTLED_NONE, trade.models.SETTLED_VALID, trade.models.SETTLED_PENDING,
+                           trade.models.SETTLED_COMPLETE]
+        updated = self.update_settled(cursor, condition=condition, params=params, from_states=from_states,
+                                      to_state=trade.models.SETTLED_ERROR)
+        error_count = sum(len(trade_ids) for trade_ids in updated.values())
+        if error_count:
+            errors.append("%s (%d orders)" % (reason, error_count))
+            print("ERROR: %s, marking %d orders SETTLED_ERROR" % (reason, error_count))
+            reporting.utils.audit(message="settling orders marked error", details={
+                'identifiers': identifiers,
+                'reason': reason,
+                'trades': {"%s_%s" % side_direction: trade_ids for side_direction, trade_ids in updated.items()},
+            })
+        return error_count
+
+    # Mark all staged trades valid if not already marked with an error
+    def mark_as_valid(self, cursor, identifiers):
+        with transaction.atomic():
+            updated = self.update_settled(cursor, condition='TRUE', params={},
+                                          from_states=[trade.models.SETTLED_NONE], to_state=trade.models.SETTLED_VALID)
+            trade_ids = set(trade_id for trade_ids in updated.values() for trade_id in trade_ids)
+            settled_trades = trade.models.Trade.objects.select_related('buy_order', 'sell_order').in_bulk(trade_ids)
+            wallet.ledger.trades_settled([(settled_trades[trade_id], order_side, order_direction)
+                                          for (order_side, order_direction), trade_ids in updated.items()
+                                          for trade_id in trade_ids])
+
+        for (order_side, order_direction), trade_ids in updated.items():
+            print(" - marked %d %s orders %s SETTLED_VALID" % (len(trade_ids), order_side, order_direction))
+        reporting.utils.audit(message="settling orders marked valid", details={
             'identifiers': identifiers,
-            'trade': model_to_dict(unsettled_trade),
-            'side': order_side,
+            'trades': {"%s_%s" % side_direction: trade_ids for side_direction, trade_ids in updated.items()},
         })
 
-        return unsettled_trade
-
-    # Mark trade error if not already marked with an error
-    def mark_as_error(self, identifiers, unsettled_trade=None, order_side=None):
-        if order_side == True:
-            order_side = 'buy'
-        elif order_side == False:
-            order_side = 'sell'
-
-        if order_side == 'buy':
-            if unsettled_trade.buy_order_settled is not trade.models.SETTLED_ERROR:
-                print(" - marking %s %s order (%d:%s) SETTLED_ERROR" % (unsettled_trade.cryptopair, order_side, unsettled_trade.id, unsettled_trade.buy_order.id))
-                unsettled_trade.buy_order_settled = trade.models.SETTLED_ERROR
-                unsettled_trade.save()
-        else:
-            assert(order_side == 'sell')
-            if unsettled_trade.sell_order_settled is not trade.models.SETTLED_ERROR:
-                print(" - marking %s %s order (%d:%s) SETTLED_ERROR" % (unsettled_trade.cryptopair, order_side, unsettled_trade.id, unsettled_trade.sell_order.id))
-                unsettled_trade.sell_order_settled = trade.models.SETTLED_ERROR
-                unsettled_trade.save()
-
-        reporting.utils.audit(message="settling order marked error", details={
+    # Mark a coin's staged trades pending inclusion on the blockchain, staged trades that weren't valid are errors
+    def mark_as_pending(self, cursor, identifiers, coin_type, errors):
+        with transaction.atomic():
+            self.mark_as_error(cursor, identifiers, condition='s.currency = %(coin)s', params={'coin': coin_type},
+                               reason="%s orders not valid when marking pending" % coin_type, errors=errors,
+                               from_states=[trade.models.SETTLED_NONE, trade.models.SETTLED_PENDING,
+                                            trade.models.SETTLED_COMPLETE])
+            updated = self.update_settled(cursor, condition='s.currency = %(coin)s', params={'coin': coin_type},
+                                          from_states=[trade.models.SETTLED_VALID],
+                                          to_state=trade.models.SETTLED_PENDING)
+
+        for (order_side, order_direction), trade_ids in updated.items():
+            print(" - marked %d %s orders %s SETTLED_PENDING" % (len(trade_ids), order_side, order_direction))
+        reporting.utils.audit(message="settling orders marked pending", details={
             'identifiers': identifiers,
-            'trade': model_to_dict(unsettled_trade),
-            'side': order_side,
+            'coin': coin_type,
+            'trades': {"%s_%s" % side_direction: trade_ids for side_direction, trade_ids in updated.items()},
         })
 
-        return unsettled_trade
+    # Stage a coin's unsettled trades, returns the number of trades staged.
+    def stage_trades(self, cursor, identifiers, coin_type, coin_details, watermark):
+        cursor.execute(STAGE_TRADES_SQL.format(table=self.staging_table), {
+            'coin': coin_type,
+            'none': trade.models.SETTLED_NONE,
+            'valid': trade.models.SETTLED_VALID,
+            'error': trade.models.SETTLED_ERROR,
+            'watermark': watermark,
+        })
+        # Each trade is staged as one row out and one row in.
+        staged_count = cursor.rowcount // 2
 
-    def validate_timestamps(self, identifiers, now, unsettled_trade, errors):
+        cursor.execute('SELECT trade_id FROM {table} WHERE currency = %s AND volume <= 0 ORDER BY id'
+                       .format(table=self.staging_table), [coin_type])
+        reporting.utils.audit(message="settling details", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'staged_count': staged_count,
+            'trades': [row[0] for row in cursor.fetchall()],
+        })
+        return staged_count
+
+    # Sum the staged funds in and out of each wallet in a coin, returns [(wallet_id, total_volume, total_fee), ...]
+    def get_wallet_totals(self, cursor, coin_type):
+        cursor.execute('''
+            SELECT wallet_id, SUM(volume), SUM(fee) FROM {table}
+            WHERE currency = %s AND wallet_id IS NOT NULL
+            GROUP BY wallet_id ORDER BY wallet_id
+        '''.format(table=self.staging_table), [coin_type])
+        return [(wallet_id, int(total_volume), int(total_fee)) for wallet_id, total_volume, total_fee in cursor.fetchall()]
+
+    # Be sure a coin's staged trades have sane timestamps, a wallet to receive funds, and sufficient funds to send.
+    def validate_trades(self, cursor, identifiers, now, coin_type, coin_details, errors):
         # @TODO: time-drift between servers could trigger one or more of these
         # errors. Consider rounding timestamps up.
-
+        params = {'coin': coin_type, 'now': now}
         # Orders can't be placed in the future
-        if unsettled_trade.sell_order.created > now:
-            self.mark_as_error(
-                identifiers=identifiers,
-                unsettled_trade=unsettled_trade,
-                order_side='sell'
-            )
-            errors.append("sell order created in future (%s), now %s" % (unsettled_trade.sell_order.created, now))
-            print("ERROR: order created in the future")
-        if unsettled_trade.buy_order.created > now:
-            self.mark_as_error(
-                identifiers=identifiers,
-                unsettled_trade=unsettled_trade,
-                order_side='buy'
-            )
-            errors.append("buy order created in future (%s), now %s" % (unsettled_trade.buy_order.created, now))
-            print("ERROR: buy order created in the future")
-
+        self.mark_as_error(cursor, identifiers, condition='s.currency = %(coin)s AND o.created > %(now)s',
+                           params=params, reason="order created in the future", errors=errors)
         # Trades can't happen in the future
-        if unsettled_trade.created > now:
-            self.mark_as_error(
-                identifiers=identifiers,
-                unsettled_trade=unsettled_trade,
-                order_side='sell'
-            )
-            errors.append("trade created in future (%s), now %s" % (unsettled_trade.created, now))
-            print("ERROR: sell trade created in the future")
-
+        self.mark_as_error(cursor, identifiers, condition='s.currency = %(coin)s AND t.created > %(now)s',
+                           params=params, reason="trade created in the future", errors=errors)
         # Trades can't happen before the order is placed
-        if unsettled_trade.sell_order.created > unsettled_trade.created:
-            self.mark_as_error(
-                identifiers=identifiers,
-                unsettled_trade=unsettled_trade,
-                order_side='sell'
-            )
-            errors.append("trade created (%s) before sell order created (%s)" % (unsettled_trade.created, unsettled_trade.sell_order.created))
-            print("ERROR: trade created before sell order created")
-        if unsettled_trade.buy_order.created > unsettled_trade.created:
-            self.mark_as_error(
-                identifiers=identifiers,
-                unsettled_trade=unsettled_trade,
-                order_side='buy'
-            )
-            errors.append("trade created (%s) before buy order created (%s)" % (unsettled_trade.created, unsettled_trade.buy_order.created))
-            print("ERROR: trade created before buy order created")
-
-        return errors
-
-    def get_trades_from_wallet(self, user_wallet):
-        return TempTrades.objects.filter(wallet_id=user_wallet.id)
-
-    def handle(self, *args, **options):
-
-        # Maintain global metadata about the orders being settled
-        global_settled_order_count = 0
-        now = datetime.datetime.now(datetime.timezone.utc)
-
-        # Add a unique id allowing us to trace through this pass at settling
-        identifiers = {
-            'trace_id': reporting.utils.generate_trace_id(),
+        self.mark_as_error(cursor, identifiers, condition='s.currency = %(coin)s AND o.created > t.created',
+                           params=params, reason="trade created before order created", errors=errors)
+        # The user receiving funds needs a wallet for the coin
+        self.mark_as_error(cursor, identifiers, condition='s.currency = %(coin)s AND s.wallet_id IS NULL',
+                           params=params, reason="no %s wallet to receive funds" % coin_type, errors=errors)
+
+        wallet_totals = self.get_wallet_totals(cursor, coin_type)
+        user_wallets = wallet.models.Wallet.objects.in_bulk([wallet_id for wallet_id, total_volume, total_fee
+                                                              in wallet_totals if total_volume < 0])
+        insufficient_wallets = []
+        for wallet_id, total_volume, total_fee in wallet_totals:
+            # Confirm there's sufficient funds for this trade.
+            if total_volume < 0:
+                balance_in = 0
+                balance_out = total_volume * -1
+                balances = wallet.utils.get_balances(identifiers=identifiers, user_wallet=user_wallets[wallet_id])
+                if balances['blockchain'] < balance_out:
+                    insufficient_wallets.append(wallet_id)
+                    errors.append("%d balance insufficient for %d trades" % (balances['blockchain'], balance_out))
+                    print("ERROR: insufficient funds")
+            else:
+                balance_out = 0
+                balance_in = total_volume
+                balances = {}
+
+            reporting.utils.audit(message="settling balance confirmation", details={
+                'identifiers': identifiers,
+                'coin_details': coin_details,
+                'aggregate_settle': {
+                    'wallet': wallet_id,
+                    'total_volume': total_volume,
+                    'total_fee': total_fee,
+                },
+                'funds_out': {
+                    'currency_code': coin_type,
+                    'volume': balance_out,
+                },
+                'funds_in': {
+                    'currency_code': coin_type,
+                    'volume': balance_in,
+                },
+                'balances': balances,
+                'errors': errors,
+            })
+
+        if insufficient_wallets:
+            self.mark_as_error(cursor, identifiers, condition='s.currency = %(coin)s AND s.wallet_id IN %(wallets)s',
+                               params={'coin': coin_type, 'wallets': tuple(insufficient_wallets)},
+                               reason="insufficient funds", errors=errors)
+
+    # Build the transactions settling a coin's staged trades, returns a list of transactions, or None if they can't be
+    # built.
+    def build_transactions(self, cursor, identifiers, coin_type, coin_details, errors):
+        wallet_totals = self.get_wallet_totals(cursor, coin_type)
+        validation = {
+            'exchange': 0,
         }
+        audit_validation = {
+            'exchange': 0,
+        }
+        total = 0
+        for wallet_id, total_volume, total_fee in wallet_totals:
+            validation[wallet_id] = total_volume
+            audit_validation[wallet_id.hex] = total_volume
+            validation['exchange'] += total_fee
+            audit_validation['exchange'] += total_fee
+            total += total_volume + total_fee
+        # funds in plus funds out must be zero
+        assert(total == 0)
+
+        reporting.utils.audit(message="settling trades balance validation", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'validation': audit_validation,
+            'validation_total': total,
+            'errors': errors,
+        })
 
-        errors = []
-
-        # @TODO: grab a lock to ensure only one process can settle at a time
-        # https://github.com/ .. /issues/134
-
-        with connection.cursor() as cursor:
-            cursor.execute('DROP TABLE IF EXISTS settle_temptrades')
-            cursor.execute('''
-                CREATE TABLE settle_temptrades (
-                    id BIGSERIAL PRIMARY KEY NOT NULL,
-                    currency CHARACTER VARYING(16),
-                    volume BIGINT,
-                    fee BIGINT,
-                    wallet_id UUID REFERENCES wallet_wallet (id),
-                    trade_id BIGINT REFERENCES trade_trade (id),
-                    side BOOLEAN
-                );''')
-
-            # Step 1:
-            # Loop through each coin type, settle money out:
-            for coin_type in settings.COINS.keys():
-                print("Settling %s (%s)..." % (settings.COINS[coin_type]['name'], coin_type))
-                coin_details = {
-                    'type': coin_type,
-                    'name': settings.COINS[coin_type]['name'],
-                }
-                reporting.utils.audit(message="initiating settling", details={
+        # The unspent outputs spent by the transactions, funds coming out of blockchain wallets:
+        inputs = []
+        # The funds going into blockchain wallets, as [address, value, address type]:
+        outputs = []
+
+        funds_in = validation['exchange']
+        funds_out = 0
+
+        user_wallets = wallet.models.Wallet.objects.in_bulk([wallet_id for wallet_id, total_volume, total_fee
+                                                              in wallet_totals])
+        for wallet_id in validation:
+            # @TODO: use a valid address
+            if wallet_id == 'exchange':
+                exchange_address = address.utils.get_new_exchange_address(self, currencycode=coin_type)
+                continue
+
+            user_wallet = user_wallets[wallet_id]
+
+            # Handle funds-in
+            if validation[wallet_id] > 0:
+                # Generate a new address from this user's wallet
+                new_address, index = address.utils.get_new_address(user_wallet=user_wallet, is_change=False)
+                # @TODO: make it configurable which address gets used -- for now, we use p2pkh
+                outputs.append([new_address['p2pkh'], validation[wallet_id], 'p2pkh'])
+                funds_in += validation[wallet_id]
+                reporting.utils.audit(message="settling funds in new address", details={
                     'identifiers': identifiers,
                     'coin_details': coin_details,
+                    'wallet_id': wallet_id,
+                    'wallet_funds_in': validation[wallet_id],
+                    'address': new_address['p2pkh'],
                 })
 
-                # Start by finding trades where the base currency for the sell
-                # order side has an appropriate base currency.
-                # @TODO: do we need to review sell_order_settled_in trades too?
-                trades_out_sells = trade.models.Trade.objects.filter(sell_order__base_currency=coin_type) \
-                    .filter(models.Q(sell_order_settled_out=trade.models.SETTLED_NONE) | models.Q(sell_order_settled_out=trade.models.SETTLED_VALID)) \
-                    .order_by('created')
-
-                for unsettled_trade in trades_out_sells:
-                    global_settled_order_count += 1
-                    from_user = unsettled_trade.sell_order.wallet.user.get()
-                    order_fee = order.utils.get_fee(
-                        order=unsettled_trade.sell_order,
-                        volume=unsettled_trade.base_volume
-                    )
-
-                    # Collect the temporary data we build for settling, and
-                    # write it to the audit logs.
-                    to_settle = []
-
-                    # Record the money-out (sell) from this trade
-                    new_settle = TempTrades(
-                        currency=coin_type,
-                        volume=unsettled_trade.base_volume * -1,
-                        fee=0, # no fee for money-out
-                        side=False, # sell order
-                        wallet=unsettled_trade.sell_order.wallet,
-                        trade=unsettled_trade,
-                    )
-                    new_settle.save()
-                    to_settle.append(model_to_dict(new_settle))
-
-                    # Record the money-in (buy) from this trade
-                    to_user = unsettled_trade.buy_order.wallet.user.get()
-                    money_in_wallet = wallet.models.Wallet.objects.get(
-                        user=to_user,
-                        currencycode=coin_type,
-                    )
-                    new_settle = TempTrades(
-                        currency=coin_type,
-                        volume=unsettled_trade.base_volume - order_fee,
-                        fee=order_fee,
-                        side=True, # buy order
-                        wallet=money_in_wallet,
-                        trade=unsettled_trade,
-                    )
-                    new_settle.save()
-                    to_settle.append(model_to_dict(new_settle))
-
-                    # Be sure order and trade have sane timestamps
-                    errors = self.validate_timestamps(
-                        identifiers=identifiers,
-                        now=now,
-                        unsettled_trade=unsettled_trade,
-                        errors=errors)
-
-                    from_details = {
-                        'user_id': from_user.id,
-                        'wallet_id': unsettled_trade.sell_order.wallet.id,
-                        'order_id': unsettled_trade.sell_order.id,
-                        'trade_id': unsettled_trade.id,
-                        'order_type': 'sell',
-                        'cryptopair': unsettled_trade.cryptopair,
-                        'pair_side': 'base',
-                        'volume': unsettled_trade.base_volume,
-                        'fee': order_fee,
-                        'order_created': unsettled_trade.sell_order.created,
-                        'trade_created': unsettled_trade.created,
-                        'now': now,
-                    }
-                    to_details = {
-                        'user_id': to_user.id,
-                        'wallet_id': unsettled_trade.buy_order.wallet.id,
-                        'order_id': unsettled_trade.buy_order.id,
-                        'trade_id': unsettled_trade.id,
-                        'order_type': 'buy',
-                        'cryptopair': unsettled_trade.cryptopair,
-                        'pair_side': 'base',
-                        'volume': unsettled_trade.base_volume - order_fee,
-                        'order_created': unsettled_trade.buy_order.created,
-                        'trade_created': unsettled_trade.created,
-                        'now': now,
+            else:
+                value = validation[wallet_id] * -1
+                unspent, addresses, subtotal, success = wallet.utils.get_unspent_equal_or_greater(user_wallet, value,
+                                                                                                  details=True)
+                if (success == False):
+                    # @TODO
+                    # Something has gone terribly wrong: we already validated we had sufficient funds
+                    print("ERROR: ALERT ALERT")
+                    return None
+                funds_out += subtotal
+                reporting.utils.audit(message="settling funds out loading unspent", details={
+                    'identifiers': identifiers,
+                    'coin_details': coin_details,
+                    'wallet_id': wallet_id,
+                    'wallet_funds_out': value,
+                    'unspent': {
+                        'vout': unspent,
+                        'addresses': list(addresses),
+                        'value': subtotal,
                     }
+                })
 
-                    reporting.utils.audit(message="settling details", details={
+                # Assemble the inputs, we'll use the wallet when we sign the transaction
+                for detail in unspent:
+                    detail['wallet'] = wallet_id.hex
+                    inputs.append(detail)
+                # If the unspent has more funds than needed, send the change back to the user's wallet
+                if subtotal > value:
+                    new_address, index = address.utils.get_new_address(user_wallet=user_wallet, is_change=True)
+                    outputs.append([new_address['p2pkh'], subtotal - value, 'p2pkh'])
+                    funds_in += subtotal - value
+                    reporting.utils.audit(message="settling returning change to user", details={
                         'identifiers': identifiers,
                         'coin_details': coin_details,
-                        'from_details': from_details,
-                        'to_details': to_details,
-                        'to_settle': to_settle,
-                        'errors': errors,
+                        'wallet_id': wallet_id,
+                        'wallet_funds_out': value,
+                        'unspent': {
+                            'vout': unspent,
+                            'addresses': list(addresses),
+                            'value': subtotal,
+                        },
+                        'change': {
+                            'address': new_address['p2pkh'],
+                            'value': subtotal - value,
+                        }
                     })
 
+        # Validate our inputs and outputs
+        for receive_address, value, address_type in outputs:
+            assert(value > 0)
+
+        assert(funds_in == funds_out)
+
+        # Coin selection includes the address type of each input, we only need the exchange's
+        address_types = wallet.utils.get_address_types([exchange_address])
+
+        # @TODO: exchange configuration for how quickly we settle
+        # @TODO: exchange configuratoin for how we settle
+        fee_rate, minimum_fee_rate = wallet.utils.get_fee_rates(currencycode=coin_type, number_of_blocks=18,
+                                                                estimate_mode='CONSERVATIVE')
+        transactions = plan_transactions(inputs=inputs, outputs=outputs, exchange_address=exchange_address,
+                                         exchange_type=address_types[exchange_address],
+                                         fee_rate=max(fee_rate, minimum_fee_rate),
+                                         max_vsize=settings.SETTLE['max_vsize'],
+                                         max_inputs=settings.SETTLE['max_inputs'],
+                                         max_outputs=settings.SETTLE['max_outputs'])
+
+        if transactions is None:
+            print(" ! ERROR: Unable to settle {}, our fee of {} is less than network fee ... skipping" \
+                .format(coin_type, validation['exchange']))
+            # @TODO don't record this as settled, next time we try
+            # to settle it should still need to be settled
+            reporting.utils.audit(message="settling insufficient exchange fee", details={
+                'identifiers': identifiers,
+                'coin_details': coin_details,
+                'funds_in': funds_in,
+                'funds_out': funds_out,
+                'inputs': inputs,
+                'outputs': outputs,
+                'exchange_fee': validation['exchange'],
+                'fee_rate': fee_rate,
+                'minimum_fee_rate': minimum_fee_rate,
+                'errors': errors,
+            })
+            return None
+
+        for transaction_to_send in transactions:
+            transaction_to_send['outputs'] = {to_address: wallet.utils.convert_to_decimal(value)
+                                              for to_address, value in transaction_to_send['outputs'].items()}
+
+        reporting.utils.audit(message="settling finalizing transaction", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'funds_in': funds_in,
+            'funds_out': funds_out,
+            'transactions': transactions,
+            'exchange_fee': validation['exchange'],
+            'network_fee': sum(transaction_to_send['fee'] for transaction_to_send in transactions),
+            'errors': errors,
+        })
+        return transactions
+
+    # Sign one of a coin's settling transactions with the keys of the addresses sending funds.
+    def sign_transaction(self, identifiers, coin_type, coin_details, transaction_to_sign, errors):
+        raw_tx = wallet.utils.create_raw_transaction(currencycode=coin_type, output=transaction_to_sign['outputs'],
+                                                     input=[{'txid': detail['txid'], 'vout': detail['vout']}
+                                                            for detail in transaction_to_sign['inputs']])
+        reporting.utils.audit(message="settling raw transaction", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'transaction': transaction_to_sign,
+            'raw_transaction': raw_tx,
+            'errors': errors,
+        })
 
-                # Next, find trades where the base currency for the buy order side
-                # has an appropriate quote currency.
-                # @TODO do we need to review buy_order_settled_in trades too?
-                trades_out_buys = trade.models.Trade.objects.filter(buy_order__quote_currency=coin_type) \
-                    .filter(models.Q(buy_order_settled_out=trade.models.SETTLED_NONE) | models.Q(buy_order_settled_out=trade.models.SETTLED_VALID)) \
-                    .order_by('created')
-
-                for unsettled_trade in trades_out_buys:
-                    global_settled_order_count += 1
-                    from_user = unsettled_trade.buy_order.wallet.user.get()
-                    order_fee = order.utils.get_fee(
-                        order=unsettled_trade.buy_order,
-                        volume=unsettled_trade.volume,
-                    )
+        # Group the addresses we're sending from by wallet
+        addresses_with_unspent = {}
+        for detail in transaction_to_sign['inputs']:
+            addresses_with_unspent.setdefault(uuid.UUID(detail['wallet']), set()).add(detail['address'])
+
+        # @TODO Sign the raw transaction
+        private_keys = []
+        # Load wallet's private key, effectively unlocking it
+        user_wallets = wallet.models.Wallet.objects.in_bulk(list(addresses_with_unspent))
+        for wallet_id, source_addresses in addresses_with_unspent.items():
+            # @TODO use remote secrets database for storing private keys
+            unlocked_account = BIP32Node.from_hwif(user_wallets[wallet_id].private_key)
+
+            # Get WIF for all addresses we're sending from
+            for address_object in Address.objects.filter(wallet=wallet_id).filter(
+                    models.Q(p2pkh__in=source_addresses) | models.Q(p2sh_p2wpkh__in=source_addresses) |
+                    models.Q(bech32__in=source_addresses)):
+                if address_object.is_change:
+                    is_change = 1
+                else:
+                    is_change = 0
+                unlocked_address = unlocked_account.subkey_for_path("%d/%s" % (is_change, address_object.index))
+                private_keys.append(unlocked_address.wif())
 
-                    # Collect the temporary data we build for settling, and
-                    # write it to the audit logs.
-                    to_settle = []
-
-                    # Record the money-out (buy) from this trade
-                    new_settle = TempTrades(
-                        currency=coin_type,
-                        volume=unsettled_trade.volume * -1,
-                        fee=0, # no fee for money-out
-                        side=True, # buy order
-                        wallet=unsettled_trade.buy_order.wallet,
-                        trade=unsettled_trade,
-                    )
-                    new_settle.save()
-                    to_settle.append(model_to_dict(new_settle))
-
-                    # Record the money-in (sell) from this trade
-                    to_user = unsettled_trade.sell_order.wallet.user.get()
-                    money_in_wallet = wallet.models.Wallet.objects.get(
-                        user=to_user,
-                        currencycode=coin_type,
-                    )
-                    new_settle = TempTrades(
-                        currency=coin_type,
-                        volume=unsettled_trade.volume - order_fee,
-                        fee=order_fee,
-                        side=False, # sell order
-                        wallet=money_in_wallet,
-                        trade=unsettled_trade,
-                    )
-                    new_settle.save()
-                    to_settle.append(model_to_dict(new_settle))
-
-                    # Be sure order and trade have sane timestamps
-                    errors = self.validate_timestamps(
-                        identifiers=identifiers,
-                        now=now,
-                        unsettled_trade=unsettled_trade,
-                        errors=errors)
-
-                    from_details = {
-                        'user_id': from_user.id,
-                        'wallet_id': unsettled_trade.buy_order.wallet.id,
-                        'order_id': unsettled_trade.buy_order.id,
-                        'trade_id': unsettled_trade.id,
-                        'order_type': 'buy',
-                        'cryptopair': unsettled_trade.cryptopair,
-                        'pair_side': 'quote',
-                        'volume': unsettled_trade.volume,
-                        'fee': order_fee,
-                        'order_created': unsettled_trade.buy_order.created,
-                        'trade_created': unsettled_trade.created,
-                        'now': now,
-                    }
-                    to_details = {
-                        'user_id': to_user.id,
-                        'wallet_id': unsettled_trade.sell_order.wallet.id,
-                        'order_id': unsettled_trade.sell_order.id,
-                        'trade_id': unsettled_trade.id,
-                        'order_type': 'sell',
-                        'pair_side': 'quote',
-                        'volume': unsettled_trade.volume - order_fee,
-                    }
-                    reporting.utils.audit(message="settling details", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'from_details': from_details,
-                        'to_details': to_details,
-                        'to_settle': to_settle,
-                        'errors': errors,
-                    })
+        if coin_type in ['BTC', 'XTN']:
+            # Starting with 0.17, bitcoind replaces the old sign RPC with a new one
+            signed_tx = wallet.utils.sign_raw_transaction_with_key(currencycode=coin_type, raw_tx=raw_tx, private_keys=private_keys)
+        else:
+            signed_tx = wallet.utils.sign_raw_transaction(currencycode=coin_type, raw_tx=raw_tx, output=[], private_keys=private_keys)
 
-                tmp_trades = TempTrades.objects.values('wallet') \
-                    .filter(currency=coin_type) \
-                    .annotate(total_volume=models.Sum('volume'), total_fee=models.Sum('fee'))
+        reporting.utils.audit(message="settling signed transaction", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'transaction': transaction_to_sign,
+            'raw_transaction': raw_tx,
+            'signed_transaction': signed_tx,
+            'errors': errors,
+        })
+        return signed_tx
+
+    # Send one of a coin's signed settling transactions to the blockchain, returns its txid.
+    def send_transaction(self, identifiers, coin_type, coin_details, transaction_to_send, errors):
+        txid = wallet.utils.send_signed_transaction(currencycode=coin_type, signed_tx=transaction_to_send['signed_tx']['hex'])
+        if txid:
+            # The outputs we spent are no longer unspent, don't serve them from the cache.
+            blockchain.utils.clear_unspent(coin=settings.COINS[coin_type]['name'],
+                                           addresses=[detail['address'] for detail in transaction_to_send['inputs']])
+        reporting.utils.audit(message="settling sent transaction", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'signed_transaction': transaction_to_send['signed_tx'],
+            'txid': txid,
+            'errors': errors,
+        })
+        return txid
+
+    # Take the advisory lock for settling each coin, returns the coins locked. A coin that is already locked is being
+    # settled by another process.
+    def lock_coins(self, cursor, coin_types):
+        locked = []
+        for coin_type in coin_types:
+            cursor.execute("SELECT pg_try_advisory_lock(hashtext('settle'), hashtext(%s))", [coin_type])
+            if cursor.fetchone()[0]:
+                locked.append(coin_type)
+        return locked
+
+    def unlock_coins(self, cursor, coin_types):
+        for coin_type in coin_types:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('settle'), hashtext(%s))", [coin_type])
+
+    # Returns the coin's checkpoint that isn't complete, or a new checkpoint staging trades newer than the last
+    # completed checkpoint's watermark.
+    def get_checkpoint(self, run, coin_type):
+        checkpoint = trade.models.SettlementCheckpoint.objects.filter(coin=coin_type, complete=False, abandoned=False) \
+            .order_by('-id').first()
+        if checkpoint is not None:
+            return checkpoint
+
+        last_checkpoint = trade.models.SettlementCheckpoint.objects.filter(coin=coin_type, complete=True) \
+            .order_by('-id').first()
+        if last_checkpoint is None:
+            watermark = 0
+        else:
+            watermark = last_checkpoint.watermark
+        return trade.models.SettlementCheckpoint.objects.create(run=run, coin=coin_type,
+                                                                previous_watermark=watermark, watermark=watermark)
+
+    def save_checkpoint(self, checkpoint, identifiers, phase, **fields):
+        checkpoint.phase = phase
+        for field, value in fields.items():
+            setattr(checkpoint, field, value)
+        checkpoint.save()
+        reporting.utils.audit(message="settling checkpoint", details={
+            'identifiers': identifiers,
+            'checkpoint': {
+                'id': checkpoint.id,
+                'run': checkpoint.run_id,
+                'coin': checkpoint.coin,
+                'phase': checkpoint.phase,
+                'watermark': checkpoint.watermark,
+                'staged_count': checkpoint.staged_count,
+                'complete': checkpoint.complete,
+                'abandoned': checkpoint.abandoned,
+            },
+        })
 
-                for tmp_trade in tmp_trades:
-                    user_wallet = wallet.models.Wallet.objects.get(id=tmp_trade['wallet'])
-                    balances = wallet.utils.get_balances(
-                        identifiers=identifiers,
-                        user_wallet=user_wallet,
-                    )
-                    # Confirm there's sufficient funds for this trade.
-                    if tmp_trade['total_volume'] < 0:
-                        balance_in = 0
-                        balance_out = tmp_trade['total_volume'] * -1
-                        #print("validating transfer of {} {} out of wallet {}".format(balance_out, user_wallet.currencycode, user_wallet.id))
-                        if balances['blockchain'] < balance_out:
-                            trades = self.get_trades_from_wallet(user_wallet=user_wallet)
-                            for error_trade in trades:
-                                self.mark_as_error(
-                                    identifiers=identifiers,
-                                    unsettled_trade=error_trade.trade,
-                                    order_side=error_trade.side,
-                                )
-                            errors.append("%d balance insufficient for %d trades" % (balances['blockchain'], balance_out))
-                            print("ERROR: insufficient funds")
-                        #if tmp_trade['total_fee'] > 0:
-                            #print("validating transfer of {} {} fee to exchange".format(tmp_trade['total_fee'], user_wallet.currencycode))
-                    else:
-                        balance_out = 0
-                        balance_in = tmp_trade['total_volume']
-                        #print("validating transfer of {} {} into wallet {}".format(balance_in, user_wallet.currencycode, user_wallet.id))
-                        #print("validating transfer of {} {} fee to exchange".format(tmp_trade['total_fee'], user_wallet.currencycode))
-
-                    coin_details = {
-                        'type': user_wallet.currencycode,
-                        'name': settings.COINS[user_wallet.currencycode]['name'],
-                    }
-                    reporting.utils.audit(message="settling balance confirmation", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'aggregate_settle': tmp_trade,
-                        'funds_out': {
-                            'currency_code': user_wallet.currencycode,
-                            'volume': balance_out,
-                        },
-                        'funds_in': {
-                            'currency_code': user_wallet.currencycode,
-                            'volume': balance_in,
-                        },
-                        'balances': balances,
-                        'errors': errors,
-                    })
+    # Count the staged trades with any side marked as an error.
+    def get_error_count(self, cursor):
+        cursor.execute('''
+            SELECT COUNT(*) FROM trade_trade WHERE id IN (SELECT trade_id FROM {table})
+                AND %s IN (buy_order_settled_in, buy_order_settled_out, sell_order_settled_in, sell_order_settled_out)
+        '''.format(table=self.staging_table), [trade.models.SETTLED_ERROR])
+        return cursor.fetchone()[0]
+
+    # Settle a coin, resuming its checkpoint from the last phase completed. Returns (orders staged, outcome).
+    def settle_coin(self, cursor, run, coin_type, identifiers, now, errors):
+        checkpoint = self.get_checkpoint(run=run, coin_type=coin_type)
+        identifiers = dict(identifiers, checkpoint=checkpoint.id)
+        self.staging_table = checkpoint.get_staging_table()
+        coin_details = {
+            'type': coin_type,
+            'name': settings.COINS[coin_type]['name'],
+        }
+        if checkpoint.phase:
+            print("Resuming settling %s (%s) after phase %s..." % (coin_details['name'], coin_type, checkpoint.phase))
+        else:
+            print("Settling %s (%s)..." % (coin_details['name'], coin_type))
+        reporting.utils.audit(message="initiating settling", details={
+            'identifiers': identifiers,
+            'coin_details': coin_details,
+            'phase': checkpoint.phase,
+        })
 
-            # Auditing completed, mark trades as pending indicating we're ready
-            # to actually settle. Any trades that have previously been marked
-            # with an error will stay as an error.
-            all_trades_to_settle = TempTrades.objects.filter()
-            for trade_to_settle in all_trades_to_settle:
-                # This only succeeds if the trade doesn't have an error
-                if trade_to_settle.volume > 0:
-                    order_direction = 'in'
-                else:
-                    order_direction = 'out'
-                self.mark_as_valid(
-                    identifiers=identifiers,
-                    unsettled_trade=trade_to_settle.trade,
-                    order_side=trade_to_settle.side,
-                    order_direction=order_direction)
-
-            # Be sure there are no trades in an ERROR state.
-            error_trades = trade.models.Trade.objects.filter(
-                models.Q(buy_order_settled_in=trade.models.SETTLED_ERROR) |
-                models.Q(buy_order_settled_out=trade.models.SETTLED_ERROR) |
-                models.Q(sell_order_settled_in=trade.models.SETTLED_ERROR) |
-                models.Q(sell_order_settled_out=trade.models.SETTLED_ERROR)
-            )
-            error_count = 0
-            for error_trade in error_trades:
-                error_count += 1
+        # Step 1:
+        # Stage the trades settling money out of the coin.
+        if not checkpoint.phase:
+            cursor.execute('DROP TABLE IF EXISTS {table}'.format(table=self.staging_table))
+            cursor.execute('''
+                CREATE TABLE {table} (
+                    id BIGSERIAL PRIMARY KEY NOT NULL,
+                    currency CHARACTER VARYING(16),
+                    volume BIGINT,
+                    fee BIGINT,
+                    wallet_id UUID REFERENCES wallet_wallet (id),
+                    trade_id BIGINT REFERENCES trade_trade (id),
+                    side BOOLEAN
+                );'''.format(table=self.staging_table))
+            staged_count = self.stage_trades(cursor, identifiers, coin_type, coin_details,
+                                             watermark=checkpoint.previous_watermark)
+            if not staged_count:
+                cursor.execute('DROP TABLE {table}'.format(table=self.staging_table))
+                checkpoint.delete()
+                return 0, 'nothing to settle'
+            cursor.execute('SELECT MAX(trade_id) FROM {table}'.format(table=self.staging_table))
+            self.save_checkpoint(checkpoint, identifiers, 'staged', staged_count=staged_count,
+                                 watermark=max(checkpoint.previous_watermark, cursor.fetchone()[0]))
+
+        # Step 2:
+        # Validate the staged trades, then mark them as valid indicating we're
+        # ready to actually settle. Any trades that have previously been marked
+        # with an error will stay as an error.
+        if checkpoint.phase == 'staged':
+            self.validate_trades(cursor, identifiers, now, coin_type, coin_details, errors)
+            self.mark_as_valid(cursor, identifiers)
+            self.save_checkpoint(checkpoint, identifiers, 'validated')
+
+        # Step 3:
+        # Build the blockchain transaction, once there are no trades in an
+        # ERROR state. If there are, the checkpoint is abandoned: the next run
+        # stages the other trades again, leaving the errors for review.
+        if checkpoint.phase == 'validated':
+            error_count = self.get_error_count(cursor)
             if error_count > 0:
-                print("ERROR: aborting settling due to errors (%d)".format(error_count))
-                return(-1)
-            else:
-                print("no errors detected: creating blockchain transactions.")
-
-            # Finally, create the actual blockchain transactions
-            for coin_type in settings.COINS.keys():
-                trades_to_settle = TempTrades.objects \
-                    .filter(currency=coin_type)
-                if len(trades_to_settle):
-                    print("\nGenerating {} transaction(s)...".format(coin_type))
-                    # @TODO: keep track of transaction size, split into multiple
-                    # transactions if necessary.
-
-                    validation = {
-                        'exchange': 0,
-                    }
-                    audit_validation = {
-                        'exchange': 0,
-                    }
-                    total = 0
-                    for trade_to_settle in trades_to_settle:
-                        if trade_to_settle.wallet.id in validation:
-                            validation[trade_to_settle.wallet.id] += trade_to_settle.volume
-                            audit_validation[trade_to_settle.wallet.id.hex] += trade_to_settle.volume
-                        else:
-                            validation[trade_to_settle.wallet.id] = trade_to_settle.volume
-                            audit_validation[trade_to_settle.wallet.id.hex] = trade_to_settle.volume
-                        validation['exchange'] += trade_to_settle.fee
-                        audit_validation['exchange'] += trade_to_settle.fee
-
-                        total += trade_to_settle.volume + trade_to_settle.fee
-                    # funds in plus funds out must be zero
-                    assert(total == 0)
-
-                    reporting.utils.audit(message="settling trades balance validation", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'validation': audit_validation,
-                        'validation_total': total,
-                        'errors': errors,
-                    })
-
-                    # The funds going into blockchain wallets:
-                    vin = {}
-                    # The funds coming out of blockchain wallets:
-                    vout = []
-
-                    addresses_with_unspent = {}
-
-                    funds_in = 0
-                    funds_out = 0
-
-                    #pprint(validation)
-                    for wallet_id in validation:
-                        # @TODO: use a valid address
-                        if wallet_id == 'exchange':
-                            exchange_address = address.utils.get_new_exchange_address(self, currencycode=coin_type)
-                            vin[exchange_address] = validation[wallet_id]
-                            continue
-
-                        user_wallet = wallet.models.Wallet.objects.get(id=wallet_id)
-
-                        # Handle funds-in
-                        if validation[wallet_id] > 0:
-                            # Generate a new address from this user's wallet
-                            new_address, index = address.utils.get_new_address(user_wallet=user_wallet, is_change=False)
-                            # @TODO: make it configurable which address gets used -- for now, we use p2pkh
-                            vin[new_address['p2pkh']] = validation[wallet_id]
-                            reporting.utils.audit(message="settling funds in new address", details={
-                                'identifiers': identifiers,
-                                'coin_details': coin_details,
-                                'wallet_id': wallet_id,
-                                'wallet_funds_in': validation[wallet_id],
-                                'address': new_address['p2pkh'],
-                            })
-
-                        else:
-                            value = validation[wallet_id] * -1
-                            unspent, addresses, subtotal, success = wallet.utils.get_unspent_equal_or_greater(user_wallet, value)
-                            if (success == False):
-                                # @TODO
-                                # Something has gone terribly wrong: we already validated we had sufficient funds
-                                print("ERROR: ALERT ALERT")
-                                return -1
-                            funds_out += subtotal
-                            # We'll use this when we sign the transaction
-                            addresses_with_unspent[wallet_id] = addresses
-                            reporting.utils.audit(message="settling funds out loading unspent", details={
-                                'identifiers': identifiers,
-                                'coin_details': coin_details,
-                                'wallet_id': wallet_id,
-                                'wallet_funds_out': value,
-                                'unspent': {
-                                    'vout': unspent,
-                                    'addresses': list(addresses),
-                                    'value': subtotal,
-                                }
-                            })
-
-                            # Assemble the vout array
-                            for detail in unspent:
-                                vout.append(detail)
-                            # If the unspent has more funds than needed, send the change back to the user's wallet
-                            if subtotal > value:
-                                new_address, index = address.utils.get_new_address(user_wallet=user_wallet, is_change=True)
-                                vin[new_address['p2pkh']] = subtotal - value
-                                #print(" + CHANGE: {}".format(subtotal - value))
-                                reporting.utils.audit(message="settling returning change to user", details={
-                                    'identifiers': identifiers,
-                                    'coin_details': coin_details,
-                                    'wallet_id': wallet_id,
-                                    'wallet_id': wallet_id,
-                                    'wallet_funds_out': value,
-                                    'unspent': {
-                                        'vout': unspent,
-                                        'addresses': list(addresses),
-                                        'value': subtotal,
-                                    },
-                                    'change': {
-                                        'address': new_address['p2pkh'],
-                                        'value': subtotal - value,
-                                    }
-                                })
-
-                    # Validate our vin and vout
-                    for receive_address in vin:
-                        assert(vin[receive_address] > 0)
-                        funds_in += vin[receive_address]
-
-                    assert(funds_in == funds_out)
-
-                    #print(" o vin: {}".format(vin))
-                    #print(" o vout: {}".format(vout))
-
-                    # @TODO: exchange configuration for how quickly we settle
-                    # @TODO: exchange configuratoin for how we settle
-                    fee, valid = wallet.utils.calculate_fee(wallet=user_wallet, vout=vout, vin=vin,
-                                                            number_of_blocks=18, estimate_mode='CONSERVATIVE')
-
-                    reporting.utils.audit(message="settling calculating fees", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'funds_in': funds_in,
-                        'funds_out': funds_out,
-                        'vin': vin,
-                        'vout': vout,
-                        'exchange_fee': validation['exchange'],
-                        'network_fee': fee,
-                        'errors': errors,
-                    })
+                print("ERROR: aborting settling %s due to errors (%d)" % (coin_type, error_count))
+                cursor.execute('DROP TABLE {table}'.format(table=self.staging_table))
+                self.save_checkpoint(checkpoint, identifiers, checkpoint.phase, abandoned=True)
+                return checkpoint.staged_count, 'aborted'
+            print("no errors detected: creating %s blockchain transaction." % coin_type)
+
+            # Settle in as many transactions as needed to keep each within the
+            # size and input limits.
+            transactions = self.build_transactions(cursor, identifiers, coin_type, coin_details, errors)
+            if transactions is None:
+                # The staged trades weren't settled, let the next checkpoint stage them again along with newer trades.
+                cursor.execute('DROP TABLE {table}'.format(table=self.staging_table))
+                self.save_checkpoint(checkpoint, identifiers, checkpoint.phase, abandoned=True)
+                return checkpoint.staged_count, 'skipped'
+            self.save_checkpoint(checkpoint, identifiers, 'built', state=json.dumps({
+                'transactions': transactions,
+            }))
+
+        # Step 4:
+        # Sign each transaction, and send it before signing the next so the
+        # first transactions reach the mempool sooner. Progress is saved after
+        # each transaction, so a failure resumes with the transaction that
+        # failed.
+        if checkpoint.phase == 'built':
+            state = json.loads(checkpoint.state)
+            for index, transaction_to_send in enumerate(state['transactions']):
+                if 'signed_tx' not in transaction_to_send:
+                    try:
+                        signed_tx = self.sign_transaction(identifiers, coin_type, coin_details, transaction_to_send,
+                                                          errors)
+                    except:
+                        print("ERROR: failed to sign transaction - no response from RPC call")
+                        return checkpoint.staged_count, 'signing failed'
+                    if signed_tx['complete'] is False:
+                        print("ERROR: failed to sign transaction")
+                        print(signed_tx)
+                        return checkpoint.staged_count, 'signing failed'
+                    transaction_to_send['signed_tx'] = signed_tx
+                    self.save_checkpoint(checkpoint, identifiers, 'built', state=json.dumps(state))
+
+                # @TODO: broadcast is disabled until the exchange address is a real wallet.
+                if settings.SETTLE['broadcast'] and not transaction_to_send.get('txid'):
+                    txid = self.send_transaction(identifiers, coin_type, coin_details, transaction_to_send, errors)
+                    if not txid:
+                        print("ERROR: failed to send transaction %d of %d" % (index + 1, len(state['transactions'])))
+                        return checkpoint.staged_count, 'sending failed'
+                    transaction_to_send['txid'] = txid
+                    self.save_checkpoint(checkpoint, identifiers, 'built', state=json.dumps(state))
+            self.save_checkpoint(checkpoint, identifiers, 'signed')
+
+        # Step 5:
+        # Update database: these trades are now pending inclusion on
+        # the blockchain.
+        if checkpoint.phase == 'signed':
+            self.mark_as_pending(cursor, identifiers, coin_type, errors)
+            cursor.execute('DROP TABLE {table}'.format(table=self.staging_table))
+            self.save_checkpoint(checkpoint, identifiers, 'broadcast', complete=True)
+        return checkpoint.staged_count, 'pending'
+
+    # Settle the coins, resuming any checkpoints left incomplete by earlier runs. Returns a report of the number of
+    # orders settled, the outcome for each coin, and any errors.
+    def settle(self, coin_types, run, identifiers, now):
+        report = {
+            'settled_order_count': 0,
+            'coins': {},
+            'errors': [],
+        }
 
-                    if fee > validation['exchange']:
-                        print(" ! ERROR: Unable to settle {}, our fee of {} is less than network fee of {} ... skipping" \
-                            .format(coin_type, validation['exchange'], fee))
-                        # @TODO don't record this as settled, next time we try
-                        # to settle it should still need to be settled
-                        reporting.utils.audit(message="settling insufficient exchange fee", details={
-                            'identifiers': identifiers,
-                            'coin_details': coin_details,
-                            'funds_in': funds_in,
-                            'funds_out': funds_out,
-                            'vin': vin,
-                            'vout': vout,
-                            'exchange_fee': validation['exchange'],
-                            'network_fee': fee,
-                            'errors': errors,
-                        })
+        with connection.cursor() as cursor:
+            locked_coins = self.lock_coins(cursor, coin_types)
+            try:
+                for coin_type in coin_types:
+                    if coin_type not in locked_coins:
+                        print("ERROR: %s is already being settled, skipping" % coin_type)
+                        report['coins'][coin_type] = 'locked'
                         continue
+                    staged_count, outcome = self.settle_coin(cursor, run, coin_type, identifiers, now,
+                                                             report['errors'])
+                    report['settled_order_count'] += staged_count
+                    report['coins'][coin_type] = outcome
+            finally:
+                self.unlock_coins(cursor, locked_coins)
 
-                    # Subtract network fee from our profits
-                    vin[exchange_address] -= fee
-                    #print(" - subtracting network fee of {}, leaving {} for exchange fee".format(fee, vin[exchange_address]))
-
-                    # Create actual transaction
-                    final_vin = {}
-                    for to_address in vin:
-                        final_vin[to_address] = wallet.utils.convert_to_decimal(vin[to_address])
-                    #print("final_vin: {}".format(final_vin))
-
-                    reporting.utils.audit(message="settling finalizing transaction", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'final_vin': final_vin,
-                        'vout': vout,
-                        'final_exchange_fee': validation['exchange'],
-                        'network_fee': fee,
-                        'errors': errors,
-                    })
-
-                    raw_tx = wallet.utils.create_raw_transaction(currencycode=coin_type, input=vout, output=final_vin)
-                    #print("raw_tx: {}".format(raw_tx))
-                    reporting.utils.audit(message="settling raw transaction", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'vin': final_vin,
-                        'vout': vout,
-                        'exchange_fee': validation['exchange'],
-                        'network_fee': fee,
-                        'raw_transaction': raw_tx,
-                        'errors': errors,
-                    })
+        return report
 
-                    # @TODO Sign the raw transaction
-                    private_keys = []
-                    # Load wallet's private key, effectively unlocking it
-
-                    #print("addresses_with_unspent: {}".format(addresses_with_unspent))
-
-                    for wallet_id in validation:
-                        # exchange only receives money, skip
-                        if wallet_id == 'exchange':
-                            continue
-
-                        # Only get private keys if the user is sending funds
-                        if validation[wallet_id] < 0:
-                            # @TODO use remote secrets database for storing private keys
-                            user_wallet = wallet.models.Wallet.objects.get(id=wallet_id)
-                            unlocked_account = BIP32Node.from_hwif(user_wallet.private_key)
-
-                            # Get WIF for all addresses we're sending from
-                            for source_address in addresses_with_unspent[wallet_id]:
-                                #print("to_address: %s" % to_address)
-                                address_object = Address.objects.get(wallet=wallet_id, p2pkh=source_address)
-                                #print("source_address({}) index({}) is_change({})".format(source_address, address_object.index, address_object.is_change))
-                                if address_object.is_change:
-                                    is_change = 1
-                                else:
-                                    is_change = 0
-                                unlocked_address = unlocked_account.subkey_for_path("%d/%s" % (is_change, address_object.index))
-                                private_keys.append(unlocked_address.wif())
-
-                    #print(private_keys)
-
-                    if coin_type in ['BTC', 'XTN']:
-                        # Starting with 0.17, bitcoind replaces the old sign RPC with a new one
-                        signed_tx = wallet.utils.sign_raw_transaction_with_key(currencycode=coin_type, raw_tx=raw_tx, private_keys=private_keys)
-                    else:
-                        signed_tx = wallet.utils.sign_raw_transaction(currencycode=coin_type, raw_tx=raw_tx, output=[], private_keys=private_keys)
-
-                    #print("signed_tx: {}".format(signed_tx))
-                    reporting.utils.audit(message="settling signed transaction", details={
-                        'identifiers': identifiers,
-                        'coin_details': coin_details,
-                        'vin': final_vin,
-                        'vout': vout,
-                        'exchange_fee': validation['exchange'],
-                        'network_fee': fee,
-                        'raw_transaction': raw_tx,
-                        'signed_transaction': signed_tx,
-                        'errors': errors,
-                    })
+    def handle(self, *args, **options):
+        now = datetime.datetime.now(datetime.timezone.utc)
 
-                    try:
-                        if signed_tx['complete'] is False:
-                            print("ERROR: failed to sign transaction")
-                            print(signed_tx)
-                        else:
-                            # @TODO Send the transaction to the blockchain:
-                            #  - submit tx to blockchain, audit resulting txid
-
-                            # Update database: these trades are now pending inclusion on
-                            # the blockchain.
-                            for trade_to_settle in trades_to_settle:
-                                if trade_to_settle.volume > 0:
-                                    order_direction = 'in'
-                                else:
-                                    order_direction = 'out'
-                                self.mark_as_pending(
-                                    identifiers=identifiers,
-                                    unsettled_trade=trade_to_settle.trade,
-                                    order_side=trade_to_settle.side,
-                                    order_direction=order_direction)
-                    except:
-                        print("ERROR: failed to sign transaction - no response from RPC call")
+        # Add a unique id allowing us to trace through this pass at settling, shared by all workers.
+        identifiers = {
+            'trace_id': reporting.utils.generate_trace_id(),
+        }
+        run = trade.models.SettlementRun.objects.create(trace_id=identifiers['trace_id'], parallel=options['parallel'])
+        identifiers['settlement_run'] = run.id
+
+        coin_types = list(settings.COINS.keys())
+        if options['parallel']:
+            # Workers open their own database connections, don't share ours across the fork.
+            connections.close_all()
+            with multiprocessing.Pool(processes=len(coin_types)) as pool:
+                reports = pool.map(settle_worker, [(coin_type, run.id, identifiers, now) for coin_type in coin_types],
+                                   chunksize=1)
+        else:
+            reports = [self.settle(coin_types=coin_types, run=run, identifiers=identifiers, now=now)]
 
-            cursor.execute('DROP TABLE settle_temptrades')
+        # Merge the worker reports into a single report for the run.
+        report = {
+            'settled_order_count': 0,
+            'coins': {},
+            'errors': [],
+        }
+        for coin_report in reports:
+            report['settled_order_count'] += coin_report['settled_order_count']
+            report['coins'].update(coin_report['coins'])
+            report['errors'].extend(coin_report['errors'])
+
+        for coin_type in coin_types:
+            self.stdout.write("%s: %s" % (coin_type, report['coins'].get(coin_type)))
+        for error in report['errors']:
+            self.stdout.write(self.style.ERROR(error))
+
+        if any(outcome in ['aborted', 'failed'] for outcome in report['coins'].values()):
+            self.stdout.write(self.style.ERROR('Failed to settle %d orders' % report['settled_order_count']))
+        else:
+            self.stdout.write(self.style.SUCCESS('Successfully settled %d orders' % report['settled_order_count']))
 
-        self.stdout.write(self.style.SUCCESS('Successfully settled %d orders' % global_settled_order_count))
+        run.report = json.dumps(report)
+        run.save()
 
         reporting.utils.audit(message="completed settling all coins", details={
             'identifiers': identifiers,
-            'global_settled_order_count': global_settled_order_count,
+            'global_settled_order_count': report['settled_order_count'],
+            'report': report,
         })
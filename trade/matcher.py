@@ -0,0 +1,367 @@
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.forms.models import model_to_dict
+from rest_framework import status
+
+import pika
+
+from order.models import Order
+import trade.orderbook
+import trade.utils
+import reporting.utils
+import wallet.ledger
+
+
+# Orders and cancels for a cryptopair are sent to that cryptopair's intake queue. A single matcher process consumes
+# each queue, making it the only writer to the cryptopair's orderbook. When MATCHER['enabled'] is False (for example
+# when running tests) orders are instead matched inline by the web worker that accepted them.
+
+def get_queue(cryptopair):
+    return settings.MATCHER['queue'] % cryptopair
+
+# Match a new order against the orderbook, the new order must already be saved.
+def process_order(identifiers, new_order):
+    with trade.orderbook.locked_orderbook(new_order.cryptopair) as book:
+        # The book may have loaded this order from the database before it was matched: match it as an incoming order.
+        book.remove(new_order)
+        trades = trade.utils.match_order(identifiers=identifiers, order_to_match=new_order, book=book)
+        book.save_snapshot()
+        return trades
+
+# Cancel an open order, returns the order as it is after the cancel (it may have been filled first).
+def process_cancel(identifiers, order_id):
+    user_order = Order.objects.get(id=order_id)
+    with trade.orderbook.locked_orderbook(user_order.cryptopair) as book:
+        # Reload inside the lock, the order may have been filled since it was loaded.
+        user_order = Order.objects.get(id=order_id)
+        if user_order.open is True:
+            user_order.open = False
+            user_order.canceled = True
+            with transaction.atomic():
+                user_order.save()
+                wallet.ledger.order_closed(user_order)
+            book.remove(user_order)
+            book.save_snapshot()
+            reporting.utils.audit(message="order canceled", details={
+                'identifiers': identifiers,
+                'order': user_order,
+            })
+    return user_order
+
+# Cancel what remains of an order that failed to match, so it doesn't rest in the orderbook without being matched.
+def cancel_failed_order(identifiers, order_id, error):
+    reporting.utils.audit(message="failed to match order, canceling it", details={
+        'identifiers': identifiers,
+        'order_id': order_id,
+        'error': str(error),
+    })
+    try:
+        process_cancel(identifiers=identifiers, order_id=order_id)
+    except Exception as e:
+        reporting.utils.audit(message="failed to cancel order that failed to match", details={
+            'identifiers': identifiers,
+            'order_id': order_id,
+            'error': str(e),
+        })
+
+class MatcherClient:
+    '''
+    Sends requests to the matchers over a long-lived RabbitMQ connection per process, and waits for their replies with
+    direct reply-to. Replies are handed to the waiting request by correlation id, so concurrent requests in a worker
+    share the connection.
+    '''
+    def __init__(self):
+        self.pid = None
+        self.mqconnection = None
+        self.channel = None
+        # The intake queues already declared on this connection.
+        self.declared = set()
+        # The reply to each request waiting on this connection, None until it arrives, indexed by correlation id.
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    # The connection is opened on first use in each process, as connections can't be shared with forked workers.
+    def connect(self):
+        self.mqconnection = pika.BlockingConnection(pika.ConnectionParameters(settings.MATCHER['host']))
+        self.channel = self.mqconnection.channel()
+        # Use RabbitMQ direct reply-to, so replies don't require declaring a queue per request.
+        self.channel.basic_consume(self.on_response, queue='amq.rabbitmq.reply-to', no_ack=True)
+        self.declared = set()
+        self.pid = os.getpid()
+
+    def disconnect(self):
+        try:
+            if self.mqconnection is not None and self.pid == os.getpid():
+                self.mqconnection.close()
+        except Exception:
+            pass
+        self.mqconnection = None
+        self.channel = None
+
+    def on_response(self, channel, method, properties, body):
+        # Replies to requests that timed out are dropped.
+        if properties.correlation_id in self.responses:
+            self.responses[properties.correlation_id] = json.loads(body.decode())
+
+    def request(self, cryptopair, request):
+        correlation_id = str(uuid.uuid4())
+        with self.lock:
+            if self.pid != os.getpid():
+                self.disconnect()
+            if self.mqconnection is not None:
+                try:
+                    # Service heartbeats, and find out if the broker closed the connection while it was idle.
+                    self.mqconnection.process_data_events(time_limit=0)
+                except Exception:
+                    self.disconnect()
+            if self.mqconnection is None:
+                self.connect()
+            try:
+                if cryptopair not in self.declared:
+                    self.channel.queue_declare(queue=get_queue(cryptopair), durable=True)
+                    self.declared.add(cryptopair)
+                self.responses[correlation_id] = None
+                self.channel.basic_publish(exchange='', routing_key=get_queue(cryptopair),
+                                           body=json.dumps(request, cls=DjangoJSONEncoder),
+                                           properties=pika.BasicProperties(reply_to='amq.rabbitmq.reply-to',
+                                                                           correlation_id=correlation_id,
+                                                                           delivery_mode=2))
+            except Exception:
+                self.responses.pop(correlation_id, None)
+                self.disconnect()
+                raise
+            mqconnection = self.mqconnection
+
+        deadline = time.time() + settings.MATCHER['timeout']
+        try:
+            while True:
+                with self.lock:
+                    if self.responses.get(correlation_id) is not None:
+                        return self.responses[correlation_id]
+                    remaining = deadline - time.time()
+                    # The reply can only arrive on the connection the request was sent on.
+                    if remaining <= 0 or self.mqconnection is not mqconnection:
+                        return None
+                    try:
+                        # Poll briefly, so other requests waiting on the connection get their turn.
+                        mqconnection.process_data_events(time_limit=min(remaining, 0.1))
+                    except Exception:
+                        self.disconnect()
+                        return None
+        finally:
+            with self.lock:
+                self.responses.pop(correlation_id, None)
+
+matcher_client = MatcherClient()
+
+# Send a request to the matcher for the cryptopair and wait for it to reply. Returns None if no reply arrives in time,
+# in which case the request remains queued and will still be processed.
+def rpc_request(cryptopair, request):
+    return matcher_client.request(cryptopair, request)
+
+def matcher_unavailable(identifiers, error):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {
+        "status": "matching engine unavailable",
+        "code": status_code,
+        "debug": {
+            'identifiers': identifiers,
+            'error': str(error),
+        },
+        "data": {},
+    }, status_code
+
+def matcher_failed(identifiers, error):
+    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+    return {
+        "status": "matching engine failed",
+        "code": status_code,
+        "debug": {
+            'identifiers': identifiers,
+            'error': str(error),
+        },
+        "data": {},
+    }, status_code
+
+# Submit a new order for matching, returns a list of trades made by the order.
+def submit_order(identifiers, new_order):
+    if not settings.MATCHER['enabled']:
+        try:
+            return process_order(identifiers=identifiers, new_order=new_order), True
+        except Exception as e:
+            cancel_failed_order(identifiers=identifiers, order_id=new_order.id, error=e)
+            return matcher_failed(identifiers=identifiers, error=e)
+
+    try:
+        response = rpc_request(new_order.cryptopair, {
+            'type': 'order',
+            'identifiers': identifiers,
+            'id': new_order.id,
+        })
+    except Exception as e:
+        # The order never reached the matcher, cancel it so it doesn't sit unmatched in the orderbook.
+        new_order.open = False
+        new_order.canceled = True
+        with transaction.atomic():
+            new_order.save()
+            wallet.ledger.order_closed(new_order)
+        reporting.utils.audit(message="failed to submit order to matcher", details={
+            'identifiers': identifiers,
+            'order': new_order,
+            'error': str(e),
+        })
+        return matcher_unavailable(identifiers=identifiers, error=e)
+
+    if response is None:
+        reporting.utils.audit(message="matcher did not reply in time, order remains queued", details={
+            'identifiers': identifiers,
+            'order': new_order,
+        })
+        return [], True
+    if response.get('error'):
+        # The matcher canceled what remained of the order.
+        return matcher_failed(identifiers=identifiers, error=response['error'])
+    return response['trades'], True
+
+# Submit an order cancel, returns the order as it is after the cancel.
+def cancel_order(identifiers, user_order):
+    if not settings.MATCHER['enabled']:
+        return process_cancel(identifiers=identifiers, order_id=user_order.id), True
+
+    try:
+        response = rpc_request(user_order.cryptopair, {
+            'type': 'cancel',
+            'identifiers': identifiers,
+            'id': user_order.id,
+        })
+    except Exception as e:
+        reporting.utils.audit(message="failed to submit cancel to matcher", details={
+            'identifiers': identifiers,
+            'order': user_order,
+            'error': str(e),
+        })
+        return matcher_unavailable(identifiers=identifiers, error=e)
+
+    if response is None:
+        status_code = status.HTTP_202_ACCEPTED
+        reporting.utils.audit(message="matcher did not reply in time, cancel remains queued", details={
+            'identifiers': identifiers,
+            'order': user_order,
+        })
+        return {
+            "status": "order cancel queued",
+            "code": status_code,
+            "debug": {
+                'identifiers': identifiers,
+            },
+            "data": {
+                'order': model_to_dict(user_order),
+            },
+        }, status_code
+    if response.get('error'):
+        return matcher_failed(identifiers=identifiers, error=response['error'])
+    return Order.objects.get(id=user_order.id), True
+
+
+class Matcher:
+    '''
+    Consumes the intake queues of one or more cryptopairs, sequencing and processing each request in the order it was
+    received. Queues are consumed exclusively, so a second matcher for the same cryptopair can't start.
+    '''
+    def __init__(self, cryptopairs, stdout=None):
+        self.cryptopairs = cryptopairs
+        self.stdout = stdout
+        self.sequence = {}
+        self.last_prune = time.time()
+
+    def run(self):
+        mqconnection = pika.BlockingConnection(pika.ConnectionParameters(settings.MATCHER['host']))
+        channel = mqconnection.channel()
+        channel.basic_qos(prefetch_count=settings.MATCHER['prefetch'])
+        for cryptopair in self.cryptopairs:
+            # Load the orderbook before we start consuming.
+            trade.orderbook.get_orderbook(cryptopair)
+            self.sequence[cryptopair] = 0
+            channel.queue_declare(queue=get_queue(cryptopair), durable=True)
+            channel.basic_consume(functools.partial(self.on_request, cryptopair), queue=get_queue(cryptopair),
+                                  exclusive=True)
+            reporting.utils.audit(message="matcher started", details={
+                'cryptopair': cryptopair,
+                'queue': get_queue(cryptopair),
+            })
+            if self.stdout:
+                self.stdout.write("matching %s from queue %s" % (cryptopair, get_queue(cryptopair)))
+
+        while True:
+            mqconnection.process_data_events(time_limit=settings.MATCHER['snapshot_interval'])
+            trade.orderbook.flush_snapshots()
+            if time.time() - self.last_prune >= settings.MATCHER['prune_interval']:
+                self.prune()
+
+    def on_request(self, cryptopair, channel, method, properties, body):
+        close_old_connections()
+        request = json.loads(body.decode())
+        self.sequence[cryptopair] += 1
+        identifiers = request['identifiers']
+        identifiers['sequence'] = self.sequence[cryptopair]
+
+        try:
+            if request['type'] == 'order':
+                new_order = Order.objects.get(id=request['id'])
+                if new_order.open is True:
+                    trades = process_order(identifiers=identifiers, new_order=new_order)
+                else:
+                    # The order was canceled before it could be matched.
+                    trades = []
+                response = {
+                    'sequence': self.sequence[cryptopair],
+                    'trades': trades,
+                }
+            else:
+                assert(request['type'] == 'cancel')
+                user_order = process_cancel(identifiers=identifiers, order_id=request['id'])
+                response = {
+                    'sequence': self.sequence[cryptopair],
+                    'order': model_to_dict(user_order),
+                }
+        except Exception as e:
+            reporting.utils.audit(message="matcher failed to process request", details={
+                'identifiers': identifiers,
+                'request': request,
+                'error': str(e),
+            })
+            if request['type'] == 'order':
+                cancel_failed_order(identifiers=identifiers, order_id=request['id'], error=e)
+            response = {
+                'sequence': self.sequence[cryptopair],
+                'error': str(e),
+            }
+
+        if properties.reply_to:
+            channel.basic_publish(exchange='', routing_key=properties.reply_to,
+                                  body=json.dumps(response, cls=DjangoJSONEncoder),
+                                  properties=pika.BasicProperties(correlation_id=properties.correlation_id))
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    # Expired orders are otherwise only removed from the book when they're next matched.
+    def prune(self):
+        for cryptopair in self.cryptopairs:
+            book = trade.orderbook.get_orderbook(cryptopair)
+            with book.lock:
+                pruned = book.prune()
+                if pruned:
+                    book.save_snapshot()
+            if pruned:
+                reporting.utils.audit(message="pruned expired orders from orderbook", details={
+                    'cryptopair': cryptopair,
+                    'pruned': pruned,
+                })
+        self.last_prune = time.time()
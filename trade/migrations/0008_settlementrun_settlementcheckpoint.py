@@ -0,0 +1,42 @@
+# Generated by Django 2.2 on 2026-10-18 12:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trade', '0007_auto_20190328_1037'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SettlementRun',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('trace_id', models.UUIDField()),
+                ('parallel', models.BooleanField(default=False)),
+                ('report', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True, null=True)),
+                ('modified', models.DateTimeField(auto_now=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SettlementCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('coin', models.CharField(max_length=16)),
+                ('phase', models.CharField(blank=True, max_length=16)),
+                ('previous_watermark', models.BigIntegerField(default=0)),
+                ('watermark', models.BigIntegerField(default=0)),
+                ('staged_count', models.IntegerField(default=0)),
+                ('state', models.TextField(blank=True, null=True)),
+                ('complete', models.BooleanField(default=False)),
+                ('abandoned', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True, null=True)),
+                ('modified', models.DateTimeField(auto_now=True, null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='checkpoints', to='trade.SettlementRun')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trade', '0008_settlementrun_settlementcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderbookSnapshot',
+            fields=[
+                ('cryptopair', models.CharField(max_length=33, primary_key=True, serialize=False)),
+                ('sequence', models.BigIntegerField(default=0)),
+                ('l2', models.TextField(default='{}')),
+                ('l3', models.TextField(default='{}')),
+                ('market', models.TextField(default='{}')),
+                ('modified', models.DateTimeField(auto_now=True, null=True)),
+            ],
+        ),
+    ]
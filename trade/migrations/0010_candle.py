@@ -0,0 +1,38 @@
+# Generated by Django 2.2 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trade', '0009_orderbooksnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Candle',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('cryptopair', models.CharField(max_length=33)),
+                ('interval', models.CharField(max_length=3)),
+                ('start', models.DateTimeField()),
+                ('open', models.BigIntegerField(default=0)),
+                ('high', models.BigIntegerField(default=0)),
+                ('low', models.BigIntegerField(default=0)),
+                ('close', models.BigIntegerField(default=0)),
+                ('volume', models.BigIntegerField(default=0)),
+                ('base_volume', models.BigIntegerField(default=0)),
+                ('trades', models.IntegerField(default=0)),
+                ('last_trade', models.BigIntegerField(default=0)),
+                ('modified', models.DateTimeField(auto_now=True, null=True)),
+            ],
+            options={
+                'unique_together': {('cryptopair', 'interval', 'start')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='trade',
+            index=models.Index(fields=['cryptopair', '-id'], name='trade_cryptopair_id_idx'),
+        ),
+    ]
@@ -45,3 +45,95 @@ class Trade(models.Model):
     # Metadata
     created = models.DateTimeField(auto_now_add=True, null=True, blank=True, editable=False)
     modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # The latest trades of a cryptopair, for the ticker.
+            models.Index(fields=['cryptopair', '-id'], name='trade_cryptopair_id_idx'),
+        ]
+
+
+# The phases a coin passes through while it's settled, in order. A checkpoint records the last phase completed.
+SETTLEMENT_PHASES = ['staged', 'validated', 'built', 'signed', 'broadcast']
+
+class SettlementRun(models.Model):
+    '''
+    One invocation of the settle command. Each coin settled by a run gets a checkpoint.
+    '''
+    id = models.BigAutoField(primary_key=True, editable=False)
+    trace_id = models.UUIDField()
+    parallel = models.BooleanField(default=False)
+    # The outcome of the run for each coin, as reported by the settle command
+    report = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True, null=True, blank=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+class SettlementCheckpoint(models.Model):
+    '''
+    The progress of settling one coin. A checkpoint that isn't complete is resumed from its last completed phase by
+    the next run, instead of staging new trades for the coin.
+    '''
+    id = models.BigAutoField(primary_key=True, editable=False)
+    # The run that staged the trades, a later run may resume it
+    run = models.ForeignKey(SettlementRun, on_delete=models.PROTECT, related_name='checkpoints')
+    coin = models.CharField(max_length=16)
+    # The last phase completed, blank before the trades are staged
+    phase = models.CharField(max_length=16, blank=True)
+    # Trades newer than the last completed checkpoint's watermark are staged, and the watermark is the newest trade id
+    # staged. Older trades are only staged if they haven't been validated.
+    previous_watermark = models.BigIntegerField(default=0)
+    watermark = models.BigIntegerField(default=0)
+    staged_count = models.IntegerField(default=0)
+    # JSON encoded transaction, once built
+    state = models.TextField(null=True, blank=True)
+    complete = models.BooleanField(default=False)
+    # An abandoned checkpoint's trades are staged again by the next checkpoint for the coin
+    abandoned = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True, null=True, blank=True, editable=False)
+    modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+    def get_staging_table(self):
+        return 'settle_temptrades_%d' % self.id
+
+class OrderbookSnapshot(models.Model):
+    '''
+    The latest state of a cryptopair's resident orderbook, saved by the process matching the cryptopair each time the
+    book changes. Public orderbook requests are served from the snapshot, instead of reading all the open orders.
+    '''
+    cryptopair = models.CharField(max_length=33, primary_key=True)
+    # Incremented each time the snapshot is saved
+    sequence = models.BigIntegerField(default=0)
+    # JSON encoded {'bids': [[price, volume], ...], 'asks': [...]}, with one row per price level (l2) or per order (l3),
+    # best prices first
+    l2 = models.TextField(default='{}')
+    l3 = models.TextField(default='{}')
+    # JSON encoded {'bids': volume, 'asks': volume} of the open market orders, which have no price
+    market = models.TextField(default='{}')
+    modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+class Candle(models.Model):
+    '''
+    The trades of a cryptopair during one interval (for example one minute), updated as trades are made. The ticker
+    adds up the candles of the last 24 hours, instead of reading all the trades.
+    '''
+    id = models.BigAutoField(primary_key=True, editable=False)
+    cryptopair = models.CharField(max_length=33)
+    # The length of the interval, see trade.ticker.CANDLE_INTERVALS
+    interval = models.CharField(max_length=3)
+    # When the interval starts
+    start = models.DateTimeField()
+    # Trade prices in quote currency, the close is the price of the last trade
+    open = models.BigIntegerField(default=0)
+    high = models.BigIntegerField(default=0)
+    low = models.BigIntegerField(default=0)
+    close = models.BigIntegerField(default=0)
+    # How much quote and base currency, in satoshi, was traded
+    volume = models.BigIntegerField(default=0)
+    base_volume = models.BigIntegerField(default=0)
+    trades = models.IntegerField(default=0)
+    # The id of the last trade included
+    last_trade = models.BigIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True, null=True, blank=True, editable=False)
+
+    class Meta:
+        unique_together = ['cryptopair', 'interval', 'start']
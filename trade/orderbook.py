@@ -0,0 +1,376 @@
+import bisect
+import collections
+import contextlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from order.models import Order
+from trade.models import OrderbookSnapshot
+import reporting.utils
+
+
+# Resident orderbooks, one per cryptopair, kept by the matcher (see trade.matcher).
+orderbooks = {}
+orderbooks_lock = threading.Lock()
+
+class OrderBook:
+    '''
+    An in-memory price-time-priority (FIFO) orderbook for a single cryptopair.
+
+    Open orders are kept in sorted price levels, one per side, with a FIFO queue of orders at each level. Market
+    orders (those with a limit_price of 0) are kept in their own FIFO queue per side, as they are always matched first.
+    The database remains the persistence layer: the book only ever holds the same Order objects that get saved.
+    '''
+    def __init__(self, cryptopair):
+        self.cryptopair = cryptopair
+        # Sorted (ascending) limit prices with at least one resting order, per side (True is buy, False is sell).
+        self.prices = {True: [], False: []}
+        # A FIFO queue of resting orders for each limit price, oldest first.
+        self.levels = {True: {}, False: {}}
+        # A FIFO queue of resting market orders, oldest first.
+        self.market = {True: collections.deque(), False: collections.deque()}
+        # All resting orders, indexed by order id.
+        self.orders = {}
+        # The total volume of the resting orders at each limit price, and of the resting market orders, per side.
+        self.volumes = {True: {}, False: {}}
+        self.market_volume = {True: 0, False: 0}
+        # The volume of each resting order included in the totals, indexed by order id.
+        self.order_volumes = {}
+        # The user owning each wallet that has placed an order in this book, indexed by wallet id.
+        self.wallet_users = {}
+        # Only one order at a time can be matched against this book.
+        self.lock = threading.RLock()
+        # The sequence of the last snapshot saved.
+        self.sequence = 0
+        # The price levels of the last snapshot saved, to publish what changed in the next.
+        self.last_l2 = None
+        # When the last snapshot was saved, and whether the book has changed since.
+        self.last_save = 0
+        self.changed = False
+
+    def load(self):
+        for open_order in Order.objects.filter(cryptopair=self.cryptopair, open=True).order_by('created'):
+            self.add(open_order)
+        # Carry on from the last snapshot saved, so its sequence keeps increasing when the book is reloaded.
+        self.sequence = OrderbookSnapshot.objects.filter(cryptopair=self.cryptopair) \
+            .values_list('sequence', flat=True).first() or 0
+
+    def snapshot(self):
+        '''
+        Return the book aggregated by price level (l2) and by order (l3), best prices first, and the total volume of
+        market orders.
+        '''
+        l2 = {}
+        l3 = {}
+        market = {}
+        for side, name in [(True, 'bids'), (False, 'asks')]:
+            prices = self.prices[side]
+            if side is True:
+                prices = reversed(prices)
+            l2[name] = []
+            l3[name] = []
+            for price in prices:
+                l2[name].append([price, self.volumes[side][price]])
+                l3[name].extend([price, resting_order.volume] for resting_order in self.levels[side][price])
+            market[name] = self.market_volume[side]
+        return {
+            'cryptopair': self.cryptopair,
+            'sequence': self.sequence,
+            'l2': l2,
+            'l3': l3,
+            'market': market,
+        }
+
+    def save_snapshot(self, force=False):
+        '''
+        Called each time the book changes. Save a snapshot of the book for the public orderbook endpoint, and publish
+        the price levels that changed since the last snapshot to the middleware. When the matcher is running, this only
+        marks the book as changed: flush_snapshots() saves the changes together from the matcher loop, at most once per
+        snapshot interval.
+        '''
+        if not force and get_snapshot_interval():
+            self.changed = True
+            return None
+        self.changed = False
+        self.last_save = time.time()
+        self.sequence += 1
+        snapshot = self.snapshot()
+        if self.last_l2 is not None:
+            self.publish_deltas(snapshot)
+        self.last_l2 = snapshot['l2']
+        try:
+            OrderbookSnapshot.objects.update_or_create(cryptopair=self.cryptopair, defaults={
+                'sequence': snapshot['sequence'],
+                'l2': json.dumps(snapshot['l2']),
+                'l3': json.dumps(snapshot['l3']),
+                'market': json.dumps(snapshot['market']),
+            })
+        except Exception as e:
+            # The public orderbook falls behind, but matching carries on.
+            reporting.utils.audit(message="failed to save orderbook snapshot", details={
+                'cryptopair': self.cryptopair,
+                'sequence': snapshot['sequence'],
+                'error': str(e),
+            })
+        return snapshot
+
+    def publish_deltas(self, snapshot):
+        deltas = get_deltas(self.last_l2, snapshot['l2'])
+        reporting.utils.notify_middleware({
+            'recipient': None,
+            'type': 'orderbook delta',
+            'data': {
+                'symbol': self.cryptopair,
+                'sequence': snapshot['sequence'],
+                'bids': deltas['bids'],
+                'asks': deltas['asks'],
+                'market': snapshot['market'],
+            },
+            'timestamp': time.time(),
+        }, topic=settings.NOTIFICATIONS['orderbook_topic'] % self.cryptopair)
+
+    def add(self, open_order):
+        if open_order.id in self.orders:
+            return
+        # Orders placed in this process may still have a naive timeinforce, the database stores it as UTC.
+        if open_order.timeinforce and timezone.is_naive(open_order.timeinforce):
+            open_order.timeinforce = timezone.make_aware(open_order.timeinforce, timezone.utc)
+
+        self.orders[open_order.id] = open_order
+        self.order_volumes[open_order.id] = open_order.volume
+        side = open_order.side
+        if not open_order.limit_price:
+            self.market[side].append(open_order)
+            self.market_volume[side] += open_order.volume
+            return
+
+        level = self.levels[side].get(open_order.limit_price)
+        if level is None:
+            level = collections.deque()
+            self.levels[side][open_order.limit_price] = level
+            self.volumes[side][open_order.limit_price] = 0
+            bisect.insort(self.prices[side], open_order.limit_price)
+        level.append(open_order)
+        self.volumes[side][open_order.limit_price] += open_order.volume
+
+    def remove(self, open_order):
+        resting_order = self.orders.pop(open_order.id, None)
+        if resting_order is None:
+            return None
+
+        volume = self.order_volumes.pop(resting_order.id)
+        side = resting_order.side
+        if not resting_order.limit_price:
+            self.market[side].remove(resting_order)
+            self.market_volume[side] -= volume
+            return resting_order
+
+        level = self.levels[side][resting_order.limit_price]
+        level.remove(resting_order)
+        self.volumes[side][resting_order.limit_price] -= volume
+        if not level:
+            # The last order at this price is gone, remove the price level.
+            del self.levels[side][resting_order.limit_price]
+            del self.volumes[side][resting_order.limit_price]
+            prices = self.prices[side]
+            del prices[bisect.bisect_left(prices, resting_order.limit_price)]
+        return resting_order
+
+    def update(self, resting_order, now=None):
+        '''
+        Called after an order in the book was matched: drop it if it was closed, or if it has expired. Otherwise its
+        remaining volume is updated in the totals.
+        '''
+        if resting_order.id not in self.orders:
+            return
+        if now is None:
+            now = timezone.now()
+        if not resting_order.open or (resting_order.timeinforce and resting_order.timeinforce <= now):
+            self.remove(resting_order)
+            return
+
+        filled = self.order_volumes[resting_order.id] - resting_order.volume
+        if filled:
+            self.order_volumes[resting_order.id] = resting_order.volume
+            if resting_order.limit_price:
+                self.volumes[resting_order.side][resting_order.limit_price] -= filled
+            else:
+                self.market_volume[resting_order.side] -= filled
+
+    def wallet_user_id(self, open_order):
+        user_id = self.wallet_users.get(open_order.wallet_id)
+        if user_id is None:
+            user_id = open_order.wallet.user.get().id
+            self.wallet_users[open_order.wallet_id] = user_id
+        return user_id
+
+    def prune(self, now=None):
+        '''
+        Remove all expired orders from the book, returns the number of orders removed.
+        '''
+        if now is None:
+            now = timezone.now()
+        expired = [resting_order for resting_order in self.orders.values()
+                   if resting_order.timeinforce and resting_order.timeinforce <= now]
+        for resting_order in expired:
+            self.remove(resting_order)
+        return len(expired)
+
+    def next_price(self, side, price=None):
+        '''
+        Return the next best limit price on the given side after price, or the best price if price is None. Bids are
+        walked from the highest price down, asks from the lowest price up.
+        '''
+        prices = self.prices[side]
+        if side is True:
+            if price is None:
+                index = len(prices) - 1
+            else:
+                index = bisect.bisect_left(prices, price) - 1
+            if index >= 0:
+                return prices[index]
+        else:
+            if price is None:
+                index = 0
+            else:
+                index = bisect.bisect_right(prices, price)
+            if index < len(prices):
+                return prices[index]
+        return None
+
+    def matching_orders(self, order_to_match):
+        '''
+        Yield the resting orders that order_to_match can trade with, in price-time-priority: market orders first, then
+        limit orders from the best price on, oldest first at each price. Only the price levels that cross the limit
+        price of order_to_match are visited. The book can be updated while iterating.
+        '''
+        to_match_side = not order_to_match.side
+
+        for market_order in list(self.market[to_match_side]):
+            yield market_order
+
+        price = None
+        while True:
+            price = self.next_price(to_match_side, price)
+            if price is None:
+                return
+            if order_to_match.limit_price:
+                # A sell specifies the minimum accepted price, a buy the maximum price willing to pay.
+                if to_match_side is True and price < order_to_match.limit_price:
+                    return
+                if to_match_side is False and price > order_to_match.limit_price:
+                    return
+            for limit_order in list(self.levels[to_match_side].get(price, ())):
+                yield limit_order
+
+def get_deltas(previous, current):
+    '''
+    Return the price levels that changed between two l2 snapshots as [price, volume], best prices first. A volume of 0
+    means the price level was removed.
+    '''
+    deltas = {}
+    for name in ['bids', 'asks']:
+        previous_levels = dict((price, volume) for price, volume in previous[name])
+        current_levels = dict((price, volume) for price, volume in current[name])
+        changed = []
+        for price, volume in current_levels.items():
+            if previous_levels.get(price) != volume:
+                changed.append([price, volume])
+        for price in previous_levels:
+            if price not in current_levels:
+                changed.append([price, 0])
+        deltas[name] = sorted(changed, reverse=name == 'bids')
+    return deltas
+
+def get_snapshot_interval():
+    # Orders matched inline by web workers save each change, there's no matcher loop to save changes later.
+    if not settings.MATCHER['enabled']:
+        return 0
+    return settings.MATCHER['snapshot_interval']
+
+def flush_snapshots():
+    '''
+    Save the snapshots of the resident orderbooks with changes not yet saved, once their interval has passed. Called
+    by the matcher between requests.
+    '''
+    for book in list(orderbooks.values()):
+        if book.changed and time.time() - book.last_save >= get_snapshot_interval():
+            with book.lock:
+                if book.changed:
+                    book.save_snapshot(force=True)
+
+def get_orderbook(cryptopair):
+    with orderbooks_lock:
+        book = orderbooks.get(cryptopair)
+        if book is None:
+            book = OrderBook(cryptopair)
+            book.load()
+            book.save_snapshot(force=True)
+            orderbooks[cryptopair] = book
+    return book
+
+def get_snapshot(cryptopair):
+    '''
+    Return the latest snapshot of a cryptopair's orderbook, see OrderBook.snapshot(). If none has been saved, the
+    snapshot is built from the database.
+    '''
+    try:
+        saved = OrderbookSnapshot.objects.get(cryptopair=cryptopair)
+    except OrderbookSnapshot.DoesNotExist:
+        book = OrderBook(cryptopair)
+        book.load()
+        return book.snapshot()
+    return {
+        'cryptopair': cryptopair,
+        'sequence': saved.sequence,
+        'l2': json.loads(saved.l2),
+        'l3': json.loads(saved.l3),
+        'market': json.loads(saved.market),
+    }
+
+def discard_orderbook(cryptopair):
+    '''
+    Discard a resident orderbook that may no longer match the database, it will be reloaded when next needed.
+    '''
+    with orderbooks_lock:
+        orderbooks.pop(cryptopair, None)
+
+def clear_orderbooks():
+    with orderbooks_lock:
+        orderbooks.clear()
+
+@contextlib.contextmanager
+def locked_orderbook(cryptopair):
+    '''
+    Yield the orderbook of a cryptopair, with only one order at a time matched against it.
+
+    The matcher is the only process matching a cryptopair, so it keeps the book resident. When the matcher isn't
+    enabled, orders are matched by whichever web worker accepted them: a book kept by one worker would go stale as soon
+    as another worker matched an order, so the book is loaded from the database on every use instead. A Postgres
+    advisory lock on the cryptopair is held until the matched orders are saved, so no other process can match against
+    the same resting orders in between.
+    '''
+    if settings.MATCHER['enabled']:
+        book = get_orderbook(cryptopair)
+        with book.lock:
+            yield book
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_lock(hashtext('match'), hashtext(%s))", [cryptopair])
+    try:
+        book = OrderBook(cryptopair)
+        book.load()
+        # Every inline change is saved under the lock, so publish what changes from the last snapshot saved.
+        last_l2 = OrderbookSnapshot.objects.filter(cryptopair=cryptopair).values_list('l2', flat=True).first()
+        if last_l2 is not None:
+            book.last_l2 = json.loads(last_l2)
+        yield book
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('match'), hashtext(%s))", [cryptopair])
@@ -2,16 +2,24 @@ import json
 from pprint import pprint
 from io import StringIO
 import time
+import datetime
 
 from django.core.cache import cache
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APITestCase
+from django.test import SimpleTestCase, TestCase
 from django.core.management import call_command
 
 import order.utils
+from order.models import Order
+from wallet.models import WalletLedger
 import reporting.utils
 import trade.models
+import trade.orderbook
+import trade.ticker
 import trade.utils
+from trade.management.commands import settle
 
 
 # When an order is placed, we check to see if it matches against existing open orders. We match orders using a basic
@@ -1080,6 +1088,24 @@ class TradeTest(APITestCase):
         # A trade out and then back in results in less available funds, because the exchange took fees.
         self.assertLess(content['data']['funds']['available'], available_for_trading)
 
+        # The wallet ledgers updated while trading match the ledgers rebuilt from the open orders and unsettled trades.
+        def load_ledgers():
+            return {ledger.wallet_id: (ledger.reserved, ledger.pending_in, ledger.pending_out)
+                    for ledger in WalletLedger.objects.all() if ledger.reserved or ledger.pending_in or ledger.pending_out}
+        ledgers = load_ledgers()
+        self.assertGreater(len(ledgers), 0)
+        call_command('rebuildledger', stdout=StringIO())
+        self.assertEqual(ledgers, load_ledgers())
+
+        # The candles updated while trading match the candles rebuilt from the trades.
+        def load_candles():
+            return sorted(trade.models.Candle.objects.values_list('cryptopair', 'interval', 'start', 'open', 'high',
+                                                                  'low', 'close', 'volume', 'base_volume', 'trades'))
+        candles = load_candles()
+        self.assertGreater(len(candles), 0)
+        call_command('backfillcandles', stdout=StringIO())
+        self.assertEqual(candles, load_candles())
+
     def test_trade_timeinforce(self):
         """
         Verify order expires after timeinforce passes
@@ -1363,9 +1389,306 @@ class TradeTest(APITestCase):
         pprint(out.getvalue())
         self.assertIn('settled 6 orders', out.getvalue())
 
+        # Settling moved every side of every trade out of SETTLED_NONE, and released them from the wallet ledgers.
+        for settled_trade in trade.models.Trade.objects.all():
+            self.assertNotEqual(settled_trade.buy_order_settled_in, trade.models.SETTLED_NONE)
+            self.assertNotEqual(settled_trade.buy_order_settled_out, trade.models.SETTLED_NONE)
+            self.assertNotEqual(settled_trade.sell_order_settled_in, trade.models.SETTLED_NONE)
+            self.assertNotEqual(settled_trade.sell_order_settled_out, trade.models.SETTLED_NONE)
+        self.assertFalse(WalletLedger.objects.exclude(pending_in=0, pending_out=0).exists())
+
         # Invoke the settle admin command again, as currently we're failing to
         # settle this results in attempting to re-settle all 6 orders again.
         out = StringIO()
         call_command('settle', stdout=out)
         pprint(out.getvalue())
         self.assertIn('settled 6 orders', out.getvalue())
+
+        # Each run is recorded, and the second run resumed or restaged the same trades rather than staging them twice.
+        self.assertEqual(trade.models.SettlementRun.objects.count(), 2)
+        checkpoints = trade.models.SettlementCheckpoint.objects.filter(abandoned=False)
+        self.assertEqual(sum(checkpoint.staged_count for checkpoint in checkpoints), 6)
+        self.assertEqual(max(checkpoint.watermark for checkpoint in checkpoints),
+                         trade.models.Trade.objects.order_by('-id').first().id)
+
+    def test_trade_settle_errors(self):
+        """
+        Verify a trade that fails validation doesn't stop newer trades from being settled.
+        """
+        token1, xtn_wallet_id1, xlt_wallet_id1, xdt_wallet_id1, \
+        token2, xtn_wallet_id2, xlt_wallet_id2, xdt_wallet_id2 = order.utils.create_test_trading_wallets(
+            self, add_valid_xlt=True, add_valid_xtn=True)
+
+        cryptopair = 'XTN-XLT'
+        response = order.utils.place_order(self, token=token1, data=({
+            'side': 'buy',
+            'cryptopair': cryptopair,
+            'volume': 1200000,
+            'limit_price': 13800000000,
+        }))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Each market sell trades with part of the buy order.
+        def sell():
+            response = order.utils.place_order(self, token=token2, data=({
+                'side': 'sell',
+                'cryptopair': cryptopair,
+                'volume': 200000,
+            }))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            content = json.loads(response.content)
+            self.assertEqual(len(content['data']['trades']), 1)
+            return content['data']['trades'][0]['id']
+
+        # A trade that happens in the future fails validation.
+        error_trade_id = sell()
+        trade.models.Trade.objects.filter(id=error_trade_id).update(
+            created=timezone.now() + datetime.timedelta(days=1))
+        out = StringIO()
+        call_command('settle', stdout=out)
+        self.assertIn(': aborted', out.getvalue())
+        error_trade = trade.models.Trade.objects.get(id=error_trade_id)
+        self.assertIn(trade.models.SETTLED_ERROR, [error_trade.buy_order_settled_in, error_trade.buy_order_settled_out,
+                                                   error_trade.sell_order_settled_in,
+                                                   error_trade.sell_order_settled_out])
+        self.assertFalse(trade.models.SettlementCheckpoint.objects.filter(complete=False, abandoned=False).exists())
+
+        # The next run settles the new trade, leaving the error for review.
+        new_trade_id = sell()
+        out = StringIO()
+        call_command('settle', stdout=out)
+        self.assertNotIn('aborted', out.getvalue())
+        new_trade = trade.models.Trade.objects.get(id=new_trade_id)
+        for settled in [new_trade.buy_order_settled_in, new_trade.buy_order_settled_out, new_trade.sell_order_settled_in,
+                        new_trade.sell_order_settled_out]:
+            self.assertNotIn(settled, [trade.models.SETTLED_NONE, trade.models.SETTLED_ERROR])
+        error_trade.refresh_from_db()
+        self.assertIn(trade.models.SETTLED_ERROR, [error_trade.buy_order_settled_in, error_trade.buy_order_settled_out,
+                                                   error_trade.sell_order_settled_in,
+                                                   error_trade.sell_order_settled_out])
+
+
+class OrderBookTest(SimpleTestCase):
+    def test_price_time_priority(self):
+        """
+        Verify the in-memory orderbook walks resting orders in price-time-priority.
+
+        Market orders are always matched first. Buys are matched against the lowest sell prices, and sells are matched
+        against the highest buy prices, oldest first at each price. Only price levels crossing the limit price of the
+        incoming order are visited.
+        """
+        book = trade.orderbook.OrderBook('XTN-XLT')
+        sell1 = Order(cryptopair='XTN-XLT', side=False, limit_price=14100000000, volume=1000, open=True)
+        sell2 = Order(cryptopair='XTN-XLT', side=False, limit_price=14000000000, volume=1000, open=True)
+        sell3 = Order(cryptopair='XTN-XLT', side=False, limit_price=14100000000, volume=1000, open=True)
+        sell4 = Order(cryptopair='XTN-XLT', side=False, limit_price=14200000000, volume=1000, open=True)
+        market_sell = Order(cryptopair='XTN-XLT', side=False, limit_price=0, volume=1000, open=True)
+        buy1 = Order(cryptopair='XTN-XLT', side=True, limit_price=13900000000, volume=1000, open=True)
+        for resting_order in [sell1, sell2, sell3, sell4, market_sell, buy1]:
+            book.add(resting_order)
+
+        # A limit buy only visits the sell levels at or below its limit price.
+        limit_buy = Order(cryptopair='XTN-XLT', side=True, limit_price=14100000000, volume=5000, open=True)
+        self.assertEqual(list(book.matching_orders(limit_buy)), [market_sell, sell2, sell1, sell3])
+
+        # A market buy visits every sell level.
+        market_buy = Order(cryptopair='XTN-XLT', side=True, limit_price=0, volume=5000, open=True)
+        self.assertEqual(list(book.matching_orders(market_buy)), [market_sell, sell2, sell1, sell3, sell4])
+
+        # A limit sell above the best bid doesn't match anything.
+        limit_sell = Order(cryptopair='XTN-XLT', side=False, limit_price=14000000000, volume=5000, open=True)
+        self.assertEqual(list(book.matching_orders(limit_sell)), [])
+
+        # Filled orders leave the book, and empty price levels are removed.
+        sell2.open = False
+        book.update(sell2)
+        book.remove(market_sell)
+        self.assertEqual(list(book.matching_orders(market_buy)), [sell1, sell3, sell4])
+        self.assertEqual(book.prices[False], [14100000000, 14200000000])
+        self.assertEqual(book.next_price(True), 13900000000)
+
+    def test_snapshot(self):
+        """
+        Verify orderbook snapshots aggregate orders by price level, best prices first, and total market orders.
+        """
+        book = trade.orderbook.OrderBook('XTN-XLT')
+        for side, limit_price, volume in [(False, 14100000000, 1000), (False, 14000000000, 2000),
+                                          (False, 14100000000, 3000), (True, 13900000000, 4000),
+                                          (True, 13800000000, 5000), (True, 0, 6000), (True, 0, 7000)]:
+            book.add(Order(cryptopair='XTN-XLT', side=side, limit_price=limit_price, volume=volume, open=True))
+        snapshot = book.snapshot()
+        self.assertEqual(snapshot['l2'], {
+            'bids': [[13900000000, 4000], [13800000000, 5000]],
+            'asks': [[14000000000, 2000], [14100000000, 4000]],
+        })
+        self.assertEqual(snapshot['l3'], {
+            'bids': [[13900000000, 4000], [13800000000, 5000]],
+            'asks': [[14000000000, 2000], [14100000000, 1000], [14100000000, 3000]],
+        })
+        self.assertEqual(snapshot['market'], {'bids': 13000, 'asks': 0})
+
+        # The totals follow partial fills and removed orders.
+        resting_order = book.levels[False][14100000000][0]
+        resting_order.volume = 400
+        book.update(resting_order)
+        book.remove(book.levels[True][13800000000][0])
+        book.remove(book.market[True][0])
+        snapshot = book.snapshot()
+        self.assertEqual(snapshot['l2'], {
+            'bids': [[13900000000, 4000]],
+            'asks': [[14000000000, 2000], [14100000000, 3400]],
+        })
+        self.assertEqual(snapshot['market'], {'bids': 7000, 'asks': 0})
+
+    def test_deltas(self):
+        """
+        Verify orderbook deltas only include the price levels that changed, with a volume of 0 for removed levels.
+        """
+        previous = {
+            'bids': [[13900000000, 4000], [13800000000, 5000]],
+            'asks': [[14000000000, 2000], [14100000000, 4000]],
+        }
+        current = {
+            'bids': [[14000000000, 1000], [13900000000, 4000], [13800000000, 2500]],
+            'asks': [[14100000000, 4000]],
+        }
+        self.assertEqual(trade.orderbook.get_deltas(previous, current), {
+            'bids': [[14000000000, 1000], [13800000000, 2500]],
+            'asks': [[14000000000, 0]],
+        })
+        self.assertEqual(trade.orderbook.get_deltas(current, current), {'bids': [], 'asks': []})
+
+    def test_prune(self):
+        """
+        Verify expired orders are pruned from the resident orderbook.
+        """
+        book = trade.orderbook.OrderBook('XTN-XLT')
+        now = timezone.now()
+        expired = Order(cryptopair='XTN-XLT', side=True, limit_price=14000000000, volume=1000, open=True,
+                        timeinforce=now - datetime.timedelta(seconds=1))
+        good = Order(cryptopair='XTN-XLT', side=True, limit_price=14000000000, volume=1000, open=True,
+                     timeinforce=now + datetime.timedelta(seconds=60))
+        book.add(expired)
+        book.add(good)
+        self.assertEqual(book.prune(now=now), 1)
+        self.assertEqual(list(book.orders.values()), [good])
+        self.assertEqual(book.prune(now=now), 0)
+
+
+class TickerTest(SimpleTestCase):
+    def test_candles(self):
+        """
+        Verify trades are added up in candles aligned to their interval, and merged into saved candles.
+        """
+        start = datetime.datetime(2019, 1, 8, 14, 30, tzinfo=datetime.timezone.utc)
+        new_trades = []
+        for trade_id, seconds, price, volume in [(1, 5, 14000000000, 1000), (3, 40, 13900000000, 2000),
+                                                 (2, 20, 14100000000, 3000), (4, 70, 14200000000, 4000)]:
+            new_trades.append(trade.models.Trade(id=trade_id, cryptopair='XTN-XLT', price=price, volume=volume,
+                                                 base_volume=volume // 100,
+                                                 created=start + datetime.timedelta(seconds=seconds)))
+        candles = trade.ticker.get_candles(new_trades, '1m')
+        self.assertEqual(candles, {
+            ('XTN-XLT', start): {'open': 14000000000, 'high': 14100000000, 'low': 13900000000,
+                                 'close': 13900000000, 'volume': 6000, 'base_volume': 60, 'trades': 3,
+                                 'last_trade': 3},
+            ('XTN-XLT', start + datetime.timedelta(minutes=1)): {
+                'open': 14200000000, 'high': 14200000000, 'low': 14200000000, 'close': 14200000000,
+                'volume': 4000, 'base_volume': 40, 'trades': 1, 'last_trade': 4},
+        })
+
+        saved = trade.models.Candle(cryptopair='XTN-XLT', interval='1m', start=start)
+        trade.ticker.merge_candle(saved, candles[('XTN-XLT', start)])
+        trade.ticker.merge_candle(saved, {'open': 13800000000, 'high': 13800000000, 'low': 13800000000,
+                                          'close': 13800000000, 'volume': 500, 'base_volume': 5, 'trades': 1,
+                                          'last_trade': 5})
+        self.assertEqual([saved.open, saved.high, saved.low, saved.close, saved.volume, saved.base_volume,
+                          saved.trades, saved.last_trade],
+                         [14000000000, 14100000000, 13800000000, 13800000000, 6500, 65, 4, 5])
+
+        # The same trades all fall in one hourly candle.
+        self.assertEqual(trade.ticker.get_candles(new_trades, '1h'), {
+            ('XTN-XLT', start - datetime.timedelta(minutes=30)): {
+                'open': 14000000000, 'high': 14200000000, 'low': 13900000000, 'close': 14200000000,
+                'volume': 10000, 'base_volume': 100, 'trades': 4, 'last_trade': 4},
+        })
+
+
+        # Candles are aligned to their interval.
+        timestamp = datetime.datetime(2019, 1, 8, 14, 37, 12, tzinfo=datetime.timezone.utc)
+        self.assertEqual(trade.ticker.get_candle_start(timestamp, trade.ticker.CANDLE_INTERVALS['5m']),
+                         datetime.datetime(2019, 1, 8, 14, 35, tzinfo=datetime.timezone.utc))
+        self.assertEqual(trade.ticker.get_candle_start(timestamp, trade.ticker.CANDLE_INTERVALS['1d']),
+                         datetime.datetime(2019, 1, 8, tzinfo=datetime.timezone.utc))
+
+
+class TickerWindowTest(TestCase):
+    def test_ticker_candles(self):
+        """
+        Verify the ticker adds up hourly candles for the hours entirely in the last 24 hours, and minute candles for
+        the rest of the window.
+        """
+        now = datetime.datetime(2019, 1, 8, 14, 30, 20, tzinfo=datetime.timezone.utc)
+        yesterday = datetime.datetime(2019, 1, 7, tzinfo=datetime.timezone.utc)
+        today = datetime.datetime(2019, 1, 8, tzinfo=datetime.timezone.utc)
+        for interval, start, price, volume in [
+                # Before the window.
+                ('1m', yesterday + datetime.timedelta(hours=14, minutes=30), 10000000000, 1000),
+                ('1h', yesterday + datetime.timedelta(hours=14), 10000000000, 3000),
+                # The first minutes of the window, then the hours entirely in it.
+                ('1m', yesterday + datetime.timedelta(hours=14, minutes=31), 14000000000, 2000),
+                ('1h', yesterday + datetime.timedelta(hours=15), 14100000000, 4000),
+                ('1h', today + datetime.timedelta(hours=13), 13900000000, 8000),
+                # Already added up in the hourly candles.
+                ('1m', yesterday + datetime.timedelta(hours=15), 14100000000, 4000),
+                # The last minutes of the window.
+                ('1h', today + datetime.timedelta(hours=14), 14200000000, 16000),
+                ('1m', today + datetime.timedelta(hours=14, minutes=30), 14200000000, 16000)]:
+            trade.models.Candle.objects.create(cryptopair='XTN-XLT', interval=interval, start=start, open=price,
+                                               high=price, low=price, close=price, volume=volume,
+                                               base_volume=volume // 100, trades=1)
+
+        self.assertEqual(trade.ticker.get_ticker_candles('XTN-XLT', now).count(), 4)
+        self.assertEqual(trade.ticker.get_ticker('XTN-XLT', now=now), {
+            'open': 14000000000,
+            'high': 14200000000,
+            'low': 13900000000,
+            'vwap': 10000000000,
+            'volume': 30000,
+            'base_volume': 300,
+        })
+
+
+class PlanTransactionsTest(SimpleTestCase):
+    def test_plan_transactions(self):
+        """
+        Verify settlement is split into transactions within the input limit, splitting an output across transactions
+        when needed, with each transaction's network fee paid from what remains for the exchange.
+        """
+        inputs = [{'txid': 'tx%d' % index, 'vout': 0, 'address': 'input%d' % index, 'value': 100000, 'type': 'p2pkh'}
+                  for index in range(3)]
+        outputs = [['output1', 120000, 'p2pkh'], ['output2', 150000, 'p2pkh']]
+        transactions = settle.plan_transactions(inputs=inputs, outputs=outputs, exchange_address='exchange',
+                                                exchange_type='p2pkh', fee_rate=1000, max_vsize=90000, max_inputs=2,
+                                                max_outputs=1000)
+        self.assertEqual(len(transactions), 2)
+        self.assertEqual([len(planned['inputs']) for planned in transactions], [2, 1])
+        # output2 is split across both transactions.
+        self.assertEqual(transactions[0]['outputs'], {'output1': 120000, 'output2': 79626})
+        self.assertEqual(transactions[1]['outputs'], {'output2': 70374, 'exchange': 29400})
+        for planned in transactions:
+            self.assertEqual(planned['fee'], planned['vsize'])
+            self.assertEqual(sum(detail['value'] for detail in planned['inputs']),
+                             sum(planned['outputs'].values()) + planned['fee'])
+
+        # Without the input limit, everything fits in a single transaction.
+        transactions = settle.plan_transactions(inputs=inputs, outputs=outputs, exchange_address='exchange',
+                                                exchange_type='p2pkh', fee_rate=1000, max_vsize=90000, max_inputs=500,
+                                                max_outputs=1000)
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0]['outputs'], {'output1': 120000, 'output2': 150000, 'exchange': 29444})
+
+        # The inputs can't cover the outputs and network fees.
+        self.assertIsNone(settle.plan_transactions(inputs=inputs, outputs=[['output1', 300000, 'p2pkh']],
+                                                   exchange_address='exchange', exchange_type='p2pkh',
+                                                   fee_rate=1000, max_vsize=90000, max_inputs=500, max_outputs=1000))
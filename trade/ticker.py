@@ -0,0 +1,157 @@
+import datetime
+
+from django.db import transaction
+from django.db.models import Max, Min, Q, Sum
+from django.utils import timezone
+
+from trade.models import Candle
+
+
+# Trades are added up in candles as they're made, one per cryptopair per interval, so market statistics never need to
+# read the trades themselves. The length of each candle interval, in seconds:
+CANDLE_INTERVALS = {
+    '1m': 60,
+    '5m': 5 * 60,
+    '15m': 15 * 60,
+    '1h': 60 * 60,
+    '1d': 24 * 60 * 60,
+}
+
+# The ticker reports the trades of the last 24 hours, to the minute.
+TICKER_WINDOW = 24 * 60 * 60
+
+CANDLE_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'base_volume', 'trades', 'last_trade', 'modified']
+
+# Returns when the candle including timestamp starts, intervals are aligned to the epoch (so daily candles start at
+# midnight UTC).
+def get_candle_start(timestamp, seconds):
+    epoch = int(timestamp.timestamp())
+    return datetime.datetime.fromtimestamp(epoch - epoch % seconds, datetime.timezone.utc)
+
+# Add up trades in candles of the given interval, returns the candles indexed by (cryptopair, start).
+def get_candles(new_trades, interval):
+    seconds = CANDLE_INTERVALS[interval]
+    candles = {}
+    for new_trade in sorted(new_trades, key=lambda each: each.id):
+        key = (new_trade.cryptopair, get_candle_start(new_trade.created, seconds))
+        candle = candles.get(key)
+        if candle is None:
+            candles[key] = {
+                'open': new_trade.price,
+                'high': new_trade.price,
+                'low': new_trade.price,
+                'close': new_trade.price,
+                'volume': new_trade.volume,
+                'base_volume': new_trade.base_volume,
+                'trades': 1,
+                'last_trade': new_trade.id,
+            }
+            continue
+        candle['high'] = max(candle['high'], new_trade.price)
+        candle['low'] = min(candle['low'], new_trade.price)
+        candle['close'] = new_trade.price
+        candle['volume'] += new_trade.volume
+        candle['base_volume'] += new_trade.base_volume
+        candle['trades'] += 1
+        candle['last_trade'] = new_trade.id
+    return candles
+
+# Add the trades of a candle (as returned by get_candles) to a saved candle.
+def merge_candle(saved, candle):
+    if not saved.trades:
+        saved.open = candle['open']
+        saved.high = candle['high']
+        saved.low = candle['low']
+    else:
+        saved.high = max(saved.high, candle['high'])
+        saved.low = min(saved.low, candle['low'])
+    if candle['last_trade'] > saved.last_trade:
+        saved.close = candle['close']
+        saved.last_trade = candle['last_trade']
+    saved.volume += candle['volume']
+    saved.base_volume += candle['base_volume']
+    saved.trades += candle['trades']
+
+# Add new trades to their candles, in the transaction saving the trades.
+def add_trades(new_trades):
+    if not new_trades:
+        return
+
+    assert(transaction.get_connection().in_atomic_block)
+    candles = {}
+    for interval in CANDLE_INTERVALS:
+        for (cryptopair, start), candle in get_candles(new_trades, interval).items():
+            candles[(cryptopair, interval, start)] = candle
+    Candle.objects.bulk_create([Candle(cryptopair=cryptopair, interval=interval, start=start)
+                                for cryptopair, interval, start in candles], ignore_conflicts=True)
+
+    now = timezone.now()
+    # Lock the candles in a consistent order so concurrent updates can't deadlock. This can also select candles of
+    # another interval starting at the same time, they're locked but left as they are.
+    saved_candles = []
+    for saved in Candle.objects.select_for_update() \
+            .filter(cryptopair__in=set(key[0] for key in candles), interval__in=set(key[1] for key in candles),
+                    start__in=set(key[2] for key in candles)) \
+            .order_by('cryptopair', 'interval', 'start'):
+        candle = candles.get((saved.cryptopair, saved.interval, saved.start))
+        if candle is not None:
+            merge_candle(saved, candle)
+            saved.modified = now
+            saved_candles.append(saved)
+    Candle.objects.bulk_update(saved_candles, CANDLE_FIELDS)
+
+# Returns the candles adding up to the ticker window: hourly candles for the hours entirely in the window, and minute
+# candles for the minutes before the first and after the last of these hours. That's at most 24 hourly and 60 minute
+# candles, however many trades were made.
+def get_ticker_candles(cryptopair, now):
+    until = get_candle_start(now, CANDLE_INTERVALS['1m']) + datetime.timedelta(seconds=CANDLE_INTERVALS['1m'])
+    since = until - datetime.timedelta(seconds=TICKER_WINDOW)
+    first_hour = get_candle_start(since + datetime.timedelta(seconds=CANDLE_INTERVALS['1h'] - 1),
+                                  CANDLE_INTERVALS['1h'])
+    last_hour = get_candle_start(until, CANDLE_INTERVALS['1h'])
+    return Candle.objects.filter(cryptopair=cryptopair).filter(
+        Q(interval='1h', start__gte=first_hour, start__lt=last_hour) |
+        Q(interval='1m', start__gte=since, start__lt=first_hour) |
+        Q(interval='1m', start__gte=last_hour, start__lt=until))
+
+# Returns the trading statistics of a cryptopair over the ticker window.
+def get_ticker(cryptopair, now=None):
+    if now is None:
+        now = timezone.now()
+    candles = get_ticker_candles(cryptopair, now)
+    totals = candles.aggregate(Sum('volume'), Sum('base_volume'), Max('high'), Min('low'))
+    volume = totals['volume__sum'] or 0
+    base_volume = totals['base_volume__sum'] or 0
+    if base_volume:
+        # The volume weighted average price.
+        vwap = int(volume * 100000000 / base_volume)
+    else:
+        vwap = None
+    return {
+        # The candles don't overlap, so the earliest has the first trade of the window.
+        'open': candles.order_by('start').values_list('open', flat=True).first(),
+        'high': totals['high__max'],
+        'low': totals['low__min'],
+        'vwap': vwap,
+        'volume': volume,
+        'base_volume': base_volume,
+    }
+
+# Returns up to limit candles of a cryptopair, oldest first: the first starting at or after since (a datetime), or the
+# latest if since is None. Intervals without trades have no candle.
+def get_ohlcv(cryptopair, interval, since=None, limit=500):
+    candles = Candle.objects.filter(cryptopair=cryptopair, interval=interval)
+    if since is not None:
+        candles = candles.filter(start__gte=since).order_by('start')[:limit]
+    else:
+        candles = reversed(list(candles.order_by('-start')[:limit]))
+    return [{
+        'timestamp': candle.start.timestamp(),
+        'open': candle.open,
+        'high': candle.high,
+        'low': candle.low,
+        'close': candle.close,
+        'volume': candle.volume,
+        'base_volume': candle.base_volume,
+        'trades': candle.trades,
+    } for candle in candles]
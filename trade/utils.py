@@ -1,29 +1,32 @@
 import datetime
 import time
 
+from django.db import transaction
 from django.forms.models import model_to_dict
 from django.urls import reverse
 from django.utils import timezone
 
 import trade.models
+import trade.orderbook
+import trade.ticker
 from order.models import Order
 import order.utils
 import reporting.utils
 import spauser.utils
+import wallet.ledger
 
 
 def convert_quote_to_base(volume, price):
     return int(volume / price * 100000000)
 
 # The matching engine, look for another existing order that matches with this order to fulfill a trade.
-def match_order(identifiers, order_to_match):
+def match_order(identifiers, order_to_match, book):
     trades = []
 
     # Match the opposite side of the order:
     to_match_side = not order_to_match.side
 
-    # Start by matching Market orders.
-    reporting.utils.audit(message="matching with market orders", details={
+    reporting.utils.audit(message="matching with orderbook", details={
         'identifiers': identifiers,
         'order': order_to_match,
         'to_match_side': to_match_side,
@@ -38,91 +41,111 @@ def match_order(identifiers, order_to_match):
     # 50 shares of the same stock at the same price, the system must match the entire 200-share order to one or more
     # sell orders before beginning to match any portion of the 50-share order."
 
-    # We match with a basic price-time-priority (FIFO) algorithm, staring with oldest orders first. In this case, we're
-    # matching against open market orders (those with a limit_price of 0) on the other side, so we only sort by the
-    # created timestamp.
-    for market_order in Order.objects.filter(side=to_match_side, cryptopair=order_to_match.cryptopair, open=True,
-                                             limit_price=0).order_by('created'):
-        trade, done, valid = make_trade(identifiers=identifiers, order1=order_to_match, order2=market_order)
+    # We match with a basic price-time-priority (FIFO) algorithm against the orderbook for this cryptopair, which the
+    # caller holds locked (see trade.orderbook). We start with open market orders (those with a limit_price of 0) on the
+    # other side, oldest first. We then move on to limit orders: for sells, we match the highest buys first, for buys,
+    # we match the lowest sells first. If there are multiple matches at the same price, we match the oldest order first.
+    # A sell order specifies the minimum accepted price and a buy order the maximum price willing to pay; market orders
+    # match all price levels.
+
+    # Fills are collected in memory, then all written together in a single transaction.
+    fills = []
+    done = False
+    for resting_order in book.matching_orders(order_to_match):
+        if fills:
+            last_price = fills[-1]['trade'].price
+        else:
+            last_price = None
+        new_trade, done, valid = make_trade(identifiers=identifiers, order1=order_to_match, order2=resting_order,
+                                            book=book, last_price=last_price)
+        book.update(resting_order)
         if valid:
-            trades.append(trade)
-            reporting.utils.audit(message="matched with existing market order", details={
-                'identifiers': identifiers,
-                'trade': trade,
+            fills.append({
+                'trade': new_trade,
+                'new_order': model_to_dict(order_to_match),
+                'matched_order': model_to_dict(resting_order),
+                'resting_order': resting_order,
+                'market_order': not resting_order.limit_price,
             })
         if done:
-            return trades
+            break
 
-    reporting.utils.audit(message="matching with limit orders", details={
-        'identifiers': identifiers,
-        'order': order_to_match,
-        'to_match_side': to_match_side,
-        'trades': trades,
-        'matching_algorithm': 'basic FIFO',
-    })
+    if fills:
+        try:
+            save_fills(order_to_match=order_to_match, fills=fills, book=book)
+        except:
+            # The orders in the book were updated but not saved, reload the book from the database.
+            trade.orderbook.discard_orderbook(order_to_match.cryptopair)
+            raise
+
+    if not done:
+        # The order was not completely filled, it now rests in the orderbook.
+        book.add(order_to_match)
+
+    for fill in fills:
+        new_trade = fill['trade']
+        new_trade_dict = model_to_dict(new_trade)
+        new_trade_dict['id'] = new_trade.id
+        trades.append(new_trade_dict)
+
+        reporting.utils.audit(message="created trade", details={
+            'identifiers': identifiers,
+            'new_trade_dict': new_trade_dict,
+        })
+        reporting.utils.audit(message="updated traded orders", details={
+            'identifiers': identifiers,
+            'new_trade_dict': new_trade_dict,
+            'new_order': fill['new_order'],
+            'matched_order': fill['matched_order'],
+        })
+        reporting.utils.audit(message="matched with resting order", details={
+            'identifiers': identifiers,
+            'order': order_to_match,
+            'market_order': fill['market_order'],
+            'trade': new_trade_dict,
+        })
+
+        data = {
+            'recipient': None,
+            'type': 'trade',
+            'data': {
+                'symbol': new_trade.cryptopair,
+                'timestamp': new_trade.buy_order.created.replace(tzinfo=datetime.timezone.utc).timestamp(),
+                'base': {
+                    'symbol': new_trade.sell_order.base_currency,
+                    'volume': new_trade.base_volume,
+                },
+                'quote': {
+                    'symbol': new_trade.sell_order.quote_currency,
+                    'price': new_trade.price,
+                    'volume': new_trade.volume,
+                },
+            },
+            'timestamp': time.time(),
+        }
+        reporting.utils.notify_middleware(data)
 
-    # There are no more market orders to match, now we move on to limit orders. We continue using a basic price-time-
-    # priority (FIFO) algorithm. For sells, we match the highest buys first. For buys, we match the lowest sells first.
-    # If there are multiple matches at the same price, we match the oldest order first.
-    if order_to_match.side is not True:
-        # A sell order (side == False) specifies the minimum accepted price, match against the highest buy orders that
-        # are equal to or greater than this minimum price. (In the case of a market order, the order.limit_price will
-        # be 0, and will therfore match _ALL_ open sell orders.)
-        for buy_order in Order.objects.filter(side=to_match_side, cryptopair=order_to_match.cryptopair, open=True,
-                                              limit_price__gte=order_to_match.limit_price).order_by('-limit_price',
-                                                                                                    'created'):
-            # to_match_side is True (we're matching buys), and the bid must be greater or equal to our minimum
-            # accepted price. Sort by limit_price descending, so we match the highest buy bids first.
-            trade, done, valid = make_trade(identifiers=identifiers, order1=order_to_match, order2=buy_order)
-            if valid:
-                trades.append(trade)
-                reporting.utils.audit(message="sell matched with limit buy order", details={
-                    'identifiers': identifiers,
-                    'order': order_to_match,
-                    'trade': trade,
-                })
-            if done:
-                return trades
-    else:
-        assert(order_to_match.side is True)
-        # A buy order (side is True) limit_price specifies the maximum price willing to pay, match against the lowest
-        # sell orders that are equal to or less than this maximum price.
-        if order_to_match.limit_price:
-            for sell_order in Order.objects.filter(side=to_match_side, cryptopair=order_to_match.cryptopair, open=True,
-                                                   limit_price__lte=order_to_match.limit_price) \
-                    .order_by('-limit_price', 'created'):
-                # to_match_side is False (we're matching sells), and the bid must be less than or equal to our minimum
-                # accepted price. Sort by limit_price ascending so we match the lowest sell bids first.
-                trade, done, valid = make_trade(identifiers=identifiers, order1=order_to_match, order2=sell_order)
-                if valid:
-                    trades.append(trade)
-                    reporting.utils.audit(message="limit buy matched with limit sell order", details={
-                        'identifiers': identifiers,
-                        'order': order_to_match,
-                        'trade': trade,
-                    })
-                if done:
-                    return trades
-        else:
-            # This order has no limit_price, so it is a market order. There is no maximum price willing to pay, match
-            # against all sell orders.
-            for sell_order in Order.objects.filter(side=to_match_side, cryptopair=order_to_match.cryptopair,
-                                                   open=True).order_by('-limit_price', 'created'):
-                # to_match_side is False (we're matching sells). Sort by limit_price ascending so we match the lowest
-                # sell bids first.
-                trade, done, valid = make_trade(identifiers=identifiers, order1=order_to_match, order2=sell_order)
-                if valid:
-                    trades.append(trade)
-                    reporting.utils.audit(message="marke buy matched with limit sell order", details={
-                        'identifiers': identifiers,
-                        'order': order_to_match,
-                        'trade': trade,
-                    })
-                if done:
-                    return trades
     return trades
 
-def make_trade(identifiers, order1, order2):
+# Write all trades made by an order, and all orders they filled, in one transaction with a constant number of queries.
+def save_fills(order_to_match, fills, book):
+    now = timezone.now()
+    orders = [order_to_match]
+    for fill in fills:
+        orders.append(fill['resting_order'])
+    for filled_order in orders:
+        # bulk_update() doesn't update auto_now fields.
+        filled_order.modified = now
+
+    with transaction.atomic():
+        trade.models.Trade.objects.bulk_create([fill['trade'] for fill in fills])
+        trade.ticker.add_trades([fill['trade'] for fill in fills])
+        Order.objects.bulk_update(orders, ['volume', 'open', 'filled', 'modified'])
+        wallet.ledger.trades_made(new_trades=[fill['trade'] for fill in fills], wallet_users=book.wallet_users)
+
+# Make a trade between an incoming order (order1) and a resting order (order2) from the book. The trade and the
+# updated orders are not saved: match_order() saves all the trades made by an order at once.
+def make_trade(identifiers, order1, order2, book, last_price=None):
     assert(order1.side != order2.side)
 
     if order1.side is True:
@@ -138,9 +161,7 @@ def make_trade(identifiers, order1, order2):
     }
 
     # Be sure the orders aren't owned by the same users.
-    order1_user = order1.wallet.user.get()
-    order2_user = order2.wallet.user.get()
-    if order1_user.id == order2_user.id:
+    if book.wallet_user_id(order1) == book.wallet_user_id(order2):
         # this is a buy and a sell by the same user, do not make the trade
         reporting.utils.audit(message="buy and sell are from same wallet", details={
             'identifiers': identifiers,
@@ -169,8 +190,12 @@ def make_trade(identifiers, order1, order2):
     # Otherwise both sides of the order are market orders, so we use use the price of the last trade:
     else:
         try:
-            last_trade, = trade.models.Trade.objects.filter(cryptopair=order1.cryptopair).order_by('-id')[:1]
-            price = last_trade.price
+            if last_price:
+                # This order already traded, but the trade isn't saved yet.
+                price = last_price
+            else:
+                last_trade, = trade.models.Trade.objects.filter(cryptopair=order1.cryptopair).order_by('-id')[:1]
+                price = last_trade.price
             price_match = 'c'
 
             # Sanity test: be sure we didn't match a buy with too expensive a sell order.
@@ -240,8 +265,6 @@ def make_trade(identifiers, order1, order2):
     buy_order_fee = order.utils.get_fee(order=buy_order, volume=volume)
     sell_order_fee = order.utils.get_fee(order=sell_order, volume=volume)
 
-    # @TODO: Grab the per-user lock for the matched trade
-
     new_trade = trade.models.Trade(
         buy_order=buy_order,
         buy_order_settled_in=trade.models.SETTLED_NONE,
@@ -256,36 +279,6 @@ def make_trade(identifiers, order1, order2):
         buy_fee=buy_order_fee,
         sell_fee=sell_order_fee,
     )
-    # .save() has no return value, so we run it after creating a new trade
-    new_trade.save()
-    new_trade_dict = model_to_dict(new_trade)
-    new_trade_dict['id'] = new_trade.id
-
-    reporting.utils.audit(message="created trade", details={
-        'identifiers': identifiers,
-        'orders': orders,
-        'new_trade_dict': new_trade_dict,
-    })
-
-    data = {
-        'recipient': None,
-        'type': 'trade',
-        'data': {
-            'symbol': new_trade.cryptopair,
-            'timestamp': new_trade.buy_order.created.replace(tzinfo=datetime.timezone.utc).timestamp(),
-            'base': {
-                'symbol': new_trade.sell_order.base_currency,
-                'volume': new_trade.base_volume,
-            },
-            'quote': {
-                'symbol': new_trade.sell_order.quote_currency,
-                'price': new_trade.price,
-                'volume': new_trade.volume,
-            },
-        },
-        'timestamp': time.time(),
-    }
-    reporting.utils.notify_middleware(data)
 
     order1.filled += 1
     if completely_filled1:
@@ -294,26 +287,14 @@ def make_trade(identifiers, order1, order2):
     else:
         order1.volume -= volume
         done = False
-    order1.save()
 
     order2.filled += 1
     if completely_filled2:
         order2.open = False
     else:
         order2.volume -= volume
-    order2.save()
-
-    order1_dict = model_to_dict(order1)
-    order2_dict = model_to_dict(order2)
-    reporting.utils.audit(message="updated traded orders", details={
-        'identifiers': identifiers,
-        'orders': orders,
-        'new_trade_dict': new_trade_dict,
-        'new_order': order1_dict,
-        'matched_order': order2_dict,
-    })
 
-    return new_trade_dict, done, True
+    return new_trade, done, True
 
 # Helper to invoke /api/trade/history/ endpoint from a test.
 def trade_history(self, token=None, data={}, offset=None, limit=None):
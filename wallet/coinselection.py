@@ -0,0 +1,206 @@
+import math
+
+from django.conf import settings
+from rest_framework import status
+
+import blockchain.utils
+import wallet.utils
+from address.models import Address
+
+
+# Coin selection picks which of a wallet's unspent outputs fund a transaction. The wallet's unspent outputs are loaded
+# once from the unspent cache (see blockchain.utils.get_unspent), then selected in memory. Each unspent output is a
+# dictionary with its txid, vout, address, value and address type.
+
+# Load all the unspent outputs of a wallet, returns (unspent, True), or (error, status code) if an address couldn't be
+# queried.
+def get_wallet_unspent(user_wallet):
+    address_types = {}
+    for p2pkh, p2sh_p2wpkh, bech32 in Address.objects.filter(wallet=user_wallet.id).order_by('created') \
+            .values_list('p2pkh', 'p2sh_p2wpkh', 'bech32'):
+        for an_address, address_type in [(p2pkh, 'p2pkh'), (p2sh_p2wpkh, 'p2sh_p2wpkh'), (bech32, 'bech32')]:
+            if an_address:
+                address_types[an_address] = address_type
+
+    unspent = []
+    fetched = blockchain.utils.get_unspent(coin=settings.COINS[user_wallet.currencycode]['name'],
+                                           addresses=address_types.keys())
+    for an_address, address_type in address_types.items():
+        status_code, addressapi = fetched[an_address]
+        if status_code is None:
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            return {
+                'status': 'fail',
+                'code': status_code,
+                'debug': {
+                    'address': an_address,
+                    'error': addressapi,
+                }
+            }, status_code
+
+        # 'unspent' is only set if the address was found in the blockchain (ie, it's received funds)
+        if not isinstance(addressapi, dict) or 'unspent' not in addressapi.get('data', {}):
+            continue
+        for txid in addressapi['data']['unspent']:
+            for vout in addressapi['data']['unspent'][txid]:
+                if vout != 'height':
+                    unspent.append({
+                        'txid': txid,
+                        'vout': int(vout),
+                        'address': an_address,
+                        'value': addressapi['data']['unspent'][txid][vout],
+                        'type': address_type,
+                    })
+    return unspent, True
+
+# Search for a set of unspent outputs with a total of at least value_needed, and no more than value_needed plus
+# tolerance, so the transaction doesn't need change. Unspent outputs are explored largest first, each either included
+# or excluded, abandoning a branch as soon as it overshoots or can't reach value_needed. Returns the selection wasting
+# the least, or None if none is found within max_tries steps.
+def select_branch_and_bound(unspent, value_needed, tolerance, max_tries):
+    candidates = sorted(unspent, key=lambda detail: detail['value'], reverse=True)
+    # The total of the candidates not yet included or excluded.
+    remaining = sum(detail['value'] for detail in candidates)
+    if remaining < value_needed:
+        return None
+
+    selection = []
+    total = 0
+    best = None
+    best_waste = None
+    for tries in range(max_tries):
+        backtrack = False
+        if total + remaining < value_needed or total > value_needed + tolerance:
+            backtrack = True
+        elif total >= value_needed:
+            waste = total - value_needed
+            if best is None or waste < best_waste:
+                best = list(selection)
+                best_waste = waste
+                if waste == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            # Walk back past the candidates we excluded, to the last one we included, and exclude it instead.
+            while selection and not selection[-1]:
+                selection.pop()
+                remaining += candidates[len(selection)]['value']
+            if not selection:
+                break
+            selection[-1] = False
+            total -= candidates[len(selection) - 1]['value']
+        else:
+            remaining -= candidates[len(selection)]['value']
+            total += candidates[len(selection)]['value']
+            selection.append(True)
+
+    if best is None:
+        return None
+    return [detail for detail, included in zip(candidates, best) if included]
+
+# Spend the largest unspent outputs first, using as few inputs as possible.
+def select_largest_first(unspent, value_needed):
+    selected = []
+    total = 0
+    for detail in sorted(unspent, key=lambda detail: detail['value'], reverse=True):
+        if total >= value_needed:
+            break
+        selected.append(detail)
+        total += detail['value']
+    if total < value_needed:
+        return None
+    return selected
+
+# Spend the smallest unspent outputs first, consolidating them while fees are low.
+def select_smallest_first(unspent, value_needed):
+    selected = []
+    total = 0
+    for detail in sorted(unspent, key=lambda detail: detail['value']):
+        if total >= value_needed:
+            break
+        selected.append(detail)
+        total += detail['value']
+    if total < value_needed:
+        return None
+    return selected
+
+# Choose between the smallest single unspent output covering value_needed, and the largest first selection of the
+# smaller unspent outputs, whichever has the least change.
+def select_knapsack(unspent, value_needed):
+    larger = [detail for detail in unspent if detail['value'] >= value_needed]
+    smaller = [detail for detail in unspent if detail['value'] < value_needed]
+    lowest_larger = None
+    if larger:
+        lowest_larger = [min(larger, key=lambda detail: detail['value'])]
+
+    selected = select_largest_first(smaller, value_needed)
+    if selected is None:
+        return lowest_larger
+    # Drop any inputs we no longer need, now that the larger inputs have been added.
+    for detail in sorted(selected, key=lambda detail: detail['value']):
+        if sum(each['value'] for each in selected) - detail['value'] >= value_needed:
+            selected.remove(detail)
+    if lowest_larger is not None and lowest_larger[0]['value'] <= sum(detail['value'] for detail in selected):
+        return lowest_larger
+    return selected
+
+# Select unspent outputs totaling at least value_needed, using the strategy configured in COIN_SELECTION. Returns the
+# selected unspent outputs, or None if there aren't enough funds.
+def select_unspent(unspent, value_needed, strategy=None):
+    if strategy is None:
+        strategy = settings.COIN_SELECTION['strategy']
+
+    if strategy == 'consolidate':
+        return select_smallest_first(unspent, value_needed)
+
+    assert(strategy == 'minimize_fee')
+    selected = select_branch_and_bound(unspent, value_needed, tolerance=settings.COIN_SELECTION['change_tolerance'],
+                                       max_tries=settings.COIN_SELECTION['max_tries'])
+    if selected is not None:
+        return selected
+    if settings.COIN_SELECTION['fallback'] == 'largest_first':
+        return select_largest_first(unspent, value_needed)
+    return select_knapsack(unspent, value_needed)
+
+# Select unspent outputs paying value_needed to outputs of the given address types, plus the network fee at fee_rate
+# satoshi per kilobyte. Each unspent output is valued at what it adds after paying for its own input, so the fee is
+# known as soon as the inputs are selected. Returns (selected, vsize, fee, change), where change is 0 if the
+# transaction has no change output, or None if there aren't enough funds.
+def select_unspent_with_fee(unspent, value_needed, output_types, fee_rate, change_type='p2pkh', strategy=None):
+    def get_fee(vsize):
+        return int(math.ceil(vsize * fee_rate / 1000))
+
+    candidates = []
+    for detail in unspent:
+        effective_value = detail['value'] - get_fee(wallet.utils.INPUT_VSIZE[detail['type']])
+        # Unspent outputs worth less than the fee to spend them are left for when fees are lower.
+        if effective_value > 0:
+            candidates.append({'value': effective_value, 'detail': detail})
+
+    change_fee = get_fee(wallet.utils.OUTPUT_VSIZE[change_type])
+    change_tolerance = settings.COIN_SELECTION['change_tolerance']
+    # The size of the transaction without its inputs is known up front. The input count and segwit marker can add a few
+    # bytes, if they're not covered we try again asking for that much more.
+    shortfall = 0
+    while True:
+        target = value_needed + get_fee(wallet.utils.estimate_transaction_vsize([], output_types)) + shortfall
+        selected = select_unspent(candidates, target, strategy=strategy)
+        if selected is None:
+            return None
+        selected = [candidate['detail'] for candidate in selected]
+        total = sum(detail['value'] for detail in selected)
+        input_types = [detail['type'] for detail in selected]
+
+        vsize = wallet.utils.estimate_transaction_vsize(input_types, output_types)
+        fee = get_fee(vsize)
+        if total - value_needed - fee < 0:
+            shortfall += value_needed + fee - total
+            continue
+        if total - value_needed - fee <= change_tolerance + change_fee:
+            # Change isn't worth an output, the difference is paid as fee.
+            return selected, vsize, total - value_needed, 0
+
+        vsize = wallet.utils.estimate_transaction_vsize(input_types, output_types + [change_type])
+        fee = get_fee(vsize)
+        return selected, vsize, fee, total - value_needed - fee
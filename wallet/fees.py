@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+from django.conf import settings
+
+import wallet.utils
+
+
+# Returns True if a coin has a daemon configured for RPC requests.
+def has_daemon(currencycode):
+    coin = settings.COINS.get(currencycode, {})
+    return bool(coin.get('server') and coin.get('rpcauth'))
+
+class FeeOracle:
+    '''
+    Serves fee rates from memory, so sends and settlement don't wait on daemon RPCs. A background thread refreshes the
+    mempool minimum fee rate and the smart fee rates for the targets in FEE_ORACLE of each coin this process has asked
+    for, if the coin has a daemon configured. Each rate is stored with the time it was fetched, a rate older than
+    FEE_ORACLE['max_age'] (or one never fetched) is fetched live. If the daemon can't be queried, the last rate fetched
+    is used however old it is.
+    '''
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        # The coins refreshed in the background: those with a daemon that fee rates were asked for in this process.
+        self.currencycodes = set()
+        # The coins whose last refresh failed, so each failure is only reported once.
+        self.failing = set()
+        # {currencycode: (fee rate, fetched)}
+        self.minimum_fee_rates = {}
+        # {(currencycode, number_of_blocks, estimate_mode): (fee rate, fetched)}
+        self.smart_fee_rates = {}
+
+    # The refresh thread is started on first use in each process, as threads don't survive gunicorn forking workers.
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.minimum_fee_rates = {}
+            self.smart_fee_rates = {}
+            self.currencycodes = set()
+            self.failing = set()
+            if settings.FEE_ORACLE['background']:
+                refresher = threading.Thread(target=self.run, name='fee-oracle')
+                refresher.daemon = True
+                refresher.start()
+            self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            time.sleep(settings.FEE_ORACLE['interval'])
+            for currencycode in list(self.currencycodes):
+                try:
+                    self.refresh(currencycode)
+                except Exception as e:
+                    if currencycode not in self.failing:
+                        print("Failed to refresh %s fee rates: %s" % (currencycode, e))
+                        self.failing.add(currencycode)
+                    continue
+                if currencycode in self.failing:
+                    print("Refreshed %s fee rates" % currencycode)
+                    self.failing.discard(currencycode)
+
+    def refresh(self, currencycode):
+        self.minimum_fee_rates[currencycode] = (wallet.utils.fetch_minimum_fee_rate(currencycode=currencycode),
+                                                time.time())
+        targets = [(number_of_blocks, estimate_mode) for number_of_blocks in settings.FEE_ORACLE['targets']
+                   for estimate_mode in settings.FEE_ORACLE['estimate_modes']]
+        fee_rates = wallet.utils.fetch_smart_fee_rates(currencycode=currencycode, targets=targets)
+        fetched = time.time()
+        for (number_of_blocks, estimate_mode), fee_rate in zip(targets, fee_rates):
+            # Keep the last rate if the daemon couldn't estimate one this time.
+            if fee_rate is not None:
+                self.smart_fee_rates[(currencycode, number_of_blocks, estimate_mode)] = (fee_rate, fetched)
+
+    def is_fresh(self, cached):
+        return cached is not None and time.time() - cached[1] <= settings.FEE_ORACLE['max_age']
+
+    def get_minimum_fee_rate(self, currencycode):
+        cached = self.minimum_fee_rates.get(currencycode)
+        if self.is_fresh(cached):
+            return cached[0]
+        try:
+            fee_rate = wallet.utils.fetch_minimum_fee_rate(currencycode=currencycode)
+        except Exception as e:
+            if cached is None:
+                raise
+            # The daemon is unavailable, a stale minimum is better than none.
+            print("Failed to fetch %s minimum fee rate, using rate from %ds ago: %s" %
+                  (currencycode, time.time() - cached[1], e))
+            return cached[0]
+        self.minimum_fee_rates[currencycode] = (fee_rate, time.time())
+        return fee_rate
+
+    def get_smart_fee_rate(self, currencycode, number_of_blocks, estimate_mode):
+        key = (currencycode, number_of_blocks, estimate_mode)
+        cached = self.smart_fee_rates.get(key)
+        if self.is_fresh(cached):
+            return cached[0]
+        try:
+            fee_rate = wallet.utils.fetch_smart_fee_rate(currencycode=currencycode, number_of_blocks=number_of_blocks,
+                                                         estimate_mode=estimate_mode)
+        except Exception as e:
+            print("Failed to fetch %s smart fee rate: %s" % (currencycode, e))
+            fee_rate = None
+        if fee_rate is None:
+            if cached is None:
+                return None
+            # The daemon is unavailable or can't estimate, a stale estimate is better than the minimum.
+            print("Failed to fetch %s smart fee rate, using rate from %ds ago" %
+                  (currencycode, time.time() - cached[1]))
+            return cached[0]
+        self.smart_fee_rates[key] = (fee_rate, time.time())
+        return fee_rate
+
+    # Returns (fee rate, minimum fee rate) in satoshi per kilobyte.
+    def get_fee_rates(self, currencycode, number_of_blocks, estimate_mode):
+        if self.pid != os.getpid():
+            self.start()
+        if has_daemon(currencycode):
+            self.currencycodes.add(currencycode)
+
+        minimum_fee_rate = self.get_minimum_fee_rate(currencycode)
+        if number_of_blocks == 0:
+            # Don't estimate a smart fee, just use the minimum allowed fee (this may not be accepted by the network).
+            return minimum_fee_rate, minimum_fee_rate
+
+        fee_rate = self.get_smart_fee_rate(currencycode, number_of_blocks, estimate_mode)
+        if fee_rate is None:
+            return minimum_fee_rate, minimum_fee_rate
+        return fee_rate, minimum_fee_rate
+
+oracle = FeeOracle()
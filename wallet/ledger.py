@@ -0,0 +1,185 @@
+import collections
+
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Func, Sum, Value
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+import trade.models
+import trade.utils
+from order.models import Order
+from wallet.models import Wallet, WalletLedger
+
+
+LEDGER_FIELDS = ['reserved', 'pending_in', 'pending_out']
+
+# Load a wallet's ledger, a wallet with no ledger has no open orders or unsettled trades.
+def get_ledger(wallet):
+    try:
+        return WalletLedger.objects.get(wallet=wallet)
+    except WalletLedger.DoesNotExist:
+        return WalletLedger(wallet=wallet)
+
+# Apply changes to wallet ledgers, where deltas is {wallet_id: {field: delta}}. This must be called inside the
+# transaction that changes the orders or trades the ledgers track.
+def update_ledgers(deltas):
+    wallet_ids = sorted(wallet_id for wallet_id, delta in deltas.items() if any(delta.values()))
+    if not wallet_ids:
+        return
+
+    assert(transaction.get_connection().in_atomic_block)
+    WalletLedger.objects.bulk_create([WalletLedger(wallet_id=wallet_id) for wallet_id in wallet_ids],
+                                     ignore_conflicts=True)
+    # Lock the ledgers in a consistent order so concurrent updates can't deadlock.
+    list(WalletLedger.objects.select_for_update().filter(wallet_id__in=wallet_ids).order_by('wallet_id')
+         .values_list('wallet_id', flat=True))
+
+    now = timezone.now()
+    ledgers = []
+    for wallet_id in wallet_ids:
+        ledger = WalletLedger(wallet_id=wallet_id, modified=now)
+        for field in LEDGER_FIELDS:
+            setattr(ledger, field, F(field) + deltas[wallet_id].get(field, 0))
+        ledgers.append(ledger)
+    WalletLedger.objects.bulk_update(ledgers, LEDGER_FIELDS + ['modified'])
+
+def add_delta(deltas, wallet_id, field, delta):
+    if wallet_id is None:
+        # The user doesn't have a wallet in this currency.
+        return
+    wallet_deltas = deltas.setdefault(wallet_id, {})
+    wallet_deltas[field] = wallet_deltas.get(field, 0) + delta
+
+# The value credited to the buyer's base currency wallet by a trade, once settled.
+def get_buy_in(new_trade):
+    return new_trade.base_volume - trade.utils.convert_quote_to_base(volume=new_trade.buy_fee, price=new_trade.price)
+
+# The value credited to the seller's quote currency wallet by a trade, once settled.
+def get_sell_in(new_trade):
+    return new_trade.volume - new_trade.sell_fee
+
+# Returns {(user_id, currencycode): wallet_id} for the given users and currencies, in a single query.
+def get_user_wallets(user_ids, currencies):
+    user_wallets = {}
+    for wallet_id, user_id, currencycode in Wallet.objects.filter(user__in=set(user_ids), currencycode__in=set(currencies)) \
+            .values_list('id', 'user', 'currencycode'):
+        user_wallets[(user_id, currencycode)] = wallet_id
+    return user_wallets
+
+# A new order reserves its volume in the wallet it was placed from.
+def order_opened(new_order):
+    update_ledgers({new_order.wallet_id: {'reserved': new_order.volume}})
+
+# A canceled or expired order releases its remaining volume.
+def order_closed(closed_order):
+    update_ledgers({closed_order.wallet_id: {'reserved': -closed_order.volume}})
+
+# Trades move volume from reserved by the matched orders to pending out of their wallets, and to pending into the
+# users' wallets for the other currency of the cryptopair. wallet_users is {wallet_id: user_id} for the wallets of all
+# the orders involved.
+def trades_made(new_trades, wallet_users):
+    currencies = set()
+    for new_trade in new_trades:
+        currencies.add(new_trade.buy_order.base_currency)
+        currencies.add(new_trade.sell_order.quote_currency)
+    user_wallets = get_user_wallets(user_ids=wallet_users.values(), currencies=currencies)
+
+    deltas = {}
+    for new_trade in new_trades:
+        buy_order = new_trade.buy_order
+        sell_order = new_trade.sell_order
+        add_delta(deltas, buy_order.wallet_id, 'reserved', -new_trade.volume)
+        add_delta(deltas, buy_order.wallet_id, 'pending_out', new_trade.volume)
+        add_delta(deltas, sell_order.wallet_id, 'reserved', -new_trade.volume)
+        add_delta(deltas, sell_order.wallet_id, 'pending_out', new_trade.base_volume)
+
+        buyer_wallet_id = user_wallets.get((wallet_users[buy_order.wallet_id], buy_order.base_currency))
+        add_delta(deltas, buyer_wallet_id, 'pending_in', get_buy_in(new_trade))
+        seller_wallet_id = user_wallets.get((wallet_users[sell_order.wallet_id], sell_order.quote_currency))
+        add_delta(deltas, seller_wallet_id, 'pending_in', get_sell_in(new_trade))
+    update_ledgers(deltas)
+
+# Trades are no longer pending once settlement moves them out of SETTLED_NONE. settled is a list of
+# (unsettled_trade, order_side, order_direction) for each side ('buy' or 'sell') and direction ('in' or 'out') settled.
+def trades_settled(settled):
+    wallet_ids = set()
+    currencies = set()
+    for unsettled_trade, order_side, order_direction in settled:
+        if order_side == 'buy':
+            wallet_ids.add(unsettled_trade.buy_order.wallet_id)
+            currencies.add(unsettled_trade.buy_order.base_currency)
+        else:
+            wallet_ids.add(unsettled_trade.sell_order.wallet_id)
+            currencies.add(unsettled_trade.sell_order.quote_currency)
+    wallet_users = collections.defaultdict(list)
+    for wallet_id, user_id in Wallet.user.through.objects.filter(wallet__in=wallet_ids).values_list('wallet', 'spauser'):
+        wallet_users[wallet_id].append(user_id)
+    user_wallets = get_user_wallets(user_ids=[user_id for user_ids in wallet_users.values() for user_id in user_ids],
+                                    currencies=currencies)
+
+    deltas = {}
+    for unsettled_trade, order_side, order_direction in settled:
+        if order_side == 'buy':
+            traded_order = unsettled_trade.buy_order
+            if order_direction == 'out':
+                add_delta(deltas, traded_order.wallet_id, 'pending_out', -unsettled_trade.volume)
+            else:
+                for user_id in wallet_users[traded_order.wallet_id]:
+                    add_delta(deltas, user_wallets.get((user_id, traded_order.base_currency)), 'pending_in',
+                              -get_buy_in(unsettled_trade))
+        else:
+            traded_order = unsettled_trade.sell_order
+            if order_direction == 'out':
+                add_delta(deltas, traded_order.wallet_id, 'pending_out', -unsettled_trade.base_volume)
+            else:
+                for user_id in wallet_users[traded_order.wallet_id]:
+                    add_delta(deltas, user_wallets.get((user_id, traded_order.quote_currency)), 'pending_in',
+                              -get_sell_in(unsettled_trade))
+    update_ledgers(deltas)
+
+# Fees are paid in quote currency: the buy fee of each trade is converted to base currency, rounding down the same as
+# trade.utils.convert_quote_to_base().
+NUMERIC = DecimalField(max_digits=40, decimal_places=8)
+BUY_FEE_IN_BASE = Func(ExpressionWrapper(Cast('buy_fee', NUMERIC) * Value(100000000, output_field=NUMERIC) /
+                                         Cast('price', NUMERIC), output_field=NUMERIC),
+                       function='TRUNC', output_field=NUMERIC)
+
+# Recalculate all ledgers from the open orders and unsettled trades, summed per wallet by the database. Trading should
+# be stopped while this runs.
+def rebuild_ledgers():
+    ledgers = collections.defaultdict(dict)
+    user_wallets = {}
+    wallet_users = {}
+    for wallet_id, user_id, currencycode in Wallet.objects.filter(user__isnull=False) \
+            .values_list('id', 'user', 'currencycode').iterator():
+        user_wallets[(user_id, currencycode)] = wallet_id
+        wallet_users[wallet_id] = user_id
+
+    for wallet_id, volume in Order.objects.filter(open=True).values_list('wallet').annotate(total=Sum('volume')):
+        add_delta(ledgers, wallet_id, 'reserved', volume)
+
+    trades = trade.models.Trade.objects
+    for wallet_id, volume in trades.filter(buy_order_settled_out=trade.models.SETTLED_NONE) \
+            .values_list('buy_order__wallet').annotate(total=Sum('volume')):
+        add_delta(ledgers, wallet_id, 'pending_out', volume)
+    for wallet_id, base_volume in trades.filter(sell_order_settled_out=trade.models.SETTLED_NONE) \
+            .values_list('sell_order__wallet').annotate(total=Sum('base_volume')):
+        add_delta(ledgers, wallet_id, 'pending_out', base_volume)
+
+    # Trades pay into the user's wallet in the other currency of the traded order.
+    for wallet_id, currencycode, base_volume, buy_fee in trades.filter(buy_order_settled_in=trade.models.SETTLED_NONE) \
+            .values_list('buy_order__wallet', 'buy_order__base_currency') \
+            .annotate(base_volume=Sum('base_volume'), buy_fee=Sum(BUY_FEE_IN_BASE)):
+        buyer_wallet_id = user_wallets.get((wallet_users.get(wallet_id), currencycode))
+        add_delta(ledgers, buyer_wallet_id, 'pending_in', base_volume - int(buy_fee))
+    for wallet_id, currencycode, volume, sell_fee in trades.filter(sell_order_settled_in=trade.models.SETTLED_NONE) \
+            .values_list('sell_order__wallet', 'sell_order__quote_currency') \
+            .annotate(volume=Sum('volume'), sell_fee=Sum('sell_fee')):
+        seller_wallet_id = user_wallets.get((wallet_users.get(wallet_id), currencycode))
+        add_delta(ledgers, seller_wallet_id, 'pending_in', volume - sell_fee)
+
+    with transaction.atomic():
+        WalletLedger.objects.all().delete()
+        WalletLedger.objects.bulk_create([WalletLedger(wallet_id=wallet_id, **fields)
+                                          for wallet_id, fields in ledgers.items()])
+    return len(ledgers)
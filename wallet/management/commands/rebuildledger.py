@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import wallet.ledger
+
+
+class Command(BaseCommand):
+    help = 'Rebuild all wallet ledgers from open orders and unsettled trades, trading should be stopped first'
+
+    def handle(self, *args, **options):
+        ledger_count = wallet.ledger.rebuild_ledgers()
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt %d wallet ledgers' % ledger_count))
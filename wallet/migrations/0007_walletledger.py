@@ -0,0 +1,79 @@
+# Generated by Django 2.2 on 2026-10-18 10:05
+
+from django.db import migrations, models
+from django.db.models import Q
+import django.db.models.deletion
+
+
+# trade.models.SETTLED_NONE, copied as migrations can't rely on the current models.
+SETTLED_NONE = 0
+
+# Fill in the ledgers from the open orders and unsettled trades, as wallet.ledger.rebuild_ledgers() does.
+def backfill_ledgers(apps, schema_editor):
+    Wallet = apps.get_model('wallet', 'Wallet')
+    WalletLedger = apps.get_model('wallet', 'WalletLedger')
+    Order = apps.get_model('order', 'Order')
+    Trade = apps.get_model('trade', 'Trade')
+
+    ledgers = {}
+    def add_delta(wallet_id, field, delta):
+        if wallet_id is None:
+            # The user doesn't have a wallet in this currency.
+            return
+        ledger = ledgers.setdefault(wallet_id, {'reserved': 0, 'pending_in': 0, 'pending_out': 0})
+        ledger[field] += delta
+
+    user_wallets = {}
+    wallet_users = {}
+    for wallet_id, user_id, currencycode in Wallet.objects.filter(user__isnull=False) \
+            .values_list('id', 'user', 'currencycode').iterator():
+        user_wallets[(user_id, currencycode)] = wallet_id
+        wallet_users[wallet_id] = user_id
+
+    for wallet_id, volume in Order.objects.filter(open=True).values_list('wallet', 'volume').iterator():
+        add_delta(wallet_id, 'reserved', volume)
+
+    unsettled_trades = Trade.objects.filter(
+        Q(buy_order_settled_in=SETTLED_NONE) | Q(buy_order_settled_out=SETTLED_NONE) |
+        Q(sell_order_settled_in=SETTLED_NONE) | Q(sell_order_settled_out=SETTLED_NONE)
+    ).values_list('volume', 'base_volume', 'price', 'buy_fee', 'sell_fee',
+                  'buy_order_settled_in', 'buy_order_settled_out', 'sell_order_settled_in', 'sell_order_settled_out',
+                  'buy_order__wallet', 'buy_order__base_currency', 'sell_order__wallet', 'sell_order__quote_currency')
+    for (volume, base_volume, price, buy_fee, sell_fee, buy_settled_in, buy_settled_out, sell_settled_in,
+         sell_settled_out, buy_wallet_id, base_currency, sell_wallet_id, quote_currency) in unsettled_trades.iterator():
+        if buy_settled_out == SETTLED_NONE:
+            add_delta(buy_wallet_id, 'pending_out', volume)
+        if sell_settled_out == SETTLED_NONE:
+            add_delta(sell_wallet_id, 'pending_out', base_volume)
+        if buy_settled_in == SETTLED_NONE:
+            buyer_wallet_id = user_wallets.get((wallet_users.get(buy_wallet_id), base_currency))
+            add_delta(buyer_wallet_id, 'pending_in', base_volume - int(buy_fee / price * 100000000))
+        if sell_settled_in == SETTLED_NONE:
+            seller_wallet_id = user_wallets.get((wallet_users.get(sell_wallet_id), quote_currency))
+            add_delta(seller_wallet_id, 'pending_in', volume - sell_fee)
+
+    WalletLedger.objects.bulk_create([WalletLedger(wallet_id=wallet_id, **fields)
+                                      for wallet_id, fields in ledgers.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallet', '0006_remove_wallet_wif'),
+        ('order', '0008_auto_20190204_2206'),
+        ('trade', '0007_auto_20190328_1037'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WalletLedger',
+            fields=[
+                ('wallet', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, primary_key=True, related_name='ledger', serialize=False, to='wallet.Wallet')),
+                ('reserved', models.BigIntegerField(default=0)),
+                ('pending_in', models.BigIntegerField(default=0)),
+                ('pending_out', models.BigIntegerField(default=0)),
+                ('modified', models.DateTimeField(auto_now=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_ledgers, migrations.RunPython.noop),
+    ]
@@ -30,3 +30,18 @@ class Wallet(models.Model):
     def __unicode__(self):
         return u'Wallet: %s of user %s' % (self.label, self.user.email)
 
+
+class WalletLedger(models.Model):
+    '''
+    Running totals of a wallet's open orders and unsettled trades. The ledger is updated in the same transaction as the
+    orders and trades it tracks, so checking a wallet's balance doesn't require scanning all its orders and trades.
+    The balance available for trading is the blockchain balance - reserved - pending_out + pending_in.
+    '''
+    wallet = models.OneToOneField(Wallet, primary_key=True, on_delete=models.PROTECT, related_name='ledger')
+    # volume of open orders placed from this wallet
+    reserved = models.BigIntegerField(default=0)
+    # volume of unsettled trades into this wallet, minus fees
+    pending_in = models.BigIntegerField(default=0)
+    # volume of unsettled trades out of this wallet
+    pending_out = models.BigIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True, null=True, blank=True)
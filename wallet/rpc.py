@@ -2,23 +2,54 @@
 Simple JSON-RPC 1.0 "client" implementation for invoking bitcoind and similar servers.
 '''
 import json
+import threading
+import time
 from random import randint
 
 import requests
+import requests.adapters
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
 from django.conf import settings
 
 
-def rpc_request(currencycode, method, parameters=[]):
-    '''
-    Helper function used by all RPC methods to actually make the request.
+# Methods that don't change the daemon's state, which can safely be sent again if we don't know whether the daemon
+# received them.
+READ_ONLY_METHODS = {
+    'createrawtransaction',
+    'decoderawtransaction',
+    'estimatefee',
+    'estimaterawfee',
+    'estimatesmartfee',
+    'getbestblockhash',
+    'getblock',
+    'getblockcount',
+    'getblockhash',
+    'getconnectioncount',
+    'getmempoolinfo',
+    'getrawtransaction',
+    'gettransaction',
+    'gettxout',
+    'signmessagewithprivkey',
+    'signrawtransaction',
+    'signrawtransactionwithkey',
+    'validateaddress',
+}
 
-    :param currencycode: the currencycode identify which daemon to invoke.
-    :param method: the RPC method to invoke.
-    :param parameters: optional parameters for the RPC method.
-    :return: the result of making the query.
-    '''
+# Each daemon has its own pooled keep-alive session, created on first use.
+sessions = {}
+sessions_lock = threading.Lock()
+
+def get_session(currencycode):
+    with sessions_lock:
+        if currencycode not in sessions:
+            session = requests.Session()
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                                   pool_maxsize=settings.RPC['pool_size']))
+            sessions[currencycode] = session
+        return sessions[currencycode]
 
+def get_url(currencycode):
     try:
         rpcauth = settings.COINS[currencycode]['rpcauth']
     except:
@@ -29,9 +60,77 @@ def rpc_request(currencycode, method, parameters=[]):
     except:
         print("%s server not defined in settings.py" % (currencycode,))
         return False
+    return "http://" + rpcauth + "@" + server
+
+# Returns True if a request failed before a connection to the daemon was made, so the daemon never received it.
+def is_connect_failure(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    # Other connection errors wrap the underlying urllib3 error, along with its reason.
+    for arg in error.args:
+        if isinstance(arg, (ConnectTimeoutError, NewConnectionError)) or \
+                isinstance(getattr(arg, 'reason', None), (ConnectTimeoutError, NewConnectionError)):
+            return True
+    return False
+
+def post(currencycode, url, payload, read_only=False):
+    '''
+    Post a request payload to a daemon, retrying with backoff if the daemon can't be reached or its work queue is
+    full. Unless the request is read_only, a request that may have reached the daemon is never retried: a connection
+    aborted after sending it could be processed regardless.
+
+    :return: the response, or False if the request failed.
+    '''
+    delay = settings.RPC['backoff']
+    for attempt in range(settings.RPC['retries'] + 1):
+        if attempt:
+            time.sleep(delay)
+            delay *= 2
+        try:
+            response = get_session(currencycode).post(url, data=json.dumps(payload),
+                                                      headers={'content-type': 'application/json'},
+                                                      timeout=settings.RPC['timeout'])
+        except requests.exceptions.ConnectionError as e:
+            print("failed to connect to %s (%s)" % (url, e))
+            if read_only or is_connect_failure(e):
+                continue
+            return False
+        except Exception as e:
+            print("failed to connect to %s (%s)" % (url, e))
+            return False
+        if response.status_code == 503:
+            print("RPC work queue full at %s, retrying" % url)
+            continue
+        return response
+    return False
+
+def get_result(status_code, method, response, payload_id):
+    if 'error' in response and response['error'] is not None:
+        print("RPC error (%d) for method %s: %s" % (status_code, method, response['error']))
+        return False
+
+    if 'errors' in response and response['errors'] is not None:
+        for error in response['errors']:
+            print("RPC error (%d) for method %s: %s" % (status_code, method, error))
+        return False
+
+    # We must get back our ID, or something went very wrong.
+    assert response["id"] == payload_id
+
+    return response["result"]
 
-    url = "http://" + rpcauth + "@" + server
-    headers = {'content-type': 'application/json'}
+def rpc_request(currencycode, method, parameters=[]):
+    '''
+    Helper function used by all RPC methods to actually make the request.
+
+    :param currencycode: the currencycode identify which daemon to invoke.
+    :param method: the RPC method to invoke.
+    :param parameters: optional parameters for the RPC method.
+    :return: the result of making the query.
+    '''
+    url = get_url(currencycode)
+    if not url:
+        return False
 
     # Set a unique ID for each RPC request. The ID is returned in the response. For our needs it shouldn't be
     # relevant, but we assert that we always get the same ID back as otherwise something has gone wrong.
@@ -44,38 +143,61 @@ def rpc_request(currencycode, method, parameters=[]):
         "id": payload_id,
     }
     # Post the request payload and collect the response.
-    try:
-        response = requests.post(url, data=json.dumps(payload), headers=headers)
-    except Exception as e:
-        print("failed to connect to %s (%s)" % (url, e))
+    response = post(currencycode, url, payload, read_only=method in READ_ONLY_METHODS)
+    if response is False:
         return False
 
-
     #print("payload: %s" % payload)
     #print("response: %s" % response)
 
     try:
         status_code = response.status_code
+        decoded = response.json()
     except:
         print("RPC fatal error: invalid response, verify daemeon is running and rpcauth credentials")
         return False
+    #print("response (decoded): %s" % decoded)
 
-    response = response.json()
-    #print("response (decoded): %s" % response)
+    return get_result(status_code, method, decoded, payload_id)
 
-    if 'error' in response and response['error'] is not None:
-        print("RPC error (%d) for method %s: %s" % (status_code, method, response['error']))
-        return False
+def rpc_batch(currencycode, calls):
+    '''
+    Make many RPC requests to the same daemon in a single HTTP request, using a JSON-RPC batch.
 
-    if 'errors' in response and response['errors'] is not None:
-        for error in response['errors']:
-            print("RPC error (%d) for method %s: %s" % (status_code, method, error))
-        return False
+    :param currencycode: the currencycode identify which daemon to invoke.
+    :param calls: a list of (method, parameters) to invoke.
+    :return: a list with the result of each call, in the same order, or False for calls that failed.
+    '''
+    if not calls:
+        return []
+    url = get_url(currencycode)
+    if not url:
+        return [False] * len(calls)
 
-    # We must get back our ID, or something went very wrong.
-    assert response["id"] == payload_id
+    # Each call in the batch gets its own ID, the daemon may respond in any order.
+    payload = [{"method": method, "params": parameters, "id": payload_id}
+               for payload_id, (method, parameters) in enumerate(calls)]
+    response = post(currencycode, url, payload,
+                    read_only=all(method in READ_ONLY_METHODS for method, parameters in calls))
+    if response is False:
+        return [False] * len(calls)
 
-    return response["result"]
+    try:
+        status_code = response.status_code
+        decoded = response.json()
+        responses = {call_response["id"]: call_response for call_response in decoded}
+    except:
+        print("RPC fatal error: invalid batch response, verify daemeon is running and rpcauth credentials")
+        return [False] * len(calls)
+
+    results = []
+    for payload_id, (method, parameters) in enumerate(calls):
+        if payload_id not in responses:
+            print("RPC error (%d) for method %s: no response in batch" % (status_code, method))
+            results.append(False)
+        else:
+            results.append(get_result(status_code, method, responses[payload_id], payload_id))
+    return results
 
 methods = {
     'abandontransaction': {
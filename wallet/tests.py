@@ -5,6 +5,7 @@ from pprint import pprint
 from django.core.cache import cache
 from rest_framework import status
 from rest_framework.test import APITestCase
+from django.test import SimpleTestCase
 from django.shortcuts import get_object_or_404
 
 from spauser.models import SpaUser
@@ -12,6 +13,7 @@ from address.models import Address
 from wallet.models import Wallet
 import blockchain.utils
 import spauser.utils
+import wallet.coinselection
 import wallet.utils
 
 def load_addresses_into_wallet(self, wallet_id, public_addresses, change_addresses):
@@ -1093,3 +1095,85 @@ class WalletTest(APITestCase):
         print("dogecoin testnet3 (XDG) txid(%s) sent %s to %s (fee %s)" %
               (txid, wallet.utils.convert_to_decimal(total_value), ", ".join(to_addresses),
                wallet.utils.convert_to_decimal(fee)))
+
+
+class CoinSelectionTest(SimpleTestCase):
+    def get_values(self, selected):
+        if selected is None:
+            return None
+        return sorted(detail['value'] for detail in selected)
+
+    def test_coin_selection(self):
+        """
+        Verify branch and bound finds unspent outputs that need no change, and the fallbacks otherwise cover the value
+        needed.
+        """
+        unspent = [{'txid': 'tx%d' % index, 'vout': 0, 'address': 'address%d' % index, 'value': value,
+                    'type': 'p2pkh'} for index, value in enumerate([50000, 30000, 20000, 15000, 7000, 1000])]
+
+        # An exact match, and a match within the tolerance.
+        self.assertEqual(self.get_values(wallet.coinselection.select_branch_and_bound(
+            unspent, 37000, tolerance=0, max_tries=100000)), [7000, 30000])
+        self.assertEqual(self.get_values(wallet.coinselection.select_branch_and_bound(
+            unspent, 35500, tolerance=500, max_tries=100000)), [1000, 15000, 20000])
+        # No combination is within the tolerance.
+        self.assertIsNone(wallet.coinselection.select_branch_and_bound(unspent, 36500, tolerance=200,
+                                                                       max_tries=100000))
+
+        self.assertEqual(self.get_values(wallet.coinselection.select_knapsack(unspent, 36500)), [50000])
+        self.assertEqual(self.get_values(wallet.coinselection.select_knapsack(unspent, 60000)), [30000, 50000])
+        self.assertEqual(self.get_values(wallet.coinselection.select_largest_first(unspent, 36500)), [50000])
+        self.assertEqual(self.get_values(wallet.coinselection.select_smallest_first(unspent, 36500)),
+                         [1000, 7000, 15000, 20000])
+
+        # Not enough funds.
+        for selected in [wallet.coinselection.select_branch_and_bound(unspent, 200000, tolerance=0, max_tries=100000),
+                         wallet.coinselection.select_knapsack(unspent, 200000),
+                         wallet.coinselection.select_largest_first(unspent, 200000),
+                         wallet.coinselection.select_smallest_first(unspent, 200000)]:
+            self.assertIsNone(selected)
+
+    def test_coin_selection_with_fee(self):
+        """
+        Verify selecting unspent outputs with a fee rate returns the fee for the transaction with the selected inputs,
+        and only adds change when it's worth an output.
+        """
+        unspent = [{'txid': 'tx%d' % index, 'vout': 0, 'address': 'address%d' % index, 'value': value,
+                    'type': address_type} for index, (value, address_type)
+                   in enumerate([(50000, 'p2pkh'), (30000, 'bech32'), (20000, 'p2pkh'), (100, 'p2pkh')])]
+
+        # The bech32 output covers the value and fee within the tolerance: there's no change, the rest is fee.
+        selected, vsize, fee, change = wallet.coinselection.select_unspent_with_fee(
+            unspent, 29000, output_types=['p2pkh'], fee_rate=1000)
+        self.assertEqual(self.get_values(selected), [30000])
+        self.assertEqual((vsize, fee, change), (113, 1000, 0))
+
+        selected, vsize, fee, change = wallet.coinselection.select_unspent_with_fee(
+            unspent, 29900, output_types=['p2pkh'], fee_rate=1000)
+        self.assertEqual(self.get_values(selected), [20000, 30000])
+        self.assertEqual(vsize, wallet.utils.estimate_transaction_vsize(['bech32', 'p2pkh'], ['p2pkh', 'p2pkh']))
+        self.assertEqual((fee, change), (295, 19805))
+
+        # The 100 satoshi output costs more to spend than it's worth, so it can't help.
+        self.assertIsNone(wallet.coinselection.select_unspent_with_fee(unspent, 99700, output_types=['p2pkh'],
+                                                                       fee_rate=1000))
+
+
+class AddressValidationTest(SimpleTestCase):
+    def test_is_address_valid(self):
+        """
+        Verify base58check and bech32 addresses are validated locally, and addresses in formats we don't know for the
+        network are left for the daemon.
+        """
+        self.assertTrue(wallet.utils.is_address_valid('BTC', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2'))
+        self.assertTrue(wallet.utils.is_address_valid('BTC', '3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy'))
+        self.assertTrue(wallet.utils.is_address_valid('BTC', 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'))
+        self.assertTrue(wallet.utils.is_address_valid(
+            'XTN', 'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7'))
+
+        # Bad checksums.
+        self.assertFalse(wallet.utils.is_address_valid('BTC', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN3'))
+        self.assertFalse(wallet.utils.is_address_valid('BTC', 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5'))
+
+        # A mainnet address isn't a testnet address, but only the daemon knows what else it could be.
+        self.assertIsNone(wallet.utils.is_address_valid('XTN', '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2'))
@@ -1,170 +1,36 @@
 import json
 import binascii
+import functools
 import re
 import base58
 from pprint import pprint
 
 from django.conf import settings
+from django.db.models import Q
 from django.urls import reverse
 from rest_framework import status
-import requests
+from pycoin.contrib import segwit_addr
+from pycoin.encoding import EncodingError, a2b_hashed_base58
 from pycoin.key.BIP32Node import BIP32Node
+from pycoin.networks import address_prefix_for_netcode, bech32_hrp_for_netcode, pay_to_script_prefix_for_netcode
 from mnemonic import Mnemonic
 
+import wallet.coinselection
+import wallet.fees
+import wallet.ledger
 import wallet.rpc
 import reporting.utils
-import trade.utils
 import spauser.utils
 from address.models import Address
 from wallet.models import Wallet
-from order.models import Order
-from trade.models import Trade
 import blockchain.utils
 
 
-def get_unsettled_open_orders_or_filled_trades_out(identifiers, wallet):
-    balance_out = 0
-
-    # Look for open buy orders from same wallet where quote currency matches wallet currency.
-    # A buy order has a side of True (see order.models for definition).
-    # A buy order is an ask for base currency: open buy orders subtract quote currency from the wallet.
-    for open_buy_order in Order.objects.filter(wallet=wallet, quote_currency=wallet.currencycode, side=True, open=True):
-        balance_out += open_buy_order.volume
-        reporting.utils.audit(message="open buy order with wallet in quote currency", details={
-            'identifiers': identifiers,
-            'open_order_details': {
-                'id': open_buy_order.id,
-                'cryptopair': open_buy_order.cryptopair,
-                'description': open_buy_order.description,
-                'volume': open_buy_order.volume,
-                'fee': open_buy_order.fee,
-                'balance_out': balance_out,
-            }
-        })
-
-    # Look for open sell orders from same wallet where base currency matches wallet currency.
-    # A sell order has a side of False (see order.models for definition).
-    # A sell order is an offer for base currency: open sell orders subtract base currency from the wallet.
-    for open_sell_order in Order.objects.filter(wallet=wallet, base_currency=wallet.currencycode, side=False, open=True):
-        balance_out += open_sell_order.volume
-        reporting.utils.audit(message="open sell order with wallet in base currency", details={
-            'identifiers': identifiers,
-            'open_order_details': {
-                'id': open_sell_order.id,
-                'cryptopair': open_sell_order.cryptopair,
-                'description': open_sell_order.description,
-                'volume': open_sell_order.volume,
-                'fee': open_sell_order.fee,
-                'balance_out': balance_out,
-            }
-        })
-
-    # Look for unsettled trades of buy orders from same wallet where quote currency matches wallet currency.
-    for unsettled_buy_trade in Trade.objects.filter(buy_order__wallet=wallet,
-                                                    buy_order__quote_currency=wallet.currencycode,
-                                                    buy_order_settled_out=trade.models.SETTLED_NONE):
-        balance_out += unsettled_buy_trade.volume
-        reporting.utils.audit(message="unsettled buy order trade from quote currency wallet", details={
-            'identifiers': identifiers,
-            'open_order_details': {
-                'id': unsettled_buy_trade.id,
-                'cryptopair': unsettled_buy_trade.cryptopair,
-                'volume': unsettled_buy_trade.volume,
-                'price': unsettled_buy_trade.price,
-                'buy_fee': unsettled_buy_trade.buy_fee,
-                'balance_out': balance_out,
-            }
-        })
-
-    # Look for unsettled trades of sell orders from same wallet where base currency matches wallet currency.
-    for unsettled_sell_trade in Trade.objects.filter(sell_order__wallet=wallet,
-                                                     sell_order__base_currency=wallet.currencycode,
-                                                     sell_order_settled_out=trade.models.SETTLED_NONE):
-        balance_out += unsettled_sell_trade.base_volume
-        reporting.utils.audit(message="unsettled sell order trade from base currency wallet", details={
-            'identifiers': identifiers,
-            'open_order_details': {
-                'id': unsettled_sell_trade.id,
-                'cryptopair': unsettled_sell_trade.cryptopair,
-                'base_volume': unsettled_sell_trade.base_volume,
-                'volume': unsettled_sell_trade.volume,
-                'price': unsettled_sell_trade.price,
-                'buy_fee': unsettled_sell_trade.buy_fee,
-                'balance_out': balance_out,
-            }
-        })
-
-    return balance_out
-
-def get_unsettled_trades_in(identifiers, wallet, user_id):
-    balance_in = 0
-
-    for cryptopair in settings.CRYPTOPAIRS.keys():
-        base_currency = settings.CRYPTOPAIRS[cryptopair]['base']
-        quote_currency = settings.CRYPTOPAIRS[cryptopair]['quote']
-
-        if wallet.currencycode == base_currency:
-            # The wallet is part of this cryptopair, load the other half (quote currency) to look for relevant trades.
-            try:
-                pair_opposite_wallet = Wallet.objects.get(user=user_id, currencycode=quote_currency)
-            except:
-                # This wallet doesn't exist.
-                continue
-        elif wallet.currencycode == quote_currency:
-            # The wallet is part of this cryptopair, load the other half (base currency) to look for relevant trades.
-            try:
-                pair_opposite_wallet = Wallet.objects.get(user=user_id, currencycode=base_currency)
-            except:
-                # This wallet doesn't exist.
-                continue
-        else:
-            # The wallet is not part of this cryptopair, so skip onto the next.
-            continue
-
-        # A buy order is an ask for base currency: open buy orders add base currency and subtract quote currency.
-        # Look for unsettled trades of buy orders from same wallet where base currency matches wallet currency.
-        for unsettled_buy_trade in Trade.objects.filter(buy_order__wallet=pair_opposite_wallet,
-                                                        buy_order__quote_currency=pair_opposite_wallet.currencycode,
-                                                        buy_order_settled_in=trade.models.SETTLED_NONE):
-            balance_in += unsettled_buy_trade.base_volume - trade.utils.convert_quote_to_base(volume=unsettled_buy_trade.buy_fee, price=unsettled_buy_trade.price)
-            reporting.utils.audit(message="unsettled buy order trade into base currency wallet", details={
-                'identifiers': identifiers,
-                'open_order_details': {
-                    'id': unsettled_buy_trade.id,
-                    'cryptopair': unsettled_buy_trade.cryptopair,
-                    'base_volume': unsettled_buy_trade.base_volume,
-                    'volume': unsettled_buy_trade.volume,
-                    'price': unsettled_buy_trade.price,
-                    'buy_fee': unsettled_buy_trade.buy_fee,
-                    'balance_in': balance_in,
-                }
-            })
-
-        # A sell order is an ask for base currency: open sell orders subtract base currency and add quote currency.
-        # Look for unsettled trades of sell orders from same wallet where quote currency matches wallet currency.
-        for unsettled_sell_trade in Trade.objects.filter(sell_order__wallet=pair_opposite_wallet,
-                                                         sell_order__base_currency=pair_opposite_wallet.currencycode,
-                                                         sell_order_settled_in=trade.models.SETTLED_NONE):
-            balance_in += unsettled_sell_trade.volume - unsettled_sell_trade.sell_fee
-            reporting.utils.audit(message="unsettled sell order trade into quote currency wallet", details={
-                'identifiers': identifiers,
-                'open_order_details': {
-                    'id': unsettled_sell_trade.id,
-                    'cryptopair': unsettled_sell_trade.cryptopair,
-                    'volume': unsettled_sell_trade.volume,
-                    'price': unsettled_sell_trade.price,
-                    'buy_fee': unsettled_sell_trade.buy_fee,
-                    'balance_in': balance_in,
-                }
-            })
-
-    return balance_in
-
 def get_balances(identifiers, user_wallet):
     blockchain_balance, pending_balance, pending_details = blockchain.utils.get_balance(identifiers={}, user_wallet=user_wallet)
-    orders_and_trades_out = get_unsettled_open_orders_or_filled_trades_out({}, wallet=user_wallet)
-    user_object = user_wallet.user.get()
-    trades_in = get_unsettled_trades_in(identifiers={}, wallet=user_wallet, user_id=user_object.id)
+    ledger = wallet.ledger.get_ledger(user_wallet)
+    orders_and_trades_out = ledger.reserved + ledger.pending_out
+    trades_in = ledger.pending_in
     trade_balance = blockchain_balance - orders_and_trades_out + trades_in
     withdrawal_balance = blockchain_balance - orders_and_trades_out
     return {
@@ -397,15 +263,21 @@ def get_output(request, user_wallet):
     try:
         output = request.data['output']
         total = 0
-        for address in output:
-            try:
-                validated = validate_address(currencycode=user_wallet.currencycode, address=address)
-            except Exception as e:
+        addresses = list(output)
+        validations = dict((address, {'isvalid': is_valid}) for address, is_valid in
+                           [(address, is_address_valid(currencycode=user_wallet.currencycode, address=address))
+                            for address in addresses] if is_valid is not None)
+        # Only addresses in formats we can't validate locally are sent to the daemon.
+        unknown_addresses = [address for address in addresses if address not in validations]
+        validations.update(zip(unknown_addresses, validate_addresses(currencycode=user_wallet.currencycode,
+                                                                     addresses=unknown_addresses)))
+        for address in addresses:
+            validated = validations[address]
+            if validated is False:
                 status_code = status.HTTP_503_SERVICE_UNAVAILABLE
                 data = {
                     "status": "failed to communicate with daemon",
                     "code": status_code,
-                    "error": str(e),
                     "data": {
                         'symbol': user_wallet.currencycode,
                         'address': address,
@@ -509,108 +381,155 @@ def get_priority(request):
 
     return number_of_blocks, estimate_mode, True
 
-def get_unspent_equal_or_greater(wallet, value_needed):
-    addresses_with_unspent = set()
-    addresses = set()
-    unspent = []
-    total = 0
-    # @TODO: implement a smarter algorithm for finding unspent vout. For now we load wallet addresses in random order.
-    for address_in_wallet in Address.objects.filter(wallet=wallet.id).order_by('?'):
-        for an_address in [address_in_wallet.p2pkh, address_in_wallet.p2sh_p2wpkh, address_in_wallet.bech32]:
-            if an_address:
-                url = '%s://%s:%d/api/address/%s/%s/unspent' % (settings.ADDRESSAPI['protocol'],
-                                                                settings.ADDRESSAPI['domain'],
-                                                                settings.ADDRESSAPI['port'],
-                                                                settings.COINS[wallet.currencycode]['name'],
-                                                                an_address)
-                try:
-                    addresses.add(an_address)
-                    response = requests.get(url)
-                    addressapi = json.loads(response.content)
-                except Exception as e:
-                    print("request to %s failed" % url)
-                    status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-                    data = {
-                        'status': 'fail',
-                        'code': status_code,
-                        'debug': {
-                            'url': url,
-                            'error': str(e),
-                        }
-                    }
-                    return data, False, False, status_code
-
-                try:
-                    # 'unspent' is only set if the address was found in the blockchain (ie, it's received funds)
-                    if 'unspent' in addressapi['data']:
-                        for txid in addressapi['data']['unspent']:
-                            for vout in addressapi['data']['unspent'][txid]:
-                                if vout != 'height':
-                                    value = addressapi['data']['unspent'][txid][vout]
-                                    total += value
-                                    unspent.append({'txid': txid, 'vout': int(vout)})
-                                    addresses_with_unspent.add(an_address)
-                                    if total >= value_needed:
-                                        # cash out as soon as we find enough money
-                                        return unspent, addresses_with_unspent, total, True
-                except Exception as e:
-                    print("unexpected error: %s" % e)
-
-    # If we get here, there's not enough money in the wallet
-    status_code = status.HTTP_200_OK
-    data = {
-        "status": "insufficient funds",
-        "code": status_code,
-        "debug": {
-            'wallet_id': wallet.id,
-            'currencycode': wallet.currencycode,
-            'unspent': unspent,
-            'total': total,
-            'addresses': addresses,
-            'addresses_with_unspent': addresses_with_unspent,
-        },
-        "data": {},
-    }
-    return data, False, False, status_code
+# Select unspent outputs from the wallet totaling at least value_needed, see wallet.coinselection. With details, each
+# unspent output also includes the address it was sent to, its value and its address type.
+def get_unspent_equal_or_greater(user_wallet, value_needed, details=False):
+    unspent, success = wallet.coinselection.get_wallet_unspent(user_wallet)
+    if success is not True:
+        # If success isn't true, unspent contains an error
+        return unspent, False, False, success
+
+    selected = wallet.coinselection.select_unspent(unspent, value_needed)
+    if selected is None:
+        # There's not enough money in the wallet
+        status_code = status.HTTP_200_OK
+        data = {
+            "status": "insufficient funds",
+            "code": status_code,
+            "debug": {
+                'wallet_id': user_wallet.id,
+                'currencycode': user_wallet.currencycode,
+                'unspent': unspent,
+                'total': sum(detail['value'] for detail in unspent),
+            },
+            "data": {},
+        }
+        return data, False, False, status_code
+
+    addresses_with_unspent = set(detail['address'] for detail in selected)
+    total = sum(detail['value'] for detail in selected)
+    if not details:
+        selected = [{'txid': detail['txid'], 'vout': detail['vout']} for detail in selected]
+    return selected, addresses_with_unspent, total, True
+
+# Select unspent outputs from the wallet paying value_needed to outputs of the given address types, plus the network
+# fee at fee_rate satoshi per kilobyte, see wallet.coinselection.select_unspent_with_fee(). Returns (unspent, addresses
+# with unspent, total, fee, change, True), change is 0 if the transaction needs no change output.
+def get_unspent_with_fee(user_wallet, value_needed, output_types, fee_rate):
+    unspent, success = wallet.coinselection.get_wallet_unspent(user_wallet)
+    if success is not True:
+        # If success isn't true, unspent contains an error
+        return unspent, False, False, False, False, success
+
+    selection = wallet.coinselection.select_unspent_with_fee(unspent, value_needed, output_types=output_types,
+                                                             fee_rate=fee_rate)
+    if selection is None:
+        # There's not enough money in the wallet
+        status_code = status.HTTP_200_OK
+        data = {
+            "status": "insufficient funds",
+            "code": status_code,
+            "debug": {
+                'wallet_id': user_wallet.id,
+                'currencycode': user_wallet.currencycode,
+                'unspent': unspent,
+                'total': sum(detail['value'] for detail in unspent),
+                'fee_rate': fee_rate,
+            },
+            "data": {},
+        }
+        return data, False, False, False, False, status_code
 
-def calculate_fee(wallet, vin, vout, number_of_blocks, estimate_mode):
-    mempool_info = get_mempool_info(currencycode=wallet.currencycode)
+    selected, vsize, fee, change = selection
+    addresses_with_unspent = set(detail['address'] for detail in selected)
+    total = sum(detail['value'] for detail in selected)
+    selected = [{'txid': detail['txid'], 'vout': detail['vout']} for detail in selected]
+    return selected, addresses_with_unspent, total, fee, change, True
+
+# Returns (fee rate, minimum fee rate) in satoshi per kilobyte, served by the fee oracle, see wallet.fees.
+def get_fee_rates(currencycode, number_of_blocks, estimate_mode):
+    return wallet.fees.oracle.get_fee_rates(currencycode=currencycode, number_of_blocks=number_of_blocks,
+                                            estimate_mode=estimate_mode)
+
+# Query the daemon for the minimum fee rate accepted into its mempool, in satoshi per kilobyte.
+def fetch_minimum_fee_rate(currencycode):
+    mempool_info = get_mempool_info(currencycode=currencycode)
     try:
         # Bitcoind and Litecoind define both mempoolminfee and minrelaytxfee
-        minimum_fee_multiplier = int(max(mempool_info['mempoolminfee'], mempool_info['minrelaytxfee']) * 100000000)
+        return int(max(mempool_info['mempoolminfee'], mempool_info['minrelaytxfee']) * 100000000)
     except:
         # Dogecoin only defines mempoolminfee
-        minimum_fee_multiplier = int(mempool_info['mempoolminfee'] * 100000000)
-
-    if number_of_blocks == 0:
-        # Don't make an RPC request for smart fee, just use the minimum allowed fee (this may not be accepted by the
-        # network).
-        fee_multiplier = minimum_fee_multiplier
-    else:
-        fee_multiplier = estimate_smart_fee(currencycode=wallet.currencycode, number_of_blocks=number_of_blocks,
-                                            estimate_mode=estimate_mode)
-
+        return int(mempool_info['mempoolminfee'] * 100000000)
+
+# Query the daemon for a fee rate likely to confirm within number_of_blocks, in satoshi per kilobyte. Returns None if
+# the daemon can't estimate one.
+def fetch_smart_fee_rate(currencycode, number_of_blocks, estimate_mode):
+    return convert_smart_fee(estimate_smart_fee(currencycode=currencycode, number_of_blocks=number_of_blocks,
+                                                estimate_mode=estimate_mode))
+
+# Query the daemon for the fee rates of many (number_of_blocks, estimate_mode) targets in one batch, returns a list of
+# fee rates in the same order, see fetch_smart_fee_rate().
+def fetch_smart_fee_rates(currencycode, targets):
+    return [convert_smart_fee(fee_multiplier) for fee_multiplier in wallet.rpc.rpc_batch(
+        currencycode=currencycode, calls=[('estimatesmartfee', [number_of_blocks, estimate_mode])
+                                          for number_of_blocks, estimate_mode in targets])]
+
+def convert_smart_fee(fee_multiplier):
     if not fee_multiplier:
         print("WARNING: Failed to estimate smart fee")
-        fee_multiplier = {
-            'feerate': minimum_fee_multiplier,
-        }
+        return None
     elif "errors" in fee_multiplier:
         print("WARNING: RPC call to estimatesmartfee failed with the following errors:")
         for error in fee_multiplier["errors"]:
             print(" - '%s'" % error)
-        fee_multiplier = {
-            'feerate': minimum_fee_multiplier,
-        }
-
-    # @TODO: it's possible to not have change, technically we shouldn't assume we have change here
-    vin_count = len(vin)  #
-    vout_count = len(vout) + 1  # +1 is for change
-    transaction_size = vin_count * 180 + vout_count * 34 + 10 + vin_count
-    calculated_fee = round(transaction_size / 1024 * fee_multiplier['feerate'])
-    minimum_fee = round(transaction_size / 1024 * minimum_fee_multiplier)
-    # Choose which ever fee is greater
-    return max(calculated_fee, minimum_fee), True
+        return None
+    # estimatesmartfee returns the fee rate in coins per kilobyte
+    return int(fee_multiplier['feerate'] * 100000000)
+
+# The virtual size in bytes of an input spending, and of an output paying, each type of address. Inputs assume a 72
+# byte signature and a compressed public key.
+INPUT_VSIZE = {
+    'p2pkh': 148,
+    'p2sh_p2wpkh': 91,
+    'bech32': 68,
+}
+OUTPUT_VSIZE = {
+    'p2pkh': 34,
+    'p2sh_p2wpkh': 32,
+    'bech32': 31,
+}
+
+# Returns {address: type} for addresses in our wallets, where type is 'p2pkh', 'p2sh_p2wpkh' or 'bech32'. Other
+# addresses are assumed to be p2pkh, the largest type.
+def get_address_types(addresses):
+    addresses = set(addresses)
+    address_types = {an_address: 'p2pkh' for an_address in addresses}
+    for p2pkh, p2sh_p2wpkh, bech32 in Address.objects.filter(Q(p2pkh__in=addresses) | Q(p2sh_p2wpkh__in=addresses) |
+                                                             Q(bech32__in=addresses)) \
+            .values_list('p2pkh', 'p2sh_p2wpkh', 'bech32'):
+        if p2sh_p2wpkh in addresses:
+            address_types[p2sh_p2wpkh] = 'p2sh_p2wpkh'
+        if bech32 in addresses:
+            address_types[bech32] = 'bech32'
+    return address_types
+
+def get_varint_size(count):
+    if count < 0xfd:
+        return 1
+    elif count <= 0xffff:
+        return 3
+    return 5
+
+# Estimate the virtual size in bytes of a transaction with inputs and outputs of the given address types.
+def estimate_transaction_vsize(input_types, output_types):
+    # version and locktime
+    vsize = 8 + get_varint_size(len(input_types)) + get_varint_size(len(output_types))
+    vsize += sum(INPUT_VSIZE[input_type] for input_type in input_types)
+    vsize += sum(OUTPUT_VSIZE[output_type] for output_type in output_types)
+    if any(input_type != 'p2pkh' for input_type in input_types):
+        # segwit marker and flag, rounded up
+        vsize += 1
+    return vsize
 
 def create_raw_transaction(currencycode, input, output):
     return wallet.rpc.rpc_request(currencycode=currencycode, method='createrawtransaction', parameters=[input, output])
@@ -637,6 +556,42 @@ def get_mempool_info(currencycode):
 def validate_address(currencycode, address):
     return wallet.rpc.rpc_request(currencycode=currencycode, method='validateaddress', parameters=[address])
 
+# Validate an address without asking the daemon, using the pycoin network definitions for the currencycode: base58check
+# p2pkh and p2sh addresses, and bech32 addresses. Returns True or False, or None if the address is in a format we don't
+# know for the currencycode, which only the daemon can validate.
+@functools.lru_cache(maxsize=10000)
+def is_address_valid(currencycode, address):
+    try:
+        prefixes = [address_prefix_for_netcode(currencycode), pay_to_script_prefix_for_netcode(currencycode)]
+        hrp = bech32_hrp_for_netcode(currencycode)
+    except Exception:
+        # pycoin doesn't know this network
+        return None
+
+    try:
+        decoded = a2b_hashed_base58(address)
+    except EncodingError:
+        decoded = None
+    if decoded is not None:
+        if len(decoded) == 21 and decoded[:1] in prefixes:
+            return True
+        # A valid checksum with another prefix or length, perhaps a version this pycoin doesn't know.
+        return None
+
+    if hrp and address.lower().startswith(hrp + '1'):
+        witness_version, witness_program = segwit_addr.decode(hrp, address)
+        return witness_version is not None
+    address_hrp, separator, data = address.lower().rpartition('1')
+    if address_hrp and len(data) >= 6 and all(character in segwit_addr.CHARSET for character in data):
+        # Perhaps a bech32 address with a prefix pycoin doesn't know for this network.
+        return None
+    return False
+
+# Validate many addresses in one batch, returns a list of results in the same order.
+def validate_addresses(currencycode, addresses):
+    return wallet.rpc.rpc_batch(currencycode=currencycode, calls=[('validateaddress', [address])
+                                                                  for address in addresses])
+
 def convert_to_decimal(value):
     return value / 100000000
 
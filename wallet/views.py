@@ -1,6 +1,7 @@
 import secrets
 
 from django.conf import settings
+from django.db.models import Q
 from rest_framework import views, permissions, generics, status
 from rest_framework.response import Response
 from mnemonic import Mnemonic
@@ -352,62 +353,38 @@ class WalletSendView(views.APIView):
             # If status code is set, then number_of_blocks is a JSON-formatted error: abort!
             return Response(number_of_blocks, status=success)
 
-        # STEP 1: find enough unspent to cover desired transaction
-        total_to_send = output_total
-        unspent, addresses, unspent_total, success = wallet.utils.get_unspent_equal_or_greater(user_wallet, total_to_send)
+        # STEP 1: find enough unspent to cover desired transaction, and the fee for the transaction with those inputs
+        #   https://bitcoin.org/en/developer-reference#estimatefee
+        fee_rate, minimum_fee_rate = wallet.utils.get_fee_rates(currencycode=user_wallet.currencycode,
+                                                                number_of_blocks=number_of_blocks,
+                                                                estimate_mode=estimate_mode)
+        output_types = wallet.utils.get_address_types(output.keys())
+        unspent, addresses, unspent_total, fee, change, success = wallet.utils.get_unspent_with_fee(
+            user_wallet, output_total, output_types=[output_types[out_address] for out_address in output],
+            fee_rate=max(fee_rate, minimum_fee_rate))
         if success is not True:
             # If success isn't true, unspent contains an error: abort
             return Response(unspent, status=success)
 
-        # STEP 2: calculate fee and change
-        #   https://bitcoin.org/en/developer-reference#estimatefee
-        fee, valid = wallet.utils.calculate_fee(wallet=user_wallet, vout=unspent, vin=output,
-                                                number_of_blocks=number_of_blocks, estimate_mode=estimate_mode)
-
-        if not valid:
-            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
-            data = {
-                "status": "fee error",
-                "code": status_code,
-                "debug": {
-                    "request": self.request.data,
-                    "fee": fee,
-                    "unspent": unspent,
-                    "output": output,
-                    "number_of_blocks": number_of_blocks,
-                    "estimate_mode": estimate_mode,
-                },
-                "data": {},
-            }
-            return Response(data, status=status_code)
-
-        # Check if our unspent can cover our desired transaction plus the calculated fee,
-        # if not re-request unspent this time including enough for the fee.
-        if (output_total + fee) > unspent_total:
-            print("fee grew, re-request unspent")
-            # TODO: loop in case this requires more unspent and therefor a larger fee
-            unspent, addresses, unspent_total, success = wallet.utils.get_unspent_equal_or_greater(user_wallet, total_to_send + fee)
-            if success is not True:
-                # If success isn't true, unspent contains an error: abort
-                return Response(unspent, status=success)
-
-        change = unspent_total - (total_to_send + fee)
-        #print("addresses: %s, unspent: %s, change: %s" % (addresses, unspent, change))
-
-        # STEP 3: create a raw transaction including unspent and destination address
+        # STEP 2: create a raw transaction including unspent and destination address
         final_output = {}
         for out_address in output:
             # Build an array of outputs we are sending
             final_output[out_address] = wallet.utils.convert_to_decimal(output[out_address])
             # An address may have multiple outputs, use a set to only get each address once
 
-        new_change_address, change_index = address.utils.get_new_address(user_wallet=user_wallet, is_change=True)
-        final_output[new_change_address['p2pkh']] = wallet.utils.convert_to_decimal(change)
+        if change:
+            new_change_address, change_index = address.utils.get_new_address(user_wallet=user_wallet, is_change=True)
+            final_output[new_change_address['p2pkh']] = wallet.utils.convert_to_decimal(change)
+        else:
+            # Coin selection found unspent close enough to what we're sending that change isn't worth an output, the
+            # difference is paid as fee.
+            new_change_address = None
         #pprint(final_output)
         raw_tx = wallet.utils.create_raw_transaction(currencycode=user_wallet.currencycode, input=unspent, output=final_output)
         #print("raw_tx: %s" % raw_tx)
 
-        # STEP 4: sign the raw transaction
+        # STEP 3: sign the raw transaction
         # @TODO request private key from secrets database -- limit each wallet to only 1 private key
         private_keys = []
         # Load wallet's private key, effectively unlocking it
@@ -415,7 +392,8 @@ class WalletSendView(views.APIView):
         # Get WIF for all addresses we're sending from
         for to_address in addresses:
             #print("to_address: %s" % to_address)
-            loaded_address = Address.objects.filter(wallet=user_wallet.id, p2pkh=to_address)
+            loaded_address = Address.objects.filter(Q(p2pkh=to_address) | Q(p2sh_p2wpkh=to_address) | Q(bech32=to_address),
+                                                    wallet=user_wallet.id)
             for la in loaded_address:
                 if la.is_change:
                     is_change = 1
@@ -472,13 +450,16 @@ class WalletSendView(views.APIView):
             }
             return Response(data, status=status_code)
 
-        # STEP 5: send the signed transaction
+        # STEP 4: send the signed transaction
         txid = wallet.utils.send_signed_transaction(currencycode=user_wallet.currencycode, signed_tx=signed_tx['hex'])
 
-        if txid:
+        if txid and new_change_address:
             # funds were sent, add the change address to our wallet
             wallet.utils.add_addresses_to_wallet(wallet_id=user_wallet.id, label='change', p2pkh=new_change_address['p2pkh'],
                                                  p2sh_p2wpkh=None, bech32=None, index=change_index, is_change=True)
+        if txid:
+            # The outputs we spent are no longer unspent, don't serve them from the cache.
+            blockchain.utils.clear_unspent(coin=settings.COINS[user_wallet.currencycode]['name'], addresses=addresses)
             status_message = "funds sent"
         else:
             status_message = "no funds sent"
@@ -494,7 +475,7 @@ class WalletSendView(views.APIView):
                 "fee": fee,
                 "output": final_output,
                 "spent": unspent,
-                "change_address": new_change_address['p2pkh'],
+                "change_address": new_change_address['p2pkh'] if new_change_address else None,
             },
         }
         return Response(data, status=status_code)